@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """
+    Text file written by a background thread. Chunks passed to write are
+    queued and written in order while the caller formats the next ones, and
+    several writers write their files concurrently (file writes release the
+    GIL).
+
+    The queue holds at most max_pending chunks to cap memory. An error of the
+    writing thread is raised by the next write or by close.
+    """
+
+    def __init__(self, fpath, max_pending=8):
+        """
+        :param fpath:
+        :type fpath: str
+        :param max_pending: max no. of chunks queued for writing
+        :type max_pending: int
+        """
+        self.fpath = fpath
+        self._file = open(fpath, "w")
+        self._chunks = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_chunks, name="BackgroundWriter({})".format(fpath),
+                                        daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _write_chunks(self):
+        try:
+            while True:
+                chunk = self._chunks.get()
+                if chunk is None:
+                    break
+                self._file.write(chunk)
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._file.close()
+
+    def _put(self, chunk):
+        # the thread may have died on an error and stopped taking chunks
+        while True:
+            try:
+                self._chunks.put(chunk, timeout=1.0)
+                return
+            except queue.Full:
+                if not self._thread.is_alive():
+                    return
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise IOError("Could not write {}".format(self.fpath)) from self._error
+
+    def write(self, chunk):
+        """
+        :param chunk: text appended to the file
+        :type chunk: str
+        """
+        self._raise_error()
+        if chunk:
+            self._put(chunk)
+
+    def close(self):
+        """
+        Waits until every queued chunk is written and closes the file.
+        """
+        if self._thread.is_alive():
+            self._put(None)
+            self._thread.join()
+        self._raise_error()
@@ -5,15 +5,28 @@ import json
 import os
 from warnings import warn
 
+import numpy as np
+
+from autoHDS import cluster_stability
+from autoHDS.BackgroundWriter import BackgroundWriter
+from autoHDS.CompactHierarchy import CompactHierarchy
+from autoHDS.LabelMatrix import LabelMatrix
 from lib import IdentityDict, reverse_dict
 
 
 class ClusterProcessor:
 
+    # no. of points whose labels are expanded to dense columns at a time when writing per point files
+    POINT_BLOCK_SIZE = 4096
+    # no. of (level, point) cells formatted at a time when writing line json files
+    CELL_BLOCK_SIZE = 65536
+
     def __init__(self, sorted_labels, node_map, sort_indices):
         """
-        :param sorted_labels: Label matrix in transposed form (not like plot).
-        :type sorted_labels: np.ndarray
+        :param sorted_labels: Label matrix in transposed form (not like plot),
+                              dense or compact. The combined labels are kept
+                              compact either way.
+        :type sorted_labels: np.ndarray | CompactHierarchy
         :param node_map: dict: original ID -> graphHDS index
         :type node_map: dict[int, int]
         :param sort_indices: The label matrix's columns (corresponding to
@@ -27,8 +40,15 @@ class ClusterProcessor:
                              Everything is 0-indexed.
         :type sort_indices: collections.Sequence[int]
         """
-        self.combined_labels, self.level_map, self.new_levels = self.cluster_label_matrix(
-            self._initial_relabel(sorted_labels)
+        if not isinstance(sorted_labels, CompactHierarchy):
+            sorted_labels = CompactHierarchy.from_dense(sorted_labels)
+
+        # levels are relabeled and combined one at a time so the dense matrix is never built
+        self.level_map = dict()
+        self.new_levels = defaultdict(set)
+        self.hierarchy = CompactHierarchy.from_levels(
+            self._combine_levels(self._relabel_levels(sorted_labels.levels()), self.level_map, self.new_levels),
+            sorted_labels.num_points
         )
 
         # TODO: make idx_to_id the parameter instead of its reverse dict
@@ -39,6 +59,31 @@ class ClusterProcessor:
 
         self.sort_indices = sort_indices
 
+    @property
+    def combined_labels(self):
+        """
+        :return: dense combined label matrix, see cluster_label_matrix
+        :rtype: np.ndarray
+        """
+        return self.hierarchy.to_dense()
+
+    @staticmethod
+    def _relabel_levels(levels):
+        """
+        Relabel levels so different levels don't share cluster IDs.
+        :param levels: label of every point, for every level
+        :type levels: collections.Iterable[np.ndarray]
+        :return: relabeled copy of every level
+        :rtype: collections.Iterator[np.ndarray]
+        """
+        # IDs are given to the sorted distinct labels of every level, the background takes one too
+        next_cluster_id = 1
+        for level in levels:
+            old_cluster_ids, inverse = np.unique(level, return_inverse=True)
+            cluster_ids = np.arange(next_cluster_id, next_cluster_id + len(old_cluster_ids)).astype(level.dtype)
+            next_cluster_id += len(old_cluster_ids)
+            yield np.where(level != 0, cluster_ids[inverse.reshape(level.shape)], level)
+
     @staticmethod
     def _initial_relabel(label_matrix):
         """
@@ -46,17 +91,10 @@ class ClusterProcessor:
         :param label_matrix:
         :return:
         """
-        label_matrix = label_matrix.copy()
-        num_levels, num_points = label_matrix.shape
-        cluster_id_gen = itertools.count(1)
-        for i in range(num_levels):
-            cluster_id_mapping = {old_cluster_id: next(cluster_id_gen)
-                                  for old_cluster_id in sorted(set(label_matrix[i]))}
-            for j in range(num_points):
-                old_cluster_id = label_matrix[i, j]
-                if old_cluster_id:
-                    label_matrix[i, j] = cluster_id_mapping[old_cluster_id]
-        return label_matrix
+        relabeled = label_matrix.copy()
+        for i, level in enumerate(ClusterProcessor._relabel_levels(label_matrix)):
+            relabeled[i] = level
+        return relabeled
 
     def save_clusters_jsonl(self, fpath):
         """
@@ -68,15 +106,7 @@ class ClusterProcessor:
             warn("save_cluster_jsonl fpath should have '.clusters.jsonl' file "
                  "extension; got '{}' instead".format(fpath))
 
-        with open(fpath, "w") as f:
-            for i in self.new_levels:  # iterate over levels
-                for j in range(self.combined_labels.shape[1]):  # iterate over points/nodes
-                    if self.combined_labels[i, j] in self.new_levels[i]:
-                        f.write(json.dumps({
-                            "level": self.level_map[self.combined_labels[i, j]],
-                            "id": self.idx_to_id[self.sort_indices[j]],
-                            "label": int(self.combined_labels[i, j])  # numpy int is not JSON serializable
-                        }) + "\n")
+        self._save_new_clusters_jsonl(fpath, self._json_point_ids())
 
     def save_full_label_matrix_jsonl(self, fpath):
         """
@@ -84,14 +114,101 @@ class ClusterProcessor:
         Node IDs are converted back to the original IDs in graph.jsonl.
         :param fpath: Path to line json.
         """
-        with open(fpath, "w") as f:
-            for i in range(len(self.combined_labels)):  # iterate over levels
-                for j in range(self.combined_labels.shape[1]):  # iterate over points/nodes
-                    f.write(json.dumps({
-                        "level": i,
-                        "id": self.idx_to_id[self.sort_indices[j]],
-                        "label": int(self.combined_labels[i, j])
-                    }) + "\n")
+        point_ids = self._json_point_ids()
+        with BackgroundWriter(fpath) as f:
+            for i, level in enumerate(self.hierarchy.levels()):  # iterate over levels
+                for start in range(0, len(level), ClusterProcessor.CELL_BLOCK_SIZE):
+                    labels = level[start:start + ClusterProcessor.CELL_BLOCK_SIZE].tolist()
+                    f.write(self._format_cells([i] * len(labels), point_ids[start:start + len(labels)], labels))
+
+    def save_full_label_matrix_hierarchy(self, fpath):
+        """
+        Saves the relabeled label matrix as a compact hierarchy .npz (see
+        CompactHierarchy.save) with the original ID of every point, the same
+        data as save_full_label_matrix_jsonl.
+        :param fpath: Path to .npz file.
+        """
+        self.hierarchy.save(fpath, point_ids=self._point_ids())
+
+    def save_full_label_matrix_npy(self, fpath, level_thresholds=None, shave_rate=None, derived_from_shave_rate=None):
+        """
+        Saves the relabeled label matrix as a dense .npy with a JSON sidecar
+        holding the original ID of every point and the level metadata (see
+        LabelMatrix.save), the same data as save_full_label_matrix_jsonl in a
+        file that can be memory-mapped.
+        :param fpath: Path to .npy file.
+        :param level_thresholds: edge similarity threshold of every level
+        :type level_thresholds: collections.Sequence[float] | None
+        :param shave_rate: see LabelMatrix.save
+        :type shave_rate: float | None
+        :param derived_from_shave_rate: see LabelMatrix.save
+        :type derived_from_shave_rate: float | None
+        """
+        LabelMatrix.save(fpath, self.hierarchy, self._point_ids(), level_thresholds=level_thresholds,
+                         shave_rate=shave_rate, derived_from_shave_rate=derived_from_shave_rate)
+
+    def _point_ids(self):
+        """
+        :return: original ID of every point, in the sorted order
+        :rtype: np.ndarray
+        """
+        return np.array([self.idx_to_id[idx] for idx in self.sort_indices], dtype=np.int64)
+
+    def _json_point_ids(self, point_id_mapping=None):
+        """
+        :param point_id_mapping: optional map of the original IDs
+        :type point_id_mapping: collections.Mapping[int, int | str] | None
+        :return: original or mapped ID of every point as JSON, in the sorted
+                 order
+        :rtype: list[str]
+        """
+        if point_id_mapping is None:
+            return [json.dumps(self.idx_to_id[idx]) for idx in self.sort_indices]
+        return [json.dumps(point_id_mapping[self.idx_to_id[idx]]) for idx in self.sort_indices]
+
+    def _mapped_point_ids(self, point_mapping, start, stop):
+        """
+        :param point_mapping:
+        :type point_mapping: collections.Mapping[int, int | str] | None
+        :param start: first point
+        :type start: int
+        :param stop: end of the point range
+        :type stop: int
+        :return: original or mapped ID of the points in [start, stop), as in
+                 graph.dsc
+        :rtype: list[int | str]
+        """
+        original_ids = [self.idx_to_id[self.sort_indices[j]] for j in range(start, stop)]
+        if point_mapping is None:
+            return original_ids
+        return [point_mapping[original_id] for original_id in original_ids]
+
+    @staticmethod
+    def _format_rows(rows):
+        """
+        :param rows: 2D integer array
+        :type rows: np.ndarray
+        :return: one line per row, values separated by spaces
+        :rtype: str
+        """
+        line = " ".join(["%d"] * rows.shape[1]) + "\n"
+        return (line * rows.shape[0]) % tuple(rows.ravel().tolist())
+
+    @staticmethod
+    def _format_cells(levels, point_ids, labels):
+        """
+        :param levels: level of every cell
+        :type levels: list[int]
+        :param point_ids: JSON point ID of every cell
+        :type point_ids: list[str]
+        :param labels: label of every cell
+        :type labels: list[int]
+        :return: one JSON line per cell, same as json.dumps of a dict of
+                 level, id and label
+        :rtype: str
+        """
+        line = '{"level": %d, "id": %s, "label": %d}\n'
+        return (line * len(labels)) % tuple(itertools.chain.from_iterable(zip(levels, point_ids, labels)))
 
     def save_genediver_data(self, output_dir, point_mapping, cluster_labels_file):
         """
@@ -132,43 +249,57 @@ class ClusterProcessor:
                     point_cluster_labels[point_id] = point_label
 
         if len(point_cluster_labels) > 0:
-            with open(gene_diver_cluster_labels_file, "w") as gf:
-                for j in range(self.combined_labels.shape[1]):
-                    graph_hds_original_id = self.idx_to_id[self.sort_indices[j]]
-                    if point_mapping is None:
-                        input_data_original_str_id = graph_hds_original_id
-                    else:
-                        input_data_original_str_id = point_mapping[graph_hds_original_id]
-
-                    if input_data_original_str_id in point_cluster_labels:
-                        gf.write("{},{}\n".format(
-                            input_data_original_str_id,
-                            point_cluster_labels[input_data_original_str_id])
-                        )
-                    else:
-                        gf.write("{},0\n".format(input_data_original_str_id))
-
-        with open(dsc_file, "w") as df, open(hds_file, "w") as hf, open(sorted_idx_file, "w") as sf:
-            for j in range(self.combined_labels.shape[1]):  # iterate over points/nodes
+            with BackgroundWriter(gene_diver_cluster_labels_file) as gf:
+                for start in range(0, self.hierarchy.num_points, ClusterProcessor.POINT_BLOCK_SIZE):
+                    stop = min(start + ClusterProcessor.POINT_BLOCK_SIZE, self.hierarchy.num_points)
+                    gf.write("".join(
+                        "{},{}\n".format(input_data_original_str_id,
+                                         point_cluster_labels.get(input_data_original_str_id, 0))
+                        for input_data_original_str_id in self._mapped_point_ids(point_mapping, start, stop)
+                    ))
+
+        # the files are written by their own threads while the next blocks are formatted
+        with BackgroundWriter(dsc_file) as df, BackgroundWriter(hds_file) as hf, \
+                BackgroundWriter(sorted_idx_file) as sf:
+            for start in range(0, self.hierarchy.num_points, ClusterProcessor.POINT_BLOCK_SIZE):
+                stop = min(start + ClusterProcessor.POINT_BLOCK_SIZE, self.hierarchy.num_points)
 
                 # .hds file has rows of hds levels for each point, these are
                 #     not re-labeled yet
-                hf.write(" ".join(map(str, self.combined_labels[:, j])) + "\n")
+                hf.write(self._format_rows(self.hierarchy.point_block(start, stop).T))
 
                 # idx file has ordering 1,2,3,.... 1 indexed required by gene
                 #     diver and since this data is already sorted the index
                 #     file is just 1,2,3... so really this is a simple trick to
                 #     make .hds index trivial by making it presorted
-                sf.write("{}\n".format(j + 1))
+                sf.write("".join("{}\n".format(j + 1) for j in range(start, stop)))
 
                 # description file contain original string identifiers of each
                 #     point in .hds file in exactly the same order
-                graph_hds_original_id = self.idx_to_id[self.sort_indices[j]]
-                if point_mapping is not None:
-                    input_data_original_str_id = point_mapping[graph_hds_original_id]
-                else:
-                    input_data_original_str_id = graph_hds_original_id
-                df.write("{}\n".format(input_data_original_str_id))
+                df.write("".join("{}\n".format(input_data_original_str_id)
+                                 for input_data_original_str_id in self._mapped_point_ids(point_mapping, start, stop)))
+
+    def save_graph_lab(self, output_dir, point_mapping, runt_size=1, shave_rate=0.05):
+        """
+        Produces graph_lab.csv (HMA clusters by stability) from the hierarchy,
+        as Gene DIVER does when Auto-HDS is run on the files of
+        save_genediver_data.
+        :param output_dir:
+        :type output_dir: str
+        :param point_mapping:
+        :type point_mapping: collections.Mapping[int, int | str] | None
+        :param runt_size: see cluster_stability.hma_levels
+        :type runt_size: int
+        :param shave_rate: shave rate of the hierarchy
+        :type shave_rate: float
+        :return: no. of HMA clusters
+        :rtype: int
+        """
+        # same descriptions as graph.dsc
+        point_descriptions = list(map(str, self._mapped_point_ids(point_mapping, 0, self.hierarchy.num_points)))
+
+        return cluster_stability.save_graph_lab(os.path.join(output_dir, "graph_lab.csv"), self.hierarchy,
+                                                point_descriptions, runt_size, shave_rate)
 
     def save_mapped_clusters_jsonl(self, fpath, point_id_mapping):
         """
@@ -176,15 +307,25 @@ class ClusterProcessor:
         :param fpath: Path to file to save.
         :param point_id_mapping:
         """
-        with open(fpath, "w") as f:
+        self._save_new_clusters_jsonl(fpath, self._json_point_ids(point_id_mapping))
+
+    def _save_new_clusters_jsonl(self, fpath, point_ids):
+        """
+        Saves a line json of the cells (level, point) where a cluster is new,
+        i.e. the points of every cluster at the level it first appears.
+        :param fpath: Path to file to save.
+        :param point_ids: JSON ID of every point, see _json_point_ids
+        :type point_ids: list[str]
+        """
+        with BackgroundWriter(fpath) as f:
             for i in self.new_levels:  # iterate over levels
-                for j in range(len(self.combined_labels[i])):  # iterate over points/nodes
-                    if self.combined_labels[i, j] in self.new_levels[i]:
-                        f.write(json.dumps({
-                            "level": self.level_map[self.combined_labels[i, j]],
-                            "id": point_id_mapping[self.idx_to_id[self.sort_indices[j]]],
-                            "label": int(self.combined_labels[i, j])  # numpy int is not JSON serializable
-                        }) + "\n")
+                level = self.hierarchy.level(i)
+                new_points = np.flatnonzero(np.isin(level, np.fromiter(self.new_levels[i], dtype=np.int64)))
+                for start in range(0, len(new_points), ClusterProcessor.CELL_BLOCK_SIZE):
+                    points = new_points[start:start + ClusterProcessor.CELL_BLOCK_SIZE].tolist()
+                    labels = level[points].tolist()
+                    f.write(self._format_cells([self.level_map[label] for label in labels],
+                                               [point_ids[j] for j in points], labels))
 
     def get_cluster_stabilities(self):
         """
@@ -193,7 +334,7 @@ class ClusterProcessor:
         """
         # TODO: replace with log formula rather than counting levels
         stabilities = defaultdict(int)
-        for level in self.combined_labels:
+        for level in self.hierarchy.levels():
             for cluster in set(level):
                 if cluster == 0:
                     # don't want to calculate 'stability' of the background
@@ -216,6 +357,163 @@ class ClusterProcessor:
                     "stability": stabilities[cluster]
                 }) + "\n")
 
+    @staticmethod
+    def _combine_levels(levels, level_map, new_levels):
+        """
+        Combine multi-level clusters one level at a time, the same as
+        cluster_label_matrix for levels that don't share cluster IDs (see
+        _relabel_levels), without holding more than two levels.
+        :param levels: relabeled levels
+        :type levels: collections.Iterable[np.ndarray]
+        :param level_map: filled with the map from cluster-IDs to the level
+                          used in .clusters file
+        :type level_map: dict
+        :param new_levels: filled with the map from level where clusters
+                           branch to the set of new clusters formed at that
+                           level
+        :type new_levels: collections.defaultdict
+        :return: combined labels of every level
+        :rtype: collections.Iterator[np.ndarray]
+        """
+
+        next_label = 1
+        next_level = 1
+
+        previous_labels = None
+        for i, labels in enumerate(levels):  # iterate over levels
+
+            if i > 0:
+                new, shrunk, shrunk_parents = ClusterProcessor._level_children(previous_labels, labels)
+                # the clusters that only shrink are renamed with their i-1 label
+                labels = ClusterProcessor._replace_labels(labels, shrunk, shrunk_parents)
+            else:
+                new = np.unique(labels)
+
+            previous_labels, next_label, next_level = ClusterProcessor._label_new_clusters(
+                i, labels, new, next_label, next_level, level_map, new_levels)
+            yield previous_labels
+
+    @staticmethod
+    def _level_children(previous_labels, labels):
+        """
+        Finds how the clusters of a level continue the clusters of the level
+        before it. A cluster whose points are split into more than one cluster
+        at the level is parent to new clusters, a cluster whose points are in
+        only one cluster at the level only shrinks into it.
+        :param previous_labels: combined labels of the level before
+        :type previous_labels: np.ndarray
+        :param labels: labels of the level
+        :type labels: np.ndarray
+        :return: new clusters of the level sorted by label, and the clusters
+                 that only shrink with the previous cluster they shrink from,
+                 in the order the previous clusters first appear in (a cluster
+                 shrinking from more than one keeps the first)
+        :rtype: (np.ndarray, np.ndarray, np.ndarray)
+        """
+        dtype = labels.dtype
+        previous_dtype = previous_labels.dtype
+        if len(labels) == 0:
+            return np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype), np.zeros(0, dtype=previous_dtype)
+
+        # pairs are packed in one 64 bit key, labels that may not fit in 32 bits are replaced by their rank
+        previous_ids = ids = None
+        if not (previous_dtype.kind == dtype.kind == "u" and previous_dtype.itemsize <= 4 and dtype.itemsize <= 4):
+            previous_ids, previous_labels = np.unique(previous_labels, return_inverse=True)
+            ids, labels = np.unique(labels, return_inverse=True)
+
+        # distinct (previous cluster, cluster) pairs sorted by previous cluster, with the first point of each
+        pairs, pair_first = np.unique((previous_labels.astype(np.uint64) << np.uint64(32)) | labels.astype(np.uint64),
+                                      return_index=True)
+        pair_previous = (pairs >> np.uint64(32)).astype(np.int64)
+        pair_clusters = (pairs & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        if ids is not None:
+            pair_previous = previous_ids[pair_previous]
+            pair_clusters = ids[pair_clusters]
+
+        # first point of every previous cluster, the order clusters are renamed in
+        previous_starts = np.flatnonzero(np.append(True, pair_previous[1:] != pair_previous[:-1]))
+        previous_sizes = np.diff(np.append(previous_starts, len(pairs)))
+        pair_previous_first = np.repeat(np.minimum.reduceat(pair_first, previous_starts), previous_sizes)
+
+        # skip the background of the level, pairs stay grouped by previous cluster
+        clustered = pair_clusters != 0
+        pair_previous = pair_previous[clustered]
+        pair_clusters = pair_clusters[clustered]
+        pair_previous_first = pair_previous_first[clustered]
+
+        # first pair of the previous cluster of every pair
+        previous_group = np.searchsorted(pair_previous, pair_previous)
+        num_children = np.bincount(previous_group, minlength=len(pair_previous))[previous_group]
+        new = np.unique(pair_clusters[num_children > 1])
+
+        only_child = num_children == 1
+        shrunk_previous = pair_previous[only_child]
+        shrunk = pair_clusters[only_child]
+        shrunk_previous_first = pair_previous_first[only_child]
+        order = np.lexsort((shrunk_previous_first, shrunk))
+        _, first = np.unique(shrunk[order], return_index=True)
+        kept = order[first]
+        kept = kept[np.argsort(shrunk_previous_first[kept], kind="stable")]
+
+        if ids is not None:
+            dtype = ids.dtype
+            previous_dtype = previous_ids.dtype
+        return new.astype(dtype), shrunk[kept].astype(dtype), shrunk_previous[kept].astype(previous_dtype)
+
+    @staticmethod
+    def _replace_labels(labels, old_labels, new_labels):
+        """
+        :param labels:
+        :type labels: np.ndarray
+        :param old_labels: unique labels to replace
+        :type old_labels: np.ndarray
+        :param new_labels: replacement of every old label
+        :type new_labels: np.ndarray
+        :return: copy of labels with every old label replaced
+        :rtype: np.ndarray
+        """
+        labels = labels.copy()
+        if len(old_labels) == 0:
+            return labels
+        sorter = np.argsort(old_labels)
+        pos = np.minimum(np.searchsorted(old_labels, labels, sorter=sorter), len(old_labels) - 1)
+        found = old_labels[sorter[pos]] == labels
+        labels[found] = np.asarray(new_labels)[sorter[pos[found]]]
+        return labels
+
+    @staticmethod
+    def _label_new_clusters(i, labels, new, next_label, next_level, level_map, new_levels):
+        """
+        Gives the new clusters of a level the next unique cluster IDs.
+        :param i: level index
+        :type i: int
+        :param labels: labels of the level, new clusters not renamed yet
+        :type labels: np.ndarray
+        :param new: new clusters of the level, sorted
+        :type new: np.ndarray
+        :param next_label: next unique cluster ID
+        :type next_label: int
+        :param next_level: next level used in .clusters file
+        :type next_level: int
+        :param level_map: see _combine_levels
+        :type level_map: dict
+        :param new_levels: see _combine_levels
+        :type new_levels: collections.defaultdict
+        :return: labels with the new clusters renamed, next_label and
+                 next_level after the level
+        :rtype: (np.ndarray, int, int)
+        """
+        if len(new) == 0:
+            return labels, next_label, next_level
+
+        new_labels = list(range(next_label, next_label + len(new)))
+        new_levels[i].update(new_labels)
+        for new_label in new_labels:
+            level_map[new_label] = next_level
+
+        labels = ClusterProcessor._replace_labels(labels, new, np.array(new_labels).astype(labels.dtype))
+        return labels, next_label + len(new), next_level + 1
+
     @staticmethod
     def cluster_label_matrix(labels):
         """
@@ -236,12 +534,16 @@ class ClusterProcessor:
 
         num_levels, num_points = labels.shape
 
-        # Generators for unique IDs.
-        new_labels_counter = itertools.count(1)
-        new_level_counter = itertools.count(1)
+        # unique IDs
+        next_label = 1
+        next_level = 1
 
-        # map: (cluster-ID) -> (set of points in the cluster)
-        cluster_points = defaultdict(set)
+        # (cluster-ID, point) of the points of every cluster at the levels so
+        #     far, dropped once the cluster is renamed. Levels can share
+        #     cluster-IDs here, so these can be points of earlier levels.
+        #     The background is never renamed and left out.
+        cluster_point_labels = np.zeros(0, dtype=labels.dtype)
+        cluster_points = np.zeros(0, dtype=np.int64)
 
         # map: (cluster-ID) -> (level used in .clusters file)
         level_map = dict()
@@ -252,46 +554,28 @@ class ClusterProcessor:
         for i in range(num_levels):  # iterate over levels
 
             if i > 0:
-
-                # map: (cluster-ID) -> (set of cluster-IDs from the next
-                #                       level that include the same
-                #                       nodes/points)
-                cluster_map = defaultdict(set)
-
-                for j in range(num_points):  # iterate over points/nodes
-                    cluster_map[labels[i - 1, j]].add(labels[i, j])
-                    cluster_points[labels[i, j]].add(j)
-                new = list()
-                for old_cluster in cluster_map:
-                    new_clusters = [c for c in cluster_map[old_cluster]
-                                    if c != 0]
-                    if len(new_clusters) > 1:
-                        new.extend(new_clusters)
-                    elif len(new_clusters) == 1:
-                        # the cluster only shrinks; doesn't split
-                        # rename column i cluster with i-1 label
-                        for j in cluster_points[new_clusters[0]]:
-                            labels[i, j] = old_cluster
-                        del cluster_points[new_clusters[0]]
+                new, shrunk, shrunk_parents = ClusterProcessor._level_children(labels[i - 1], labels[i])
+
+                clustered = np.flatnonzero(labels[i])
+                cluster_point_labels = np.concatenate((cluster_point_labels, labels[i, clustered]))
+                cluster_points = np.concatenate((cluster_points, clustered))
+
+                # the clusters that only shrink are renamed with their i-1
+                #     label in order, a point of several gets the last one
+                renamed = np.isin(cluster_point_labels, shrunk)
+                if renamed.any():
+                    rename_order = ClusterProcessor._replace_labels(
+                        cluster_point_labels[renamed], shrunk, np.arange(len(shrunk))).astype(np.int64)
+                    renamed_points = cluster_points[renamed]
+                    order = np.lexsort((rename_order, renamed_points))
+                    last = np.append(renamed_points[order][1:] != renamed_points[order][:-1], True)
+                    labels[i, renamed_points[order][last]] = shrunk_parents[rename_order[order][last]]
+                    cluster_point_labels = cluster_point_labels[~renamed]
+                    cluster_points = cluster_points[~renamed]
             else:
-                new = labels[i]
-            new = sorted(set(new))
-
-            # map: (old cluster-ID) -> (new cluster-ID)
-            label_map = dict()
-
-            for old_label in new:
-                new_label = next(new_labels_counter)
-                label_map[old_label] = new_label
-                new_levels[i].add(new_label)
-
-            if new:
-                new_level = next(new_level_counter)
-                for j in range(num_points):
-                    old_label = labels[i, j]
-                    if old_label in label_map:
-                        labels[i, j] = label_map[old_label]
-                for cluster_id in new:
-                    level_map[label_map[cluster_id]] = new_level
+                new = np.unique(labels[i])
+
+            labels[i], next_label, next_level = ClusterProcessor._label_new_clusters(
+                i, labels[i], new, next_label, next_level, level_map, new_levels)
 
         return labels, level_map, new_levels
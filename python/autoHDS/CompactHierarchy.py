@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+import numpy as np
+
+
+class CompactHierarchy:
+    """
+    HMA label matrix (levels x points, level 0 the coarsest, the last level
+    the densest) stored as the label transitions of every point instead of a
+    dense matrix.
+
+    The labels of a point are piecewise constant over the levels, so only the
+    levels where they change are stored. A transition (point, level, label)
+    means the point has that label at that level and at every coarser level
+    up to its previous transition, i.e. the label of a point at a level is the
+    label of its first transition at that level or a denser one, and 0
+    (background) if there is none. Memory is O(transitions) instead of
+    O(levels x points).
+
+    Transitions are stored as one sorted key per transition, point * levels +
+    level, and the label of each key.
+    """
+
+    def __init__(self, num_points, num_levels, keys, labels):
+        """
+        :param num_points:
+        :type num_points: int
+        :param num_levels:
+        :type num_levels: int
+        :param keys: point * num_levels + level of every transition, sorted
+        :type keys: np.ndarray
+        :param labels: label of every transition
+        :type labels: np.ndarray
+        """
+        self.num_points = num_points
+        self.num_levels = num_levels
+        self.keys = np.asarray(keys, dtype=np.int64)
+        self.labels = np.asarray(labels)
+
+        if len(self.keys) != len(self.labels):
+            raise ValueError("keys and labels must have the same length")
+
+    @classmethod
+    def from_deltas(cls, num_points, deltas, dtype=np.uint32):
+        """
+        :param num_points:
+        :type num_points: int
+        :param deltas: (points, labels) of every level from the densest to the
+                       coarsest, the points whose label differs from the next
+                       denser level (all clustered points for the densest
+                       level) and their labels
+        :type deltas: list[(np.ndarray, np.ndarray)]
+        :param dtype: label dtype
+        :rtype: CompactHierarchy
+        """
+        return cls.from_delta_stream(num_points, len(deltas), sum(len(points) for points, _ in deltas), deltas,
+                                     dtype=dtype)
+
+    @classmethod
+    def from_delta_stream(cls, num_points, num_levels, num_transitions, deltas, dtype=np.uint32):
+        """
+        Same as from_deltas for deltas that are read one at a time, eg. from a
+        file. Only the transition arrays are allocated, once.
+        :param num_points:
+        :type num_points: int
+        :param num_levels: no. of deltas
+        :type num_levels: int
+        :param num_transitions: total no. of points of all deltas
+        :type num_transitions: int
+        :param deltas: see from_deltas
+        :type deltas: collections.Iterable[(np.ndarray, np.ndarray)]
+        :param dtype: label dtype
+        :rtype: CompactHierarchy
+        """
+        keys = np.empty(num_transitions, dtype=np.int64)
+        labels = np.empty(num_transitions, dtype=dtype)
+
+        num_deltas = 0
+        start = 0
+        for delta_idx, (points, delta_labels) in enumerate(deltas):
+            end = start + len(points)
+            if end > num_transitions or delta_idx >= num_levels:
+                raise ValueError("more deltas than the {} levels and {} transitions passed".format(
+                    num_levels, num_transitions))
+            keys[start:end] = np.asarray(points, dtype=np.int64) * num_levels + (num_levels - 1 - delta_idx)
+            labels[start:end] = delta_labels
+            start = end
+            num_deltas += 1
+
+        if num_deltas != num_levels or start != num_transitions:
+            raise ValueError("expected {} levels and {} transitions, got {} and {}".format(
+                num_levels, num_transitions, num_deltas, start))
+
+        order = np.argsort(keys, kind="stable")
+        return cls(num_points, num_levels, keys[order], labels[order])
+
+    @classmethod
+    def from_levels(cls, levels, num_points):
+        """
+        :param levels: labels of every level from the coarsest to the densest,
+                       eg. the rows of a label matrix
+        :type levels: collections.Iterable[np.ndarray]
+        :param num_points:
+        :type num_points: int
+        :rtype: CompactHierarchy
+        """
+        deltas = list()
+        dtype = np.uint32
+        previous = None
+        for labels in levels:
+            dtype = labels.dtype
+            if previous is not None:
+                changed = np.flatnonzero(previous != labels)
+                deltas.append((changed, previous[changed]))
+            previous = labels
+        if previous is not None:
+            clustered = np.flatnonzero(previous)
+            deltas.append((clustered, previous[clustered]))
+
+        deltas.reverse()
+        return cls.from_deltas(num_points, deltas, dtype=dtype)
+
+    @classmethod
+    def from_dense(cls, label_matrix):
+        """
+        :param label_matrix: levels x points
+        :type label_matrix: np.ndarray
+        :rtype: CompactHierarchy
+        """
+        return cls.from_levels(iter(label_matrix), label_matrix.shape[1])
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        :param fpath: .npz saved by save
+        :type fpath: str
+        :return: the hierarchy, and the point IDs if they were saved
+        :rtype: (CompactHierarchy, np.ndarray | None)
+        """
+        with np.load(fpath) as data:
+            hierarchy = cls(int(data["num_points"]), int(data["num_levels"]), data["keys"], data["labels"])
+            point_ids = data["point_ids"] if "point_ids" in data else None
+        return hierarchy, point_ids
+
+    def save(self, fpath, point_ids=None):
+        """
+        :param fpath: .npz file
+        :type fpath: str
+        :param point_ids: optional ID of every point, eg. original node IDs
+        :type point_ids: np.ndarray | None
+        """
+        arrays = dict(num_points=self.num_points, num_levels=self.num_levels, keys=self.keys, labels=self.labels)
+        if point_ids is not None:
+            arrays["point_ids"] = np.asarray(point_ids)
+        np.savez_compressed(fpath, **arrays)
+
+    @property
+    def shape(self):
+        return self.num_levels, self.num_points
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.labels.nbytes
+
+    def __len__(self):
+        return self.num_levels
+
+    def __iter__(self):
+        return self.levels()
+
+    def level(self, level):
+        """
+        :param level: level index, 0 is the coarsest
+        :type level: int
+        :return: label of every point at the level
+        :rtype: np.ndarray
+        """
+        if not 0 <= level < self.num_levels:
+            raise IndexError("level {} out of range for {} levels".format(level, self.num_levels))
+
+        point_starts = np.arange(self.num_points, dtype=np.int64) * self.num_levels
+        pos = np.searchsorted(self.keys, point_starts + level)
+        labels = np.zeros(self.num_points, dtype=self.labels.dtype)
+        # the first transition at the level or denser must still be the point's own
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] < point_starts[found] + self.num_levels
+        labels[found] = self.labels[pos[found]]
+        return labels
+
+    def levels(self):
+        """
+        :return: labels of every level from the coarsest to the densest
+        :rtype: collections.Iterator[np.ndarray]
+        """
+        for level in range(self.num_levels):
+            yield self.level(level)
+
+    def point_block(self, start, stop):
+        """
+        :param start: first point
+        :type start: int
+        :param stop: end of the point range
+        :type stop: int
+        :return: dense labels of the points in [start, stop), levels x points
+        :rtype: np.ndarray
+        """
+        num_block_points = stop - start
+        block = np.zeros((self.num_levels, num_block_points), dtype=self.labels.dtype)
+        if self.num_levels == 0 or num_block_points <= 0:
+            return block
+
+        first, last = np.searchsorted(self.keys, [start * self.num_levels, stop * self.num_levels])
+        keys = self.keys[first:last]
+        points = keys // self.num_levels - start
+        levels = keys % self.num_levels
+
+        # transition index at its level, filled upwards to the coarser levels
+        transitions = np.full((self.num_levels + 1, num_block_points), len(keys), dtype=np.int64)
+        transitions[levels, points] = np.arange(len(keys))
+        transitions = np.minimum.accumulate(transitions[::-1], axis=0)[::-1][:-1]
+
+        found = transitions < len(keys)
+        block[found] = self.labels[first:last][transitions[found]]
+        return block
+
+    def to_dense(self):
+        """
+        :return: levels x points label matrix
+        :rtype: np.ndarray
+        """
+        return self.point_block(0, self.num_points)
+
+    def remap_points(self, point_ids, num_points=None):
+        """
+        :param point_ids: new point ID of every point, unique
+        :type point_ids: np.ndarray
+        :param num_points: no. of points of the new hierarchy, defaults to the
+                           current no.
+        :type num_points: int | None
+        :return: the hierarchy with every point moved to its new ID
+        :rtype: CompactHierarchy
+        """
+        if num_points is None:
+            num_points = self.num_points
+        if self.num_levels == 0:
+            return CompactHierarchy(num_points, 0, self.keys, self.labels)
+
+        point_ids = np.asarray(point_ids, dtype=np.int64)
+        keys = point_ids[self.keys // self.num_levels] * self.num_levels + self.keys % self.num_levels
+        order = np.argsort(keys, kind="stable")
+        return CompactHierarchy(num_points, self.num_levels, keys[order], self.labels[order])
+
+    def take_points(self, points):
+        """
+        :param points: old point of every new point, points can repeat, eg. to
+                       project the hierarchy of a coarsened graph onto the
+                       nodes of the finer graph
+        :type points: np.ndarray
+        :return: the hierarchy of the points (columns) taken, like
+                 label_matrix[:, points]
+        :rtype: CompactHierarchy
+        """
+        points = np.asarray(points, dtype=np.int64)
+        if self.num_levels == 0:
+            return CompactHierarchy(len(points), 0, self.keys, self.labels)
+
+        # new points grouped by their old point
+        new_points = np.argsort(points, kind="stable")
+        num_copies = np.bincount(points, minlength=self.num_points)
+        copy_starts = np.cumsum(num_copies) - num_copies
+
+        # every transition is copied to each new point of its old point
+        transition_points = self.keys // self.num_levels
+        transition_copies = num_copies[transition_points]
+        transitions = np.repeat(np.arange(len(self.keys)), transition_copies)
+        copy_idx = np.arange(len(transitions)) - np.repeat(np.cumsum(transition_copies) - transition_copies,
+                                                           transition_copies)
+        keys = (new_points[copy_starts[transition_points[transitions]] + copy_idx] * self.num_levels +
+                self.keys[transitions] % self.num_levels)
+
+        order = np.argsort(keys, kind="stable")
+        return CompactHierarchy(len(points), self.num_levels, keys[order], self.labels[transitions[order]])
+
+    def lexsort_order(self):
+        """
+        The order of np.lexsort(label_matrix[::-1]), i.e. points sorted by
+        their labels from the coarsest to the densest level, ties by point,
+        Gene DIVER's tree order. Computed from the transitions as a depth
+        first traversal of the tree of label runs, so memory is
+        O(points + transitions) and no level is ever expanded.
+
+        The labels of a point are a sequence of runs (label, last level), and
+        two points sharing their runs so far first differ where one's run ends
+        before the other's: the point whose next label is lower (or 0 after
+        its last run) sorts first. So sorting by the runs, each keyed by its
+        label and then by its last level ascending if the next label is lower
+        and descending if it is higher, is the same order. The runs of all
+        points form a tree, siblings sorted by key, and every point comes
+        after the points whose runs end at an ancestor of its last run and
+        before those continuing in a child.
+        :return: old point of every position
+        :rtype: np.ndarray
+        """
+        num_levels = self.num_levels
+        if num_levels == 0 or len(self.keys) == 0:
+            return np.arange(self.num_points, dtype=np.int64)
+
+        points = self.keys // num_levels
+        levels = self.keys % num_levels
+        labels = self.labels.astype(np.int64)
+
+        # runs: drop transitions with the same label as the point's next one, and trailing background ones
+        same_point_next = _equals_next(points)
+        keep = ~(same_point_next & _equals_next(labels))
+        points, levels, labels = points[keep], levels[keep], labels[keep]
+        same_point_next = _equals_next(points)
+        keep = same_point_next | (labels != 0)
+        points, levels, labels = points[keep], levels[keep], labels[keep]
+        same_point_next = _equals_next(points)
+
+        next_labels = np.where(same_point_next, np.append(labels[1:], 0), 0)
+        run_keys = labels * (2 * num_levels) + np.where(next_labels < labels, levels, 2 * num_levels - 1 - levels)
+
+        # depth of every run in its point's sequence
+        point_starts = np.flatnonzero(~np.append(False, same_point_next[:-1]))
+        depths = np.arange(len(points)) - np.repeat(point_starts, np.diff(np.append(point_starts, len(points))))
+
+        # tree nodes of the runs, 0 the root, numbered by depth then parent then key so siblings are contiguous and
+        #     in order
+        run_nodes = np.zeros(len(points), dtype=np.int64)
+        node_parents = [np.zeros(1, dtype=np.int64)]
+        num_nodes = 1
+        runs_by_depth = np.argsort(depths, kind="stable")
+        depth_bounds = np.searchsorted(depths[runs_by_depth], np.arange(depths.max() + 2))
+        for depth in range(len(depth_bounds) - 1):
+            runs = runs_by_depth[depth_bounds[depth]:depth_bounds[depth + 1]]
+            parents = run_nodes[runs - 1] if depth else np.zeros(len(runs), dtype=np.int64)
+            order = np.lexsort((run_keys[runs], parents))
+            runs, parents = runs[order], parents[order]
+            new_node = np.append(True, (parents[1:] != parents[:-1]) | (run_keys[runs[1:]] != run_keys[runs[:-1]]))
+            node_ids = num_nodes - 1 + np.cumsum(new_node)
+            run_nodes[runs] = node_ids
+            node_parents.append(parents[new_node])
+            num_nodes += int(np.count_nonzero(new_node))
+
+        # deepest run of every point
+        point_nodes = np.zeros(self.num_points, dtype=np.int64)
+        last_runs = np.flatnonzero(~same_point_next)
+        point_nodes[points[last_runs]] = run_nodes[last_runs]
+
+        # points and subtree sizes
+        own_sizes = np.bincount(point_nodes, minlength=num_nodes)
+        sizes = own_sizes.copy()
+        depth_starts = np.cumsum([0] + [len(parents) for parents in node_parents])
+        for depth in reversed(range(1, len(node_parents))):
+            nodes = np.arange(depth_starts[depth], depth_starts[depth + 1])
+            sizes += np.bincount(node_parents[depth], weights=sizes[nodes], minlength=num_nodes).astype(np.int64)
+
+        # first position of every subtree: after its parent's own points and its previous siblings' subtrees
+        starts = np.zeros(num_nodes, dtype=np.int64)
+        for depth in range(1, len(node_parents)):
+            nodes = np.arange(depth_starts[depth], depth_starts[depth + 1])
+            parents = node_parents[depth]
+            before = np.cumsum(sizes[nodes]) - sizes[nodes]
+            sibling_starts = np.flatnonzero(np.append(True, parents[1:] != parents[:-1]))
+            before -= np.repeat(before[sibling_starts], np.diff(np.append(sibling_starts, len(nodes))))
+            starts[nodes] = starts[parents] + own_sizes[parents] + before
+
+        # the own points of a node by point
+        order = np.argsort(point_nodes, kind="stable")
+        node_firsts = np.cumsum(own_sizes) - own_sizes
+        positions = starts[point_nodes[order]] + np.arange(self.num_points) - node_firsts[point_nodes[order]]
+        lexsort_order = np.empty(self.num_points, dtype=np.int64)
+        lexsort_order[positions] = order
+        return lexsort_order
+
+
+def _equals_next(values):
+    """
+    :param values:
+    :type values: np.ndarray
+    :return: True where a value equals the next one, False for the last
+    :rtype: np.ndarray
+    """
+    return np.append(values[1:] == values[:-1], False)[:len(values)]
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import json
+import math
+import os
+
+import numpy as np
+
+
+class LabelMatrix:
+    """
+    HMA label matrix (levels x points, level 0 the coarsest) saved as a .npy
+    file with a JSON sidecar holding the ID of every point (column) and the
+    level metadata.
+
+    Loading memory-maps the .npy file, so levels are read from disk as they
+    are used instead of parsing and copying the whole matrix. Points can be
+    remapped to other point IDs, eg. the node IDs of a measurement, in which
+    case every level is scattered to the new IDs when it is read.
+    """
+
+    def __init__(self, matrix, metadata, point_positions=None, num_points=None):
+        """
+        :param matrix: levels x points labels, eg. a read only memmap
+        :type matrix: np.ndarray
+        :param metadata: sidecar contents, see save
+        :type metadata: dict
+        :param point_positions: new point of every column, None to keep the
+                                columns
+        :type point_positions: np.ndarray | None
+        :param num_points: no. of points after remapping, defaults to the no.
+                           of columns
+        :type num_points: int | None
+        """
+        self.matrix = matrix
+        self.metadata = metadata
+        self.point_positions = point_positions
+        self.num_points = matrix.shape[1] if num_points is None else num_points
+
+    @staticmethod
+    def sidecar_path(fpath):
+        """
+        :param fpath: .npy file
+        :type fpath: str
+        :return: JSON sidecar of the .npy file
+        :rtype: str
+        """
+        return os.path.splitext(fpath)[0] + ".json"
+
+    @staticmethod
+    def save(fpath, hierarchy, point_ids, level_thresholds=None, shave_rate=None, derived_from_shave_rate=None):
+        """
+        Writes the matrix one level at a time, so the dense matrix is never
+        held in memory. Labels take the smallest unsigned dtype they fit.
+        :param fpath: .npy file, the sidecar is written next to it
+        :type fpath: str
+        :param hierarchy:
+        :type hierarchy: autoHDS.CompactHierarchy.CompactHierarchy
+        :param point_ids: ID of every point, eg. original node IDs
+        :type point_ids: np.ndarray
+        :param level_thresholds: edge similarity threshold of every level, nan
+                                 for none
+        :type level_thresholds: collections.Sequence[float] | None
+        :param shave_rate: shave rate of the hierarchy
+        :type shave_rate: float | None
+        :param derived_from_shave_rate: finer shave rate the hierarchy was
+                                        derived from by taking its nearest
+                                        levels, an approximation of a run at
+                                        shave_rate, None if it was shaved at
+                                        shave_rate
+        :type derived_from_shave_rate: float | None
+        """
+        max_label = int(hierarchy.labels.max()) if len(hierarchy.labels) else 0
+        dtype = np.promote_types(np.min_scalar_type(max_label), np.uint8)
+        shape = (hierarchy.num_levels, hierarchy.num_points)
+
+        if hierarchy.num_levels * hierarchy.num_points == 0:
+            # an empty file can not be memory-mapped
+            np.save(fpath, np.zeros(shape, dtype=dtype))
+            level_num_clustered = [0] * hierarchy.num_levels
+        else:
+            level_num_clustered = list()
+            matrix = np.lib.format.open_memmap(fpath, mode="w+", dtype=dtype, shape=shape)
+            for level_idx, level in enumerate(hierarchy.levels()):
+                matrix[level_idx] = level
+                level_num_clustered.append(int(np.count_nonzero(level)))
+            matrix.flush()
+            del matrix
+
+        if level_thresholds is not None:
+            # nan is not valid JSON
+            level_thresholds = [None if math.isnan(threshold) else float(threshold) for threshold in level_thresholds]
+        with open(LabelMatrix.sidecar_path(fpath), "w") as f:
+            json.dump({
+                "num_levels": hierarchy.num_levels,
+                "num_points": hierarchy.num_points,
+                "dtype": dtype.name,
+                "point_ids": np.asarray(point_ids).tolist(),
+                "level_thresholds": level_thresholds,
+                "level_num_clustered": level_num_clustered,
+                "shave_rate": shave_rate,
+                "derived_from_shave_rate": derived_from_shave_rate
+            }, f)
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        :param fpath: .npy saved by save
+        :type fpath: str
+        :return: the label matrix, memory-mapped read only
+        :rtype: LabelMatrix
+        """
+        with open(cls.sidecar_path(fpath)) as f:
+            metadata = json.load(f)
+        matrix = np.load(fpath, mmap_mode="r")
+        if matrix.shape != (metadata["num_levels"], metadata["num_points"]):
+            raise ValueError("{} has shape {}, its sidecar expects ({}, {})".format(
+                fpath, matrix.shape, metadata["num_levels"], metadata["num_points"]))
+        return cls(matrix, metadata)
+
+    @property
+    def point_ids(self):
+        """
+        :return: ID of every column
+        :rtype: np.ndarray
+        """
+        return np.array(self.metadata["point_ids"])
+
+    @property
+    def num_levels(self):
+        return self.matrix.shape[0]
+
+    @property
+    def shape(self):
+        return self.num_levels, self.num_points
+
+    def __len__(self):
+        return self.num_levels
+
+    def __iter__(self):
+        return self.levels()
+
+    def level(self, level):
+        """
+        :param level: level index, 0 is the coarsest
+        :type level: int
+        :return: label of every point at the level, a view of the file unless
+                 the points are remapped
+        :rtype: np.ndarray
+        """
+        if not 0 <= level < self.num_levels:
+            raise IndexError("level {} out of range for {} levels".format(level, self.num_levels))
+
+        if self.point_positions is None:
+            return self.matrix[level]
+        labels = np.zeros(self.num_points, dtype=self.matrix.dtype)
+        labels[self.point_positions] = self.matrix[level]
+        return labels
+
+    def levels(self):
+        """
+        :return: labels of every level from the coarsest to the densest
+        :rtype: collections.Iterator[np.ndarray]
+        """
+        for level in range(self.num_levels):
+            yield self.level(level)
+
+    def remap_points(self, point_ids, num_points=None):
+        """
+        :param point_ids: new point ID of every column, unique
+        :type point_ids: np.ndarray
+        :param num_points: no. of points after remapping, defaults to the
+                           current no.
+        :type num_points: int | None
+        :return: the same matrix with its columns moved to the new point IDs
+        :rtype: LabelMatrix
+        """
+        point_ids = np.asarray(point_ids, dtype=np.int64)
+        if self.point_positions is not None:
+            point_ids = point_ids[self.point_positions]
+        return LabelMatrix(self.matrix, self.metadata, point_ids, self.num_points if num_points is None else num_points)
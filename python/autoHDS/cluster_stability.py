@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+HMA clusters, their stabilities and the graph_lab.csv cluster label file,
+computed from an HDS hierarchy the same way as Gene DIVER does when
+Auto-HDS is run on graph data (Diver.computeAutoHDS,
+computeClusterStabilityAndRanks and saveAutoHDSClusters), so the file can be
+produced without the Gene DIVER GUI and without writing and parsing the .hds
+text files.
+
+The hierarchy holds the HDS labels of every level, level 0 the least dense,
+i.e. the columns of graph.hds (see ClusterProcessor.save_genediver_data).
+Going down the levels, the points of an HMA cluster keep its label in the
+next level unless its points split into more than one sub-cluster larger
+than the runt size, which then become new HMA clusters based at that level.
+The stability of a cluster is the log of the fraction of points dense at its
+peak level (the last level at which some base point is still in it without
+having left) over the fraction dense at the level before its base level, in
+units of a 0.99 shaving step, so it does not depend on the shave rate of the
+hierarchy.
+
+Where Gene DIVER iterates java.util.HashMaps of cluster labels, new clusters
+are numbered in the same iteration order (see _java_hash_order), so cluster
+IDs match those of Gene DIVER.
+"""
+import decimal
+import math
+
+import numpy as np
+
+# shave rate stabilities are measured in
+REFERENCE_SHAVE_RATE = 0.01
+
+
+def dense_sizes(hierarchy):
+    """
+    :param hierarchy:
+    :type hierarchy: CompactHierarchy
+    :return: no. of dense (non background) points of every level, Gene
+             DIVER's denseSizeList
+    :rtype: np.ndarray
+    """
+    return np.array([np.count_nonzero(level) for level in hierarchy.levels()], dtype=np.int64)
+
+
+def _table_size_for(capacity):
+    """
+    :return: table size of a java.util.HashMap created with capacity
+    :rtype: int
+    """
+    table_size = 1
+    while table_size < capacity:
+        table_size *= 2
+    return table_size
+
+
+def _java_hash_order(keys, initial_capacity):
+    """
+    Iteration order of a java.util.HashMap(initial_capacity) with Integer
+    keys put in the given order: by bucket of the final table, then by
+    insertion. Bins of more than 8 colliding keys in tables of 64 or more
+    buckets are trees in Java and may iterate differently.
+    :param keys: distinct non negative keys in insertion order
+    :type keys: np.ndarray
+    :param initial_capacity:
+    :type initial_capacity: int
+    :return: indices of keys in iteration order
+    :rtype: np.ndarray
+    """
+    table_size = _table_size_for(initial_capacity)
+    # the table doubles once it holds more than 0.75 of its size
+    while len(keys) > int(table_size * 0.75):
+        table_size *= 2
+
+    hashes = np.asarray(keys, dtype=np.int64) & 0xFFFFFFFF
+    buckets = (hashes ^ (hashes >> 16)) & (table_size - 1)
+    return np.argsort(buckets, kind="stable")
+
+
+def _next_hma_level(hma_labels, hds_labels, runt_size, num_hma_clusters, base_levels, level):
+    """
+    Splits the HMA clusters of a level by the HDS clusters of the next level.
+    :param hma_labels: HMA labels of the level
+    :type hma_labels: np.ndarray
+    :param hds_labels: HDS labels of the next level
+    :type hds_labels: np.ndarray
+    :param runt_size: sub-clusters of at most this many points are runts
+    :type runt_size: int
+    :param num_hma_clusters: no. of HMA clusters so far
+    :type num_hma_clusters: int
+    :param base_levels: base level of every HMA cluster, new clusters are
+                        appended
+    :type base_levels: list[int]
+    :param level: index of the next level
+    :type level: int
+    :return: HMA labels of the next level, no. of HMA clusters
+    :rtype: (np.ndarray, int)
+    """
+    next_hma_labels = np.zeros(len(hma_labels), dtype=np.int64)
+    dense = np.flatnonzero(hma_labels)
+    if len(dense) == 0:
+        return next_hma_labels, num_hma_clusters
+
+    # distinct (cluster, next level cluster) pairs sorted by cluster, with their sizes and first points
+    pairs, pair_first, pair_inverse, pair_sizes = np.unique(
+        (hma_labels[dense].astype(np.int64) << 32) | hds_labels[dense],
+        return_index=True, return_inverse=True, return_counts=True
+    )
+    pair_clusters = pairs >> 32
+    pair_children = pairs & 0xFFFFFFFF
+    cluster_starts = np.flatnonzero(np.append(True, pair_clusters[1:] != pair_clusters[:-1]))
+    cluster_ends = np.append(cluster_starts[1:], len(pairs))
+    pair_cluster_idx = np.repeat(np.arange(len(cluster_starts)), cluster_ends - cluster_starts)
+
+    sub_clusters = pair_children != 0
+    non_runts = sub_clusters & (pair_sizes > runt_size)
+    num_sub_clusters = np.add.reduceat(sub_clusters.astype(np.int64), cluster_starts)
+    num_non_runts = np.add.reduceat(non_runts.astype(np.int64), cluster_starts)
+    splits = (num_sub_clusters > 1) & (num_non_runts > 1)
+
+    # clusters that do not split keep their label for their sub-cluster, or their non runt sub-cluster if any
+    pair_labels = np.where(np.where(num_sub_clusters[pair_cluster_idx] > 1, non_runts, sub_clusters)
+                           & ~splits[pair_cluster_idx], pair_clusters, 0)
+
+    # each non runt sub-cluster of a splitting cluster is a new HMA cluster, in the order of the cluster and
+    #     sub-cluster histograms
+    cluster_first = np.minimum.reduceat(pair_first, cluster_starts)
+    clusters_in_order = np.argsort(cluster_first, kind="stable")
+    cluster_order = clusters_in_order[_java_hash_order(pair_clusters[cluster_starts[clusters_in_order]],
+                                                       len(cluster_starts))]
+    for cluster_idx in cluster_order[splits[cluster_order]].tolist():
+        start, end = cluster_starts[cluster_idx], cluster_ends[cluster_idx]
+        children_in_order = np.argsort(pair_first[start:end], kind="stable")
+        child_order = start + children_in_order[_java_hash_order(pair_children[start:end][children_in_order],
+                                                                 end - start)]
+        new_clusters = child_order[non_runts[child_order]]
+        pair_labels[new_clusters] = np.arange(num_hma_clusters + 1, num_hma_clusters + 1 + len(new_clusters))
+        num_hma_clusters += len(new_clusters)
+        base_levels.extend([level] * len(new_clusters))
+
+    next_hma_labels[dense] = pair_labels[pair_inverse.reshape(-1)]
+    return next_hma_labels, num_hma_clusters
+
+
+def hma_levels(hierarchy, runt_size=1, base_levels=None):
+    """
+    :param hierarchy: HDS labels
+    :type hierarchy: CompactHierarchy
+    :param runt_size: sub-clusters of at most this many points are runts
+                      that do not split a cluster
+    :type runt_size: int
+    :param base_levels: if passed, filled with the base level of every HMA
+                        cluster (cluster i + 1 is based at base_levels[i])
+    :type base_levels: list[int] | None
+    :return: HMA labels of every level
+    :rtype: collections.Iterator[np.ndarray]
+    """
+    if base_levels is None:
+        base_levels = list()
+
+    hma_labels = None
+    num_hma_clusters = 0
+    num_clusters = 0
+    # until clusters first split, a single cluster is labeled 1
+    no_breakup = True
+    for level, hds_labels in enumerate(hierarchy.levels()):
+        hds_labels = hds_labels.astype(np.int64)
+        previous_num_clusters = num_clusters
+        num_clusters = len(np.unique(hds_labels[hds_labels != 0]))
+
+        if level == 0:
+            hma_labels = hds_labels
+            num_hma_clusters = num_clusters
+            base_levels.extend([0] * num_clusters)
+        elif previous_num_clusters == 1 and num_clusters == 1 and no_breakup:
+            hma_labels = np.where((hma_labels > 0) & (hds_labels > 0), 1, 0)
+        elif np.any(hma_labels):
+            no_breakup = False
+            hma_labels, num_hma_clusters = _next_hma_level(hma_labels, hds_labels, runt_size, num_hma_clusters,
+                                                           base_levels, level)
+        yield hma_labels
+
+
+def hma_clusters(hierarchy, runt_size=1):
+    """
+    :param hierarchy: HDS labels
+    :type hierarchy: CompactHierarchy
+    :param runt_size: see hma_levels
+    :type runt_size: int
+    :return: base level, peak level and points at the base level of every
+             HMA cluster (cluster i + 1 at index i)
+    :rtype: (np.ndarray, np.ndarray, list[np.ndarray])
+    """
+    base_levels = list()
+    members = list()
+    # HMA clusters still holding base points at every level
+    level_runs = list()
+
+    # label of the HMA cluster every point has had since its base level, 0 once it left it
+    run_labels = np.zeros(hierarchy.num_points, dtype=np.int64)
+    for hma_labels in hma_levels(hierarchy, runt_size, base_levels):
+        in_run = np.flatnonzero(run_labels)
+        stayed = hma_labels[in_run] == run_labels[in_run]
+        run_labels[in_run[~stayed]] = 0
+
+        # clusters based at this level, labels are numbered in base level order
+        first_label, last_label = len(members) + 1, len(base_levels)
+        if first_label <= last_label:
+            points = np.flatnonzero((hma_labels >= first_label) & (hma_labels <= last_label))
+            points = points[np.argsort(hma_labels[points], kind="stable")]
+            boundaries = np.searchsorted(hma_labels[points], np.arange(first_label, last_label), side="right")
+            members.extend(np.split(points, boundaries))
+            run_labels[points] = hma_labels[points]
+
+        level_runs.append(np.unique(run_labels[run_labels > 0]))
+
+    # the peak level of a cluster is the last level it held base points at
+    peak_levels = np.array(base_levels, dtype=np.int64)
+    for level, labels in enumerate(level_runs):
+        peak_levels[labels - 1] = level
+
+    return np.array(base_levels, dtype=np.int64), peak_levels, members
+
+
+def cluster_stabilities(base_levels, peak_levels, level_dense_sizes, num_points, shave_rate):
+    """
+    :param base_levels: base level of every HMA cluster
+    :type base_levels: np.ndarray
+    :param peak_levels: peak level of every HMA cluster
+    :type peak_levels: np.ndarray
+    :param level_dense_sizes: see dense_sizes
+    :type level_dense_sizes: np.ndarray
+    :param num_points:
+    :type num_points: int
+    :param shave_rate: shave rate of the hierarchy, only used for clusters
+                       based at level 0 whose level before is a virtual level
+                       one shaving step less dense
+    :type shave_rate: float
+    :return: stability of every HMA cluster
+    :rtype: np.ndarray
+    """
+    base_fractions = np.where(
+        base_levels > 0,
+        level_dense_sizes[np.maximum(base_levels - 1, 0)] / num_points,
+        level_dense_sizes[base_levels] / num_points / (1.0 - shave_rate)
+    )
+    peak_fractions = level_dense_sizes[peak_levels] / num_points
+    return (np.log(peak_fractions) - np.log(base_fractions)) / math.log(1.0 - REFERENCE_SHAVE_RATE)
+
+
+def stability_rank_order(stabilities):
+    """
+    :param stabilities:
+    :type stabilities: np.ndarray
+    :return: clusters by decreasing stability, ties in the same order as
+             Gene DIVER's HeapSort.idxSort
+    :rtype: list[int]
+    """
+    values = stabilities.tolist()
+    order = list(range(len(values)))
+    if not order:
+        return order
+
+    def down_heap(k, n):
+        top = order[k - 1]
+        while k <= n // 2:
+            j = k + k
+            if j < n and values[order[j - 1]] > values[order[j]]:
+                j += 1
+            if values[top] <= values[order[j - 1]]:
+                break
+            order[k - 1] = order[j - 1]
+            k = j
+        order[k - 1] = top
+
+    n = len(order)
+    for k in range(n // 2, 0, -1):
+        down_heap(k, n)
+    while True:
+        order[0], order[n - 1] = order[n - 1], order[0]
+        n -= 1
+        down_heap(1, n)
+        if n <= 1:
+            break
+    return order
+
+
+def _java_double_string(value):
+    """
+    :return: value formatted like Java's Double.toString
+    :rtype: str
+    """
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "Infinity" if value > 0 else "-Infinity"
+    if value == 0 or 1e-3 <= abs(value) < 1e7:
+        return repr(float(value))
+
+    # shortest digits that round trip, as repr, in scientific notation
+    sign, digits, exponent = decimal.Decimal(repr(float(value))).normalize().as_tuple()
+    digits = "".join(map(str, digits))
+    return "{}{}.{}E{}".format("-" if sign else "", digits[0], digits[1:] or "0", len(digits) - 1 + exponent)
+
+
+def save_graph_lab(fpath, hierarchy, point_descriptions, runt_size=1, shave_rate=0.05):
+    """
+    Saves the HMA clusters of a hierarchy by decreasing stability as Gene
+    DIVER's graph_lab.csv: one line of cluster ID, stability, 1 indexed point
+    index and point description per point of every cluster at its base level.
+    :param fpath:
+    :type fpath: str
+    :param hierarchy: HDS labels, points in the order of graph.hds
+    :type hierarchy: CompactHierarchy
+    :param point_descriptions: description of every point, as in graph.dsc
+                               (an optional URL follows the first ":")
+    :type point_descriptions: list[str]
+    :param runt_size: see hma_levels
+    :type runt_size: int
+    :param shave_rate: see cluster_stabilities
+    :type shave_rate: float
+    :return: no. of HMA clusters
+    :rtype: int
+    """
+    base_levels, peak_levels, members = hma_clusters(hierarchy, runt_size)
+    stabilities = cluster_stabilities(base_levels, peak_levels, dense_sizes(hierarchy), hierarchy.num_points,
+                                      shave_rate)
+
+    # descriptions without URLs are padded to the same length, like Gene DIVER's point descriptions
+    descriptions = list()
+    urls = list()
+    for description in point_descriptions:
+        description, separator, url = str(description).partition(":")
+        descriptions.append(description)
+        urls.append(url if separator else None)
+    max_length = max(map(len, descriptions), default=0)
+
+    with open(fpath, "w") as f:
+        f.write("clusterId, stability, ptIdx,ptDescription\n")
+        for cluster_idx in stability_rank_order(stabilities):
+            prefix = "{},{},".format(cluster_idx + 1, _java_double_string(stabilities[cluster_idx]))
+            for point in members[cluster_idx].tolist():
+                if urls[point] is None:
+                    description = descriptions[point].ljust(max_length)
+                else:
+                    description = descriptions[point].strip() + ":" + urls[point]
+                f.write("{}{},{}\n".format(prefix, point + 1, description))
+
+    return len(base_levels)
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 from collections import defaultdict
-import json, os, copy
+import os
 from timeit import default_timer
 
+import numpy as np
+
+from graphHDS.graph_loader import dedupe_edges, read_connections_graph
+
 
 class NativeReadWrite:
 
@@ -47,110 +51,67 @@ class NativeReadWrite:
 
         return num_nodes
 
-    def count_graph(self, jaccard_threshold):
+    def _read_thresholded_connections(self, jaccard_threshold, num_workers):
+        """
+        Reads the graph line JSON keeping connections with weight >=
+        jaccard_threshold.
+        :return: line node IDs, number of kept connections of each line, kept
+                 connection node IDs, kept connection weights, number of
+                 unique undirected edges kept (self edges ignored)
+        :rtype: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, int)
+        """
+        line_ids, connection_counts, connection_ids, connection_weights = read_connections_graph(
+            os.path.join(self.staging_dir, self.experiment_name + ".jsonl"),
+            num_workers=num_workers
+        )
+        connection_lines = np.repeat(np.arange(len(line_ids)), connection_counts)
 
-        num_nodes = 0
-        unique_edges = set()
-        start_time = default_timer()
-        last_time = start_time
+        kept = connection_weights >= jaccard_threshold
+        connection_lines = connection_lines[kept]
+        connection_ids = connection_ids[kept]
+        connection_weights = connection_weights[kept]
 
-        with open(os.path.join(self.staging_dir, self.experiment_name + ".jsonl")) as graph_file:
-            for i, line in enumerate(map(str.strip, graph_file), 1):
+        unique_src, _, _, _ = dedupe_edges(line_ids[connection_lines], connection_ids, connection_weights)
 
-                if i % 1000 == 0:
-                    now = default_timer()
-                    print("\tReading data for adjacency matrix row {:,} "
-                          "({:.2f} s cumulative) (Δcumulative={:.3f} s)"
-                        .format(
-                        i,
-                        now - start_time,
-                        now - last_time
-                    ))
-                    last_time = default_timer()
+        kept_counts = np.bincount(connection_lines, minlength=len(line_ids))
+        return line_ids, kept_counts, connection_ids, connection_weights, len(unique_src)
 
-                    # format {"connections": [[1, 0.5], [1241, 0.5151515151515151]], "id": 0}
-                node_information = json.loads(line)
-                node_id_1 = node_information["id"]
-                for node_id_2, weight in node_information["connections"]:
-                    if weight >= jaccard_threshold:
-                        if node_id_1 < node_id_2:
-                            edge_id = str(node_id_1) + "." + str(node_id_2)
-                        elif node_id_2 < node_id_1:
-                            edge_id = str(node_id_2) + "." + str(node_id_1)
-                        else:
-                            # self edge ignored
-                            continue
-                        if edge_id not in unique_edges:
-                            unique_edges.add(edge_id)
-
-                num_nodes += 1  # each line represents a node
-
-        return num_nodes, len(unique_edges)
-
-    def read_graph(self, jaccard_threshold):
+    def count_graph(self, jaccard_threshold, num_workers=None):
+
+        line_ids, _, _, _, num_unique_edges = self._read_thresholded_connections(jaccard_threshold, num_workers)
+
+        # each line represents a node
+        return len(line_ids), num_unique_edges
+
+    def read_graph(self, jaccard_threshold, num_workers=None):
         """
         Read graph from graph line JSON.
         :return: input_graph: dict: (node1, node2) -> weight
                  num_nodes: number of nodes
         :rtype: (list[dict[str, Any]], int, int)
         """
-        input_graph = list()
-        num_nodes = 0
-
-        start_time = default_timer()
-        last_time = start_time
-
-        unique_edges = set()
-
-        with open(os.path.join(self.staging_dir, self.experiment_name + ".jsonl")) as graph_file:
-            for i, line in enumerate(map(str.strip, graph_file), 1):
-
-                if len(line.strip()) == 0:
-                    # ignore empty line
-                    continue
-
-                if i % 1000 == 0:
-                    now = default_timer()
-                    print("\tReading data for adjacency matrix row {:,} "
-                          "({:.2f} s cumulative) (Δcumulative={:.3f} s)"
-                        .format(
-                        i,
-                        now - start_time,
-                        now - last_time
-                    ))
-                    last_time = default_timer()
-
-                    # format {"connections": [[1, 0.5], [1241, 0.5151515151515151]], "id": 0}
+        line_ids, kept_counts, connection_ids, connection_weights, num_unique_edges = \
+            self._read_thresholded_connections(jaccard_threshold, num_workers)
 
-                node_information = json.loads(line)
-                node_id_1 = node_information["id"]
-                pruned_connections = list()
-
-                for node_id_2, weight in node_information["connections"]:
-                    if weight >= jaccard_threshold:
-                        pruned_connections.append((node_id_2, weight))
-
-                        if node_id_1 < node_id_2:
-                            edge_id = str(node_id_1) + "." + str(node_id_2)
-                        elif node_id_2 < node_id_1:
-                            edge_id = str(node_id_2) + "." + str(node_id_1)
-                        else:
-                            # self edge ignored
-                            continue
-                        if edge_id not in unique_edges:
-                            unique_edges.add(edge_id)
-
-                num_nodes += 1  # each line represents a node
-
-                if len(pruned_connections) == 0:
-                    continue
-
-                input_graph.append({
-                    "id": node_id_1,
-                    "connections": pruned_connections
-                })
+        input_graph = list()
 
-        return input_graph, num_nodes, len(unique_edges)
+        # format {"connections": [[1, 0.5], [1241, 0.5151515151515151]], "id": 0}
+        connection_ids = connection_ids.tolist()
+        connection_weights = connection_weights.tolist()
+        offset = 0
+        for node_id_1, count in zip(line_ids.tolist(), kept_counts.tolist()):
+            if count == 0:
+                continue
+
+            input_graph.append({
+                "id": node_id_1,
+                "connections": list(zip(connection_ids[offset:offset + count],
+                                        connection_weights[offset:offset + count]))
+            })
+            offset += count
+
+        # each line represents a node
+        return input_graph, len(line_ids), num_unique_edges
 
     def read_mapping(self):
         """
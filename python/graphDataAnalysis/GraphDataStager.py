@@ -8,9 +8,12 @@ from random import Random
 from timeit import default_timer
 from urllib.parse import quote_plus
 
+import numpy as np
+
 from dataReadWrite.ReadWriteAll import ALGORITHMS
 from graphDataAnalysis.GraphDataStagerException import GraphDataStagerException
 from graphDataAnalysis.GraphLabels import GraphLabels
+from graphHDS.graph_loader import connection_sources, dedupe_edges, read_connections_graph
 from lib import comb, IntToStrDict, reverse_dict
 
 ALGO_NAMES = set(ALGORITHMS.keys()) | {"autohds-g"}  # set for nice repr
@@ -257,46 +260,33 @@ class GraphDataStager:
         :return:
         """
 
+        # the graph is read once, both passes below work on the parsed arrays
+        line_ids, connection_counts, connection_ids, connection_weights = read_connections_graph(
+            os.path.join(self.input_data_dir, "graph.jsonl")
+        )
+
         # pass 1 get graph nodes
-        all_nodes = set()
-        with open(os.path.join(self.input_data_dir, "graph.jsonl")) as f:
-            for line in f:
-                node_id = json.loads(line)["id"]
-                all_nodes.add(node_id)
+        all_nodes = set(line_ids.tolist())
 
         self._sample_nodes(all_nodes)
 
-        edges_processed = set()
         self.graph.clear()
         self.graph_nodes.clear()
 
-        # pass 2 load the graph filter to sampled nodes
-        with open(os.path.join(self.input_data_dir, "graph.jsonl")) as f:
-            for line in f:
-                line_dict = json.loads(line)
-                node_id1 = line_dict["id"]
-
-                if node_id1 not in self.all_sample_nodes:
-                    continue
+        # pass 2 filter the graph to sampled nodes
+        sample_nodes = np.fromiter(self.all_sample_nodes, dtype=np.int64, count=len(self.all_sample_nodes))
+        connection_src = connection_sources(line_ids, connection_counts)
+        sampled = np.isin(connection_src, sample_nodes) & np.isin(connection_ids, sample_nodes)
 
-                for node_id2, weight in line_dict["connections"]:
-                    if node_id2 not in self.all_sample_nodes:
-                        continue
-
-                    if node_id1 not in self.graph_nodes:
-                        self.graph_nodes.add(node_id1)
-                    if node_id2 not in self.graph_nodes:
-                        self.graph_nodes.add(node_id2)
-
-                    if node_id1 > node_id2:
-                        edge_id = (node_id2, node_id1)
-                    else:
-                        edge_id = (node_id1, node_id2)
+        edge_src, edge_dst, edge_weights, _ = dedupe_edges(
+            connection_src[sampled], connection_ids[sampled], connection_weights[sampled], drop_self_loops=False
+        )
+        edge_src = edge_src.tolist()
+        edge_dst = edge_dst.tolist()
 
-                    if edge_id in edges_processed:
-                        continue
-                    edges_processed.add(edge_id)
-                    self.graph[edge_id] = weight
+        self.graph_nodes.update(edge_src)
+        self.graph_nodes.update(edge_dst)
+        self.graph.update(zip(zip(edge_src, edge_dst), edge_weights.tolist()))
 
     def _load_sim2_labels(self):
         labels = dict()  # node ID -> cluster ID
@@ -8,6 +8,8 @@ from timeit import default_timer
 import numpy as np
 
 from analysis.ClusterDeduper import ClusterDeduper
+from autoHDS.CompactHierarchy import CompactHierarchy
+from autoHDS.LabelMatrix import LabelMatrix
 from dataReadWrite.ReadWriteAll import ALGORITHMS
 from graphDataAnalysis.GraphLabels import GraphLabels
 from graphDataAnalysis.GraphMeasurementsException import GraphMeasurementsException
@@ -91,7 +93,8 @@ class GraphMeasurements:
         # set in the loader
         self.num_all_nodes = None  # int: number of vertices in original graph
 
-        self.autohdsg_label_matrix = None  # numpy array of shape (number of shave levels, number of nodes)
+        # numpy array, CompactHierarchy or LabelMatrix of shape (number of shave levels, number of nodes)
+        self.autohdsg_label_matrix = None
         self.density_sorted_clusters = None  # dict: cluster id -> density sorted cluster (tuple of node id)
 
         # used only for stability sorted measurements
@@ -201,40 +204,68 @@ class GraphMeasurements:
                 self.clustering = defaultdict(list)
                 self.clustering_ridx = dict()
 
-                label_matrix_dict = defaultdict(dict)
-                max_level = -1
-
-                # full_label_matrix.jsonl has no additional node ID mapping. The
-                #     IDs are converted back to the same IDs as graph.jsonl. And
-                #     since no ID mapping is done for autohds-g in the staging
-                #     step, no node ID conversion is necessary.
-                with open(os.path.join(self.algorithm_dir, "graph", "full_label_matrix.jsonl")) as f:
-                    for line in f:
-
-                        line_dict = json.loads(line)
-                        level = line_dict["level"]
-                        node_id = line_dict["id"]
-                        cluster_label = line_dict["label"]
-
-                        if level > max_level:
-                            max_level = level
-
+                graph_output_dir = os.path.join(self.algorithm_dir, "graph")
+                label_matrix_file = os.path.join(graph_output_dir, "full_label_matrix.npy")
+                hierarchy_file = os.path.join(graph_output_dir, "full_label_matrix.hierarchy.npz")
+                if os.path.isfile(label_matrix_file) or os.path.isfile(hierarchy_file):
+
+                    # label matrix saved next to full_label_matrix.jsonl with
+                    #     the same IDs, only the point IDs are converted. The
+                    #     .npy is memory-mapped, levels are read as they are
+                    #     measured.
+                    if os.path.isfile(label_matrix_file):
+                        label_matrix = LabelMatrix.load(label_matrix_file)
+                        point_ids = label_matrix.point_ids
+                    else:
+                        label_matrix, point_ids = CompactHierarchy.load(hierarchy_file)
+                    node_ids = list()
+                    for node_id in point_ids.tolist():
                         if stage_graph_for_autohds_run:
-                            # GDA and autohds-g have different integer IDs if
-                            #     stage_graph_for_autohds.py was run. This converts
-                            #     the autohds-g IDs back to GDA IDs.
                             node_id = gda_id_mapping[stage_graph_for_autohds_mapping[node_id]]
+                        node_ids.append(self.contiguity_mapping[node_id])
+                    self.autohdsg_label_matrix = label_matrix.remap_points(np.array(node_ids, dtype=np.int64),
+                                                                           self.num_all_nodes)
 
-                        node_id = self.contiguity_mapping[node_id]
-
-                        label_matrix_dict[level][node_id] = cluster_label
+                else:
 
-                # 0s in the label matrix indicate background
-                label_matrix = np.zeros((max_level + 1, self.num_all_nodes), dtype=np.uint8)
-                for level, level_dict in label_matrix_dict.items():
-                    for node_id, cluster_label in level_dict.items():
-                        label_matrix[level, node_id] = cluster_label
-                self.autohdsg_label_matrix = label_matrix
+                    label_matrix_dict = defaultdict(dict)
+                    max_level = -1
+                    max_label = 0
+
+                    # full_label_matrix.jsonl has no additional node ID mapping. The
+                    #     IDs are converted back to the same IDs as graph.jsonl. And
+                    #     since no ID mapping is done for autohds-g in the staging
+                    #     step, no node ID conversion is necessary.
+                    with open(os.path.join(graph_output_dir, "full_label_matrix.jsonl")) as f:
+                        for line in f:
+
+                            line_dict = json.loads(line)
+                            level = line_dict["level"]
+                            node_id = line_dict["id"]
+                            cluster_label = line_dict["label"]
+
+                            if level > max_level:
+                                max_level = level
+                            if cluster_label > max_label:
+                                max_label = cluster_label
+
+                            if stage_graph_for_autohds_run:
+                                # GDA and autohds-g have different integer IDs if
+                                #     stage_graph_for_autohds.py was run. This converts
+                                #     the autohds-g IDs back to GDA IDs.
+                                node_id = gda_id_mapping[stage_graph_for_autohds_mapping[node_id]]
+
+                            node_id = self.contiguity_mapping[node_id]
+
+                            label_matrix_dict[level][node_id] = cluster_label
+
+                    # 0s in the label matrix indicate background
+                    label_matrix = np.zeros((max_level + 1, self.num_all_nodes),
+                                            dtype=np.promote_types(np.min_scalar_type(max_label), np.uint8))
+                    for level, level_dict in label_matrix_dict.items():
+                        for node_id, cluster_label in level_dict.items():
+                            label_matrix[level, node_id] = cluster_label
+                    self.autohdsg_label_matrix = label_matrix
 
             else:  # stability sorted measurements
 
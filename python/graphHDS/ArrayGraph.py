@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import numpy as np
+
+
+class ArrayGraph:
+    """
+    Undirected weighted graph stored in contiguous NumPy arrays.
+
+    Nodes are addressed by contiguous 0-indexed internal IDs. The internal ID
+    of a node is its position in the sorted array of external node IDs, eg.
+    external IDs 2 995 34 map to 2->0, 34->1, 995->2. External IDs should only
+    be needed at the edges of the API (loading and saving).
+
+    Edges are stored once (edge_src < edge_dst) in edge order. The adjacency is
+    additionally stored in CSR form (indptr/indices/weights) with both
+    directions of every edge. Within a row the entries are ordered by edge
+    index, so if edges are added to a graph in edge order, the neighbors of a
+    node that have been added so far are always a prefix of its CSR row.
+
+    If weight_sorted is set the edges are in order of decreasing weight
+    (stable on input order), so eg. the edges of any weight threshold are a
+    prefix of the edge arrays.
+    """
+
+    def __init__(self, node_ids, edge_src, edge_dst, edge_weights, csr=None, weight_sorted=False):
+        """
+        :param node_ids: Sorted unique external node IDs. Position in this
+                         array is the internal node ID.
+        :type node_ids: np.ndarray
+        :param edge_src: Internal ID of the lower node of each edge.
+        :type edge_src: np.ndarray
+        :param edge_dst: Internal ID of the higher node of each edge.
+        :type edge_dst: np.ndarray
+        :param edge_weights: Similarity weight of each edge.
+        :type edge_weights: np.ndarray
+        :param csr: Prebuilt (indptr, indices, weights, edge_idx) of these
+                    edges, eg. from a graph cache. Built if not passed.
+        :type csr: (np.ndarray, np.ndarray, np.ndarray, np.ndarray) | None
+        :param weight_sorted: True if the edges are sorted by decreasing
+                              weight.
+        :type weight_sorted: bool
+        """
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.edge_src = np.asarray(edge_src, dtype=np.int64)
+        self.edge_dst = np.asarray(edge_dst, dtype=np.int64)
+        self.edge_weights = np.asarray(edge_weights, dtype=np.float64)
+
+        if not (len(self.edge_src) == len(self.edge_dst) == len(self.edge_weights)):
+            raise ValueError("edge arrays must all have the same length")
+
+        self.weight_sorted = weight_sorted
+
+        # CSR adjacency, filled in by _build_csr
+        self.indptr = None  # row offsets into indices, length num_nodes + 1
+        self.indices = None  # neighbor internal node ID of each entry
+        self.weights = None  # edge weight of each entry
+        self.edge_idx = None  # edge index of each entry
+        if csr is None:
+            self._build_csr()
+        else:
+            self.indptr, self.indices, self.weights, self.edge_idx = csr
+
+    @classmethod
+    def from_external_edges(cls, node_ids, src, dst, weights):
+        """
+        Builds the graph from edges given in external node IDs. Edges must
+        already be deduped and must not contain self loops.
+        :param node_ids: All external node IDs of the graph (any order).
+        :type node_ids: collections.Iterable[int] | np.ndarray
+        :param src: External ID of first node of each edge.
+        :param dst: External ID of second node of each edge.
+        :param weights: Weight of each edge.
+        :rtype: ArrayGraph
+        """
+        node_ids = np.unique(np.asarray(node_ids, dtype=np.int64))
+        src = np.searchsorted(node_ids, np.asarray(src, dtype=np.int64))
+        dst = np.searchsorted(node_ids, np.asarray(dst, dtype=np.int64))
+        return cls(node_ids, np.minimum(src, dst), np.maximum(src, dst), weights)
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_weights)
+
+    def _build_csr(self):
+        num_edges = self.num_edges
+        rows = np.concatenate((self.edge_src, self.edge_dst))
+        cols = np.concatenate((self.edge_dst, self.edge_src))
+        edge_idx = np.tile(np.arange(num_edges, dtype=np.int64), 2)
+
+        # order entries by row, then by edge index within a row
+        order = np.lexsort((edge_idx, rows))
+
+        self.indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=self.num_nodes), out=self.indptr[1:])
+        self.indices = cols[order]
+        self.edge_idx = edge_idx[order]
+        self.weights = self.edge_weights[self.edge_idx]
+
+    def permute_edges(self, order):
+        """
+        Reorders the edges (eg. by decreasing weight) and rebuilds the CSR
+        adjacency so rows stay ordered by the new edge index.
+        :param order: Permutation of edge indices; new edge i is old edge
+                      order[i].
+        :type order: np.ndarray
+        """
+        self.edge_src = self.edge_src[order]
+        self.edge_dst = self.edge_dst[order]
+        self.edge_weights = self.edge_weights[order]
+        self.weight_sorted = False
+        self._build_csr()
+
+    def sort_by_weight(self):
+        """
+        Reorders the edges by decreasing weight, keeping the current order of
+        equal weight edges.
+        """
+        if not self.weight_sorted:
+            self.permute_edges(np.argsort(-self.edge_weights, kind="stable"))
+            self.weight_sorted = True
+
+    def row_prefixes(self, nodes, lengths):
+        """
+        Gathers the first lengths[i] CSR entries of the row of every node in
+        nodes, eg. the nbrs added so far during shaving.
+        :param nodes: internal node IDs
+        :type nodes: np.ndarray
+        :param lengths: number of entries to take from each row
+        :type lengths: np.ndarray
+        :return: position in nodes of each entry, nbr node ID of each entry,
+                 weight of each entry
+        :rtype: (np.ndarray, np.ndarray, np.ndarray)
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        entry_rows = np.repeat(np.arange(len(nodes)), lengths)
+
+        # position of each entry inside its own row prefix
+        row_offsets = np.cumsum(lengths) - lengths
+        entry_positions = np.arange(len(entry_rows)) - row_offsets[entry_rows] + self.indptr[nodes][entry_rows]
+
+        return entry_rows, self.indices[entry_positions], self.weights[entry_positions]
+
+    def degrees(self):
+        """
+        :return: Number of edges incident to each node.
+        :rtype: np.ndarray
+        """
+        return np.diff(self.indptr)
+
+    def to_internal(self, external_ids):
+        """
+        Maps external node IDs to internal node IDs.
+        :param external_ids:
+        :type external_ids: np.ndarray | collections.Sequence[int]
+        :rtype: np.ndarray
+        """
+        external_ids = np.asarray(external_ids, dtype=np.int64)
+        internal_ids = np.searchsorted(self.node_ids, external_ids)
+        internal_ids[internal_ids == self.num_nodes] = 0
+        if not np.array_equal(self.node_ids[internal_ids], external_ids):
+            raise KeyError("unknown external node IDs passed")
+        return internal_ids
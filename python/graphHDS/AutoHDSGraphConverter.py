@@ -2,6 +2,7 @@
 import json, os, re
 
 from graphHDS.GraphHDSV2 import GraphHDSException
+from graphHDS.graph_loader import read_edge_lines
 
 
 class AutoHDSGraphConverter:
@@ -71,38 +72,23 @@ class AutoHDSGraphConverter:
                         self.min_raw_weight = node_weight
                     self.node_weights[node_id] = node_weight
 
-    def load_generated_graph(self, sim_threshold):
+    def load_generated_graph(self, sim_threshold, num_workers=None):
         """
         :param sim_threshold:
+        :param num_workers: number of processes parsing the graph file,
+                            defaults to the CPU count
         """
 
         unique_nodes = 0
 
         line_number = 0
         print("Reading graph from {}".format(self._input_graph_path))
-        with open(self._input_graph_path, "r") as i:
-            try:
-                for edge_line in i:
-                    edge_line = re.sub(r'[^\x00-\x7F]+', ' ', edge_line)
-                    # do not check in, only for debugging
-                    #if unique_nodes > 400:
-                    #    break
-                    line_number += 1
-                    edge = json.loads(edge_line)
-                    if line_number % 100000 == 0:
-                        print("Read {} lines...".format(line_number))
-                    try:
-                        node1 = edge["id1"].encode("ascii", "ignore")
-                        node2 = edge["id2"].encode("ascii", "ignore")
-                        sim = edge["sim"]
-
-                    except KeyError:
-                        raise GraphHDSException("One or more of required edge keys not found: id1, id2, sim "
-                                                "in line: {} at line no. {}".format(edge_line, line_number))
-
-                    # Exclude undesired edges
-                    if sim < sim_threshold:
-                        continue
+        try:
+            edge_chunks = read_edge_lines(self._input_graph_path, sim_threshold, num_workers=num_workers)
+            for num_lines, nodes1, nodes2, sims in edge_chunks:
+                line_number += num_lines
+
+                for node1, node2, sim in zip(nodes1, nodes2, sims):
 
                     # Add missing entries to mapping dictionary
                     if node1 not in self.map_dict:
@@ -126,9 +112,8 @@ class AutoHDSGraphConverter:
                         self.hdsg_dict[node2_map_int_string] = [[node1_map_int_string, sim]]
                     else:
                         self.hdsg_dict[node2_map_int_string].append([node1_map_int_string, sim])
-            # todo handle encoding errors
-            except UnicodeDecodeError as e:
-                print("Skipping line could not handle encode")
+        except ValueError as e:
+            raise GraphHDSException(str(e)) from e
         print("Found {} unique nodes from {} lines with sim threshold of {}\n".format(unique_nodes, line_number,
                                                                                       sim_threshold))
 
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import numpy as np
+
+
+class DisjointSet:
+    """
+    Disjoint-set forest (union-find) over the elements 0..n-1, using union by
+    rank and path compression.
+
+    Sets can only ever be merged, which is what happens to graph HDS clusters
+    as edges and dense nodes are added while shaving goes down the levels, so
+    one DisjointSet can be kept for the whole shaving run.
+    """
+
+    def __init__(self, num_elements):
+        """
+        :param num_elements: number of elements, all starting as singletons
+        :type num_elements: int
+        """
+        self.parent = np.arange(num_elements, dtype=np.int64)
+        self.rank = np.zeros(num_elements, dtype=np.uint8)
+        # size of the set, only valid for root elements
+        self.size = np.ones(num_elements, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def find(self, element):
+        """
+        :param element:
+        :type element: int
+        :return: root element of the set containing element
+        :rtype: int
+        """
+        parent = self.parent
+
+        root = element
+        while parent[root] != root:
+            root = parent[root]
+
+        # path compression
+        while parent[element] != root:
+            parent[element], element = root, parent[element]
+
+        return int(root)
+
+    def union(self, element_a, element_b):
+        """
+        Merges the sets containing the two elements.
+        :param element_a:
+        :type element_a: int
+        :param element_b:
+        :type element_b: int
+        :return: True if two different sets were merged
+        :rtype: bool
+        """
+        root_a = self.find(element_a)
+        root_b = self.find(element_b)
+        if root_a == root_b:
+            return False
+
+        # union by rank, attach the shallower tree under the deeper one
+        if self.rank[root_a] < self.rank[root_b]:
+            root_a, root_b = root_b, root_a
+        elif self.rank[root_a] == self.rank[root_b]:
+            self.rank[root_a] += 1
+
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        return True
+
+    def union_pairs(self, elements_a, elements_b):
+        """
+        Merges the sets of every (elements_a[i], elements_b[i]) pair.
+        :param elements_a:
+        :type elements_a: np.ndarray | collections.Sequence[int]
+        :param elements_b:
+        :type elements_b: np.ndarray | collections.Sequence[int]
+        :return: number of merges done
+        :rtype: int
+        """
+        if isinstance(elements_a, np.ndarray):
+            elements_a = elements_a.tolist()
+        if isinstance(elements_b, np.ndarray):
+            elements_b = elements_b.tolist()
+
+        num_merges = 0
+        for element_a, element_b in zip(elements_a, elements_b):
+            if self.union(element_a, element_b):
+                num_merges += 1
+        return num_merges
+
+    def roots(self):
+        """
+        Fully compresses every path (vectorized pointer jumping).
+        :return: root element of every element
+        :rtype: np.ndarray
+        """
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        self.parent = parent
+        return parent
+
+    def labels(self, min_size=2):
+        """
+        Cluster labels of all elements taken from the sets. The label of an
+        element in a set of at least min_size elements is its root + 1, other
+        elements get the background label 0.
+        :param min_size:
+        :type min_size: int
+        :rtype: np.ndarray
+        """
+        roots = self.roots()
+        labels = (roots + 1).astype(np.uint32)
+        labels[self.size[roots] < min_size] = 0
+        return labels
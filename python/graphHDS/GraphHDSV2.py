@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
-import json, math, operator, os
-from collections import defaultdict
+import contextlib, copy, heapq, itertools, json, math, os, queue, traceback
+from multiprocessing import Array, Pool, Process, Queue
 from random import Random
 from timeit import default_timer
 
 import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 from autoHDS.ClusterProcessor import ClusterProcessor
-from lib import reverse_dict
+from graphHDS import graph_cache, multilevel, sparsify
+from graphHDS.ArrayGraph import ArrayGraph
+from graphHDS.graph_loader import dedupe_edges, load_array_graph
+from graphHDS.PairFlowStore import PairFlowStore
+from graphHDS.ShavingState import ShavingState
 
 
 class GraphHDSException(Exception):
@@ -59,73 +65,124 @@ class GraphHDSV2:
        edge : Prunes low flow edges before clustering
        node : Prunes low total flow nodes. Then connects all dense nodes with
               flows between them. This is fully analogous to spatial autoHDS.
+    10. Multilevel mode (hds_multilevel) for very large graphs: coarsens by
+        heavy edge matching, shaves the coarse graph, projects back and
+        refines boundary nodes.
+    11. No pre-produced graph needed (load_similarity_graph): edges can be
+        computed on the fly by a similarity provider and candidate pair
+        generator in decreasing similarity order, only as far as shaving
+        reaches (see graphHDS.similarity).
+    12. Incremental updates (update): a run saved with save_update_state can
+        be updated with a delta graph of new nodes and edges, only the
+        connected components the delta touches are shaved again.
 
     TODO: Ability to stop at certain max shaving level (this should work with
     TODO:     Gene DIVER)
-    TODO: Add plug-in graph sim function hook with caching to remove need for a
-    TODO:     pre-produced graph. This will make the algo lot more
-    TODO:     efficient/faster to compute on large graphs.
-    TODO: Add sampling with above feature to do multi-level coarse sampling,
-    TODO:     partitioning, estimation, and refinement.
     TODO: Parallel computations of above for large graphs
     """
 
-    def __init__(self, staging_dir, data_name, seed, min_flow, shave_rate, min_shave, id_mapping, weight_scale):
+    def __init__(self, staging_dir, data_name, seed, min_flow, shave_rate, min_shave, id_mapping, weight_scale,
+                 flow_dtype=np.float64):
         """
 
         :param staging_dir:
         :param data_name:
         :param seed:
-        :param min_flow:
-        :param shave_rate:
+        :param min_flow: min flow, or a list of min flows to sweep in a single
+                         flow pass, each saved to output dir/min_flow_{value}
+        :type min_flow: float | list[float]
+        :param shave_rate: shave rate, or a list of shave rates. With a list
+                           shaving runs once at the finest rate and the
+                           hierarchies of the coarser rates are derived from
+                           its levels, each saved to
+                           output dir/shave_rate_{value}. Derived hierarchies
+                           approximate a run at their rate, see
+                           _derive_shave_rate_state
+        :type shave_rate: float | list[float]
         :param min_shave:
         :param id_mapping:
         :param weight_scale: see CLI
+        :param flow_dtype: dtype of node and pair flows, np.float32 halves the
+                           flow memory
         """
 
-        self.shave_rate = shave_rate
+        if isinstance(shave_rate, (list, tuple)):
+            self.shave_rates = list(shave_rate)
+        else:
+            self.shave_rates = [shave_rate]
+        # shaving runs at the finest rate
+        self.shave_rate = min(self.shave_rates) if self.shave_rates else None
         self.min_shave = min_shave
         self.random = Random(seed)
-        self.min_flow = min_flow
+        if isinstance(min_flow, (list, tuple)):
+            self.min_flows = list(min_flow)
+        else:
+            self.min_flows = [min_flow]
+        self.min_flow = self.min_flows[0]
         self.weight_scale = weight_scale
+        self.flow_dtype = np.dtype(flow_dtype)
 
-        # loaded raw graph, loaded during first load call
+        # loaded graph as an ArrayGraph, loaded during load_graph call
         # Only stores half of the matrix removing duplicates.
-        self.graph = list()
-        # set of loaded original node ids and their flow
-        self.node_flows = dict()
+        self.graph = None
+        # total flow of each node, indexed by internal node ID
+        self.node_flows = None
+
+        # raw weights of individual nodes if id mapping file is found with weights in it, raw_node_weights[i] is the
+        #     weight of original node id raw_weight_ids[i]
+        self.raw_weight_ids = np.zeros(0, dtype=np.int64)
+        self.raw_node_weights = np.zeros(0, dtype=np.float64)
 
-        # nodes with flow > min_flow
-        self.dense_nodes = set()
+        # original node id -> original string id from the id mapping file, None if no id mapping
+        self.source_id_mappings = None
 
-        # weights of individual nodes if id mapping file is found with weights in it
+        # average scaled raw weight the node weights were normalized by, None if all weights are 1.0
+        self.weight_normalizer = None
+
+        # normalized weights of individual nodes indexed by internal node ID
         # default is 1.0 for all points if id mapping file not passed. Also weights passed are normalized between
         # 0 and 1 for all points based on weight_scale policy
-        self.node_weights = dict()
-
-        # 0 indexed sorted index mapping of points based on point order and makes ids contiguous
-        # eg. 2 995 34 maps to 2->0, 34->1, 995->2
-        self.sorted_node_mapping = dict()
+        self.node_weights = None
 
-        # Flow graph at any given point during shaving is stored here.
-        self.flow_graph = dict()  # dict (node ID 1, node ID 2) -> flow
+        # Flow graph at any given point during shaving is stored here, only kept by the edge algo.
+        # Upper triangle (node ID 1 < node ID 2) of the symmetric flow matrix.
+        self.flow_graph = None  # PairFlowStore: (node ID 1, node ID 2) -> flow
 
-        # set of indices into self.graph representing unique nbrs/edges related to a given point/node
-        self.nbrs = defaultdict(set)
+        # nbr_fill[i] is the number of edges of node i added so far. Since
+        #     edges are added in edge order these are always the first
+        #     nbr_fill[i] entries of the node's CSR row in self.graph.
+        self.nbr_fill = None
         self.num_edges = None
 
+        # EdgeStream producing the graph's edges on the fly, set by load_similarity_graph
+        self.edge_stream = None
+
+        # clustering state of every min flow, created by hds
+        self.states = None
+        # states saved by save, one per min flow and shave rate, created by hds
+        self.output_states = None
+
         # edge shave threshold percentiles
         self.edge_shave_percentiles = None
 
-        # clusters at each level, not re-labeled these are converted into HMA hierarchy at the end
-        # no relabeling needed as that happens in gene diver
-        self.level_clusters = None
+        # hierarchy of the first min flow and shave rate, see ShavingState.hierarchy
+        self.hierarchy = None
 
         # check params
-        if not 0 <= min_flow:
-            raise ValueError("min_flow must be between 0 and 1")
-        if not 0 <= shave_rate <= 1:
-            raise ValueError("shave_rate muse be between 0 and 1")
+        if not self.min_flows:
+            raise ValueError("at least one min_flow is needed")
+        if len(set(self.min_flows)) != len(self.min_flows):
+            raise ValueError("min_flow values must be unique")
+        for flow in self.min_flows:
+            if not 0 <= flow:
+                raise ValueError("min_flow must be between 0 and 1")
+        if not self.shave_rates:
+            raise ValueError("at least one shave_rate is needed")
+        if len(set(self.shave_rates)) != len(self.shave_rates):
+            raise ValueError("shave_rate values must be unique")
+        for rate in self.shave_rates:
+            if not 0 <= rate <= 1:
+                raise ValueError("shave_rate muse be between 0 and 1")
 
         self.staging_dir = staging_dir
 
@@ -141,45 +198,61 @@ class GraphHDSV2:
             print("Creating output dir: {}".format(self.output_dir))
             os.makedirs(self.output_dir)
 
-        # File containing graph input data
-        self.graph_file = os.path.join(staging_dir, data_name + ".jsonl")
+        # incremental shaving state saved by hds for resuming interrupted runs
+        self.checkpoint_file = os.path.join(self.output_dir, "hds_checkpoint.npz")
+        # graph and labels of every level saved by hds for incremental updates
+        self.update_state_file = os.path.join(self.output_dir, "hds_update_state.npz")
 
-        if not os.path.isfile(self.graph_file):
-            raise GraphHDSException("Could not find required graph input file: {}".format(self.graph_file))
+        # File containing graph input data, not needed if the graph is computed on the fly
+        self.graph_file = os.path.join(staging_dir, data_name + ".jsonl")
 
-        # load ID mapping
+        # file with original node values as a single column of values"
         if id_mapping:
-            self.source_id_mappings = dict()
-            # file with original node values as a single column of values"
-            graph_index_file = os.path.join(staging_dir,
-                                            data_name + ".mapping.tsv")
-
-            print("Getting point id mappings from {}".format(graph_index_file))
-
-            with open(graph_index_file) as f:
-                line_count =0
-                for line in f:
-                    cols = line.split("\t")
-                    if len(cols) != 3:
-                        raise GraphHDSException("Expected format to be <node id> <int id> <raw weight>, found: {} at line: {}".format(line, line_count))
-                    line_count += 1
-                    node_original_id = cols[1].strip()
-                    node_id = int(cols[0])
-                    node_weight = float(cols[2])
-                    self.source_id_mappings[node_id] = node_original_id
-                    self.node_weights[node_id] = node_weight
+            self.graph_index_file = os.path.join(staging_dir, data_name + ".mapping.tsv")
         else:
-            self.source_id_mappings = None
+            self.graph_index_file = None
 
             print("Skipping ID mapping of points since graph ID mapping flag was off")
 
+        # binary cache of the parsed graph and mapping files next to the graph file
+        self.graph_cache_dir = graph_cache.cache_dir_for(self.graph_file)
+
+    def _read_id_mapping(self, mapping_file=None):
+        """
+        Reads the id mapping file.
+        :param mapping_file: defaults to the graph's id mapping file
+        :type mapping_file: str | None
+        :return: node id, raw weight and original string id of every row
+        :rtype: (np.ndarray, np.ndarray, list[str])
+        """
+        if mapping_file is None:
+            mapping_file = self.graph_index_file
+
+        print("Getting point id mappings from {}".format(mapping_file))
+
+        node_ids = list()
+        node_weights = list()
+        node_original_ids = list()
+        with open(mapping_file) as f:
+            line_count = 0
+            for line in f:
+                cols = line.split("\t")
+                if len(cols) != 3:
+                    raise GraphHDSException("Expected format to be <node id> <int id> <raw weight>, found: {} at line: {}".format(line, line_count))
+                line_count += 1
+                node_original_ids.append(cols[1].strip())
+                node_ids.append(int(cols[0]))
+                node_weights.append(float(cols[2]))
+
+        return np.array(node_ids, dtype=np.int64), np.array(node_weights, dtype=np.float64), node_original_ids
+
     def get_all_nodes_set(self):
         """
         returns the set of all original node ids
         :return:
         """
 
-        return set(self.node_flows.keys())
+        return set(self.graph.node_ids.tolist())
 
     def _normalize_node_weights(self):
         """
@@ -190,10 +263,12 @@ class GraphHDSV2:
         :return:
         """
 
+        num_nodes = self.graph.num_nodes
+
         # no node weights found set all of them to 1.0, or if weight scale is forced 0
-        if (len(self.node_weights) == 0) or (self.weight_scale == 0):
-            for _node_id in self.get_all_nodes_set():
-                self.node_weights[_node_id] = 1.0
+        if (len(self.raw_node_weights) == 0) or (self.weight_scale == 0):
+            self.node_weights = np.ones(num_nodes, dtype=np.float64)
+            self.weight_normalizer = None
 
             print("Setting all nodes to weight of 1.0")
             return
@@ -203,113 +278,241 @@ class GraphHDSV2:
         else:
             print("Setting all nodes using log({}) scaling".format(self.weight_scale))
 
-        avg_weight = 0.0
-        for w_node_id in self.node_weights.keys():
-            # log scale it IFF weight scale > 1
-            if self.weight_scale > 1:
-                self.node_weights[w_node_id] = abs(math.log(self.node_weights[w_node_id], self.weight_scale))
-            else:
-                pass
+        # sorted unique node ids, the last row of a node id repeated in the mapping file wins
+        last_rows = len(self.raw_weight_ids) - 1 - np.unique(self.raw_weight_ids[::-1], return_index=True)[1]
+        weight_ids = self.raw_weight_ids[last_rows]
+        weights = self.raw_node_weights[last_rows]
 
-            avg_weight += self.node_weights[w_node_id]
+        weights = self._scale_raw_weights(weights)
 
         # now compute average by dividing by node count
-        avg_weight /= len(self.get_all_nodes_set())
+        avg_weight = weights.sum() / num_nodes
+        self.weight_normalizer = avg_weight
+
+        # look up the weight of every graph node
+        pos = np.searchsorted(weight_ids, self.graph.node_ids)
+        pos[pos == len(weight_ids)] = 0
+        missing = weight_ids[pos] != self.graph.node_ids
+        if missing.any():
+            raise GraphHDSException("Missing node id {} in id mapping file".format(self.graph.node_ids[missing][0]))
 
         # now renormalize to between 0 and 1
-        min_norm_weight = 10000000000.0
-        max_norm_weight = 0.0
-        avg_norm_weight = 0.0
-        for _node_id in self.get_all_nodes_set():
-            if _node_id in self.node_weights:
-                norm_node_weight = self.node_weights[_node_id]/(avg_weight+0.000000000000000000000000000001)
-                self.node_weights[_node_id] = norm_node_weight
-                if min_norm_weight > norm_node_weight:
-                    min_norm_weight = norm_node_weight
-                if max_norm_weight < norm_node_weight:
-                    max_norm_weight = norm_node_weight
-                avg_norm_weight += norm_node_weight
-            else:
-                raise GraphHDSException("Missing node id {} in id mapping file".format(_node_id))
+        self.node_weights = weights[pos] / (avg_weight + 0.000000000000000000000000000001)
 
-        avg_norm_weight /= len(self.get_all_nodes_set())
         print("Normalized all weights to an average of 1.0, avg_weight: {}, min_weight: "
-              "{}, max_weight: {}".format(avg_norm_weight, min_norm_weight, max_norm_weight))
+              "{}, max_weight: {}".format(self.node_weights.mean(), self.node_weights.min(), self.node_weights.max()))
+
+    def _scale_raw_weights(self, weights):
+        """
+        :param weights: raw node weights
+        :type weights: np.ndarray
+        :return: weights log scaled IFF weight scale > 1
+        :rtype: np.ndarray
+        """
+        if self.weight_scale > 1:
+            return np.abs(np.log(weights) / math.log(self.weight_scale))
+        return weights
 
-    def load_graph(self):
+    def load_graph(self, num_workers=None, use_cache=True):
         """
-        Loads the autoHDS-G graph into memory as a list of edges.
+        Loads the autoHDS-G graph into memory as an ArrayGraph with edges
+        sorted by decreasing weight. If use_cache is set the parsed graph and
+        id mapping are memory mapped from the binary graph cache when it is
+        fresh, else they are parsed and the cache is (re)written.
+        :param num_workers: number of processes parsing the graph file,
+                            defaults to the CPU count
+        :type num_workers: int | None
+        :param use_cache: read and write the binary graph cache
+        :type use_cache: bool
         """
 
         start_time = default_timer()
-        last_time = start_time
-        self.num_edges = 0
-
-        # temporary edges for deduping
-        unique_edges = set()
-        with open(self.graph_file) as f:
-            for i, line in enumerate(map(str.strip, f), 1):
-                if len(line.strip()) == 0:
-                    # ignore empty line
-                    continue
 
-                # line_len = len(line)
-                # if line_len > max_line_len:
-                #     print("    longest line so far (line {:,}): {:,} characters".format(i, line_len))
-                #     max_line_len = line_len
-
-                if i % 1000 == 0:
-                    now = default_timer()
-                    print("\tReading data for adjacency matrix row {:,} "
-                          "({:.2f} s cumulative) (Δcumulative={:.3f} s)"
-                          .format(
-                              i,
-                              now - start_time,
-                              now - last_time
-                          ))
-                    last_time = default_timer()
-
-                point_data = json.loads(line)
-
-                point_id = point_data["id"]
-                self.node_flows[point_id] = 0.0
-                for neighbor, weight in point_data["connections"]:
-
-                    if neighbor < point_id:
-                        edge_id = (neighbor, point_id)
-                        edge = (neighbor, point_id, weight)
-                    elif neighbor > point_id:
-                        edge_id = (point_id, neighbor)
-                        edge = (point_id, neighbor, weight)
-                    else:
-                        print("Warning: removing referenced edges to self, please fix your graph!")
-                        continue
+        if not os.path.isfile(self.graph_file):
+            raise GraphHDSException("Could not find required graph input file: {}".format(self.graph_file))
 
-                    if edge_id not in unique_edges:
-                        self.num_edges += 1
-                        self.graph.append(edge)
-                        unique_edges.add(edge_id)
+        source_files = [self.graph_file]
+        if self.graph_index_file is not None:
+            source_files.append(self.graph_index_file)
+        signature = graph_cache.source_signature(source_files) if use_cache else None
 
-        # created sorted node id mapping for internal hma labels matrix storage
-        idx = 0
-        for external_int_id in sorted(self.node_flows):
-            self.sorted_node_mapping[idx] = external_int_id
-            idx += 1
+        cached = graph_cache.read_graph_cache(self.graph_cache_dir, signature) if use_cache else None
+        if cached is not None:
+            print("Using graph cache at: {}".format(self.graph_cache_dir))
+            self.graph, mapping_ids, mapping_weights, mapping_names = cached
+        else:
+            mapping_ids = mapping_weights = mapping_names = None
+            if self.graph_index_file is not None:
+                mapping_ids, mapping_weights, mapping_names = self._read_id_mapping()
+
+            # internal node ids are the 0 indexed sorted positions of the original node ids
+            self.graph = load_array_graph(self.graph_file, num_workers=num_workers)
+            self.graph.sort_by_weight()
+
+            if use_cache:
+                print("Writing graph cache to: {}".format(self.graph_cache_dir))
+                graph_cache.write_graph_cache(self.graph_cache_dir, signature, self.graph,
+                                              mapping_ids, mapping_weights, mapping_names)
+
+        if mapping_ids is not None:
+            self.raw_weight_ids = mapping_ids
+            self.raw_node_weights = mapping_weights
+            self.source_id_mappings = dict(zip(mapping_ids.tolist(), mapping_names))
+
+        self._init_flow_state()
 
         print("Graph at: {} loaded with {} points and {} edges in {:.3f} "
-              "seconds".format(self.graph_file, len(self.graph),
+              "seconds".format(self.graph_file, self.graph.num_nodes,
                                self.num_edges, default_timer() - start_time))
 
         # now compute normalized node weights
         self._normalize_node_weights()
 
-    def _calc_edge_shave_thresholds(self):
+    def load_similarity_graph(self, edge_stream, node_weights=None, point_names=None):
+        """
+        Uses a graph computed on the fly instead of a pre-produced graph file.
+        Point i of the stream is node ID i. No edges are computed here, hds
+        pulls them from the stream in decreasing similarity order as shaving
+        goes down the levels.
+        :param edge_stream: edges of the graph
+        :type edge_stream: graphHDS.similarity.EdgeStream
+        :param node_weights: raw weight of every point, see weight_scale.
+                             None for equal weights
+        :type node_weights: np.ndarray | None
+        :param point_names: original string ID of every point, None for no id
+                            mapping
+        :type point_names: list[str] | None
+        """
+        num_pts = edge_stream.num_points
+        no_edges = np.zeros(0, dtype=np.int64)
+
+        self.edge_stream = edge_stream
+        self.graph = ArrayGraph(np.arange(num_pts, dtype=np.int64), no_edges, no_edges,
+                                np.zeros(0, dtype=np.float64), weight_sorted=True)
+
+        if node_weights is not None:
+            self.raw_weight_ids = np.arange(num_pts, dtype=np.int64)
+            self.raw_node_weights = np.asarray(node_weights, dtype=np.float64)
+        if point_names is not None:
+            self.source_id_mappings = dict(enumerate(point_names))
+
+        self._init_flow_state()
+
+        print("Similarity graph with {} points, edges are computed during shaving".format(num_pts))
+
+        # now compute normalized node weights
+        self._normalize_node_weights()
+
+    def sparsify(self, top_k=None, mutual=False, hub_degree=None):
+        """
+        Bounds the node degrees of the loaded graph before shaving (see
+        graphHDS.sparsify), either by keeping the top k edges of every node or
+        by sampling and reweighting the edges of hub nodes. The impact report
+        is written to output dir/sparsify_report.json.
+        :param top_k: keep the top_k heaviest edges of every node
+        :type top_k: int | None
+        :param mutual: with top_k, keep only the edges in the top k of both
+                       their nodes instead of either one
+        :type mutual: bool
+        :param hub_degree: sample the edges of nodes with more edges than this
+        :type hub_degree: int | None
+        :return: the report
+        :rtype: dict
+        """
+        start_time = default_timer()
+
+        if (top_k is None) == (hub_degree is None):
+            raise ValueError("pass exactly one of top_k and hub_degree")
+        if self.edge_stream is not None:
+            raise ValueError("a similarity graph computed on the fly can not be sparsified")
+
+        if top_k is not None:
+            print("Sparsifying graph to the top {} edges of every node ({} kNN)".format(
+                top_k, "mutual" if mutual else "union"))
+            graph = sparsify.sparsified_graph(self.graph, sparsify.top_k_edges(self.graph, top_k, mutual=mutual))
+        else:
+            print("Sparsifying graph by sampling the edges of nodes with more than {} edges".format(hub_degree))
+            keep, weights = sparsify.sample_hub_edges(self.graph, hub_degree, self.random)
+            graph = sparsify.sparsified_graph(self.graph, keep, weights)
+
+        report = sparsify.sparsification_report(self.graph, graph)
+        report.update({"top_k": top_k, "mutual": mutual, "hub_degree": hub_degree})
+
+        self.graph = graph
+        self._init_flow_state()
+
+        report_file = os.path.join(self.output_dir, "sparsify_report.json")
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+        print("Sparsified graph from {} to {} edges, sum of squared degrees: {} -> {}, max degree: {} -> {}, "
+              "estimated node flow ratio: {}, mean node flow change: {}, node flow rank correlation: {}. Report "
+              "saved to {} (time={:.2f} s)".format(report["edges"], report["sparse_edges"], report["sum_sq_degrees"],
+                                                  report["sparse_sum_sq_degrees"], report["max_degree"],
+                                                  report["sparse_max_degree"], report["flow_ratio"],
+                                                  report["mean_flow_change"], report["flow_rank_correlation"],
+                                                  report_file, default_timer() - start_time))
+        return report
+
+    def _init_flow_state(self):
+        """
+        Resets the flows of the loaded graph to those of an empty graph.
+        """
+        self.num_edges = self.graph.num_edges
+        self.node_flows = np.zeros(self.graph.num_nodes, dtype=self.flow_dtype)
+        self.nbr_fill = np.zeros(self.graph.num_nodes, dtype=np.int64)
+        self.flow_graph = PairFlowStore(self.graph.num_nodes, dtype=self.flow_dtype)
+
+    @classmethod
+    def _level_recorder(cls, states, num_edges, min_shave):
+        """
+        Creates an instance that only records the levels of states, without a
+        graph, for the level labeling process of pipelined shaving.
+        :param states:
+        :type states: list[ShavingState]
+        :param num_edges: no. of edges of the graph, for reporting
+        :type num_edges: int
+        :param min_shave:
+        :type min_shave: float
+        :rtype: GraphHDSV2
+        """
+        graph_hds = cls.__new__(cls)
+        graph_hds.states = states
+        graph_hds.num_edges = num_edges
+        graph_hds.min_shave = min_shave
+        return graph_hds
+
+    @classmethod
+    def _component_shaver(cls, graph, node_weights, flow_dtype):
+        """
+        Creates an instance that only computes flows and clusters of an in
+        memory graph, without any files, for component parallel shaving.
+        :param graph: weight sorted graph of some connected components
+        :type graph: ArrayGraph
+        :param node_weights: normalized weight of each node of the graph
+        :type node_weights: np.ndarray
+        :param flow_dtype: see __init__
+        :rtype: GraphHDSV2
+        """
+        graph_hds = cls.__new__(cls)
+        graph_hds.graph = graph
+        graph_hds.node_weights = node_weights
+        graph_hds.flow_dtype = np.dtype(flow_dtype)
+        graph_hds._init_flow_state()
+        return graph_hds
+
+    def _calc_edge_shave_thresholds(self, shave_rate=None):
         """
         Calculates the edge similarity shave thresholds as percentiles based on
         edge shave rate.
+        :param shave_rate: defaults to the (finest) shave rate of the run
+        :type shave_rate: float | None
         :return:
         """
 
+        if shave_rate is None:
+            shave_rate = self.shave_rate
+
         f_kept = 1.0
         edge_shave_idx = list()
         while math.floor(f_kept * self.num_edges) >= 1.0:
@@ -319,26 +522,31 @@ class GraphHDSV2:
             if (len(edge_shave_idx) == 0) or (edge_shave_idx[-1] != percentile_idx):
                 edge_shave_idx.append(percentile_idx)
 
-            f_kept *= 1.0 - self.shave_rate
+            f_kept *= 1.0 - shave_rate
 
         print("Found {} discrete shaving levels at shaving rate"
-              " of {} for {} edges in graph.".format(len(edge_shave_idx), self.shave_rate, self.num_edges))
+              " of {} for {} edges in graph.".format(len(edge_shave_idx), shave_rate, self.num_edges))
 
         # reverse the order of the list
         edge_shave_idx.reverse()
 
         # now calculate the shaving thresholds to get as many edges
-        # TODO: speed this up using heap
-        print("Sorting edge values for ")
-        self.graph.sort(key=operator.itemgetter(2), reverse=True)
+        # only the weights at the percentile positions of the decreasing order
+        #     are needed, so partition around those instead of a full sort
+        #     unless the edges are already weight sorted
+        if self.graph.weight_sorted:
+            shave_weights = self.graph.edge_weights[edge_shave_idx]
+        else:
+            print("Partitioning edge values for {} shave thresholds".format(len(edge_shave_idx)))
+            shave_weights = -np.partition(-self.graph.edge_weights, edge_shave_idx)[edge_shave_idx]
 
         edge_shave_percentiles = list()
         print("Edge shave thresholds (reverse order):")
         count = 0
-        for edge_idx in edge_shave_idx:
+        for shave_weight in shave_weights.tolist():
             # remove duplicate thresholds that can happen due to digitization effects of similarities
-            if (len(edge_shave_percentiles) == 0) or (edge_shave_percentiles[-1] != self.graph[edge_idx][2]):
-                edge_shave_percentiles.append(self.graph[edge_idx][2])
+            if (len(edge_shave_percentiles) == 0) or (edge_shave_percentiles[-1] != shave_weight):
+                edge_shave_percentiles.append(shave_weight)
                 count += 1
                 print("{:.7f} ".format(edge_shave_percentiles[-1]), end='')
             if count % 20 == 0:
@@ -351,344 +559,1036 @@ class GraphHDSV2:
         """
         Given the full graph, returns the pruning groups of edges that would be
         added in the graph at each shaving level starting from nothing.
-        :return:
-        """
 
-        edge_groups = list()
-        for _ in self.edge_shave_percentiles:
-            edge_groups.append(set())
+        The graph's edges are reordered by group (a weight ordered permutation
+        at the resolution of the shave thresholds, input order is kept within a
+        group) so every group is a contiguous run of edge indices.
+        :return: [start, end) edge index slice of each shaving level's group
+        :rtype: list[slice]
+        """
 
         num_percentiles = len(self.edge_shave_percentiles)
 
-        # absolute index into the weight percentile buckets
-        weight_idx = 0
-        # absolute index into the original graph edges list
-        edge_idx = 0
-        for point1, point2, weight in self.graph:
-            # keep track of where you are in the bucket as you will move
-            #     through sorted points and buckets in the same direction
-            if (weight < self.edge_shave_percentiles[weight_idx]) and (weight_idx < num_percentiles - 1):
-                weight_idx += 1
+        # an edge belongs to the first level whose threshold it is not below,
+        #     i.e. its group is the number of thresholds greater than its weight
+        ascending_percentiles = np.array(self.edge_shave_percentiles[::-1])
+        edge_groups = num_percentiles - np.searchsorted(ascending_percentiles, self.graph.edge_weights, side="right")
+        np.minimum(edge_groups, num_percentiles - 1, out=edge_groups)
+
+        # weight sorted edges are already ordered by group
+        if not self.graph.weight_sorted:
+            # stable counting sort on the group (radix sort for small int types)
+            group_dtype = np.uint16 if num_percentiles <= np.iinfo(np.uint16).max else np.int64
+            edge_groups = edge_groups.astype(group_dtype)
+            order = np.argsort(edge_groups, kind="stable")
+            self.graph.permute_edges(order)
+            edge_groups = edge_groups[order]
+
+        group_ends = np.searchsorted(edge_groups, np.arange(num_percentiles), side="right")
+        group_starts = np.concatenate(([0], group_ends[:-1]))
+        return [slice(start, end) for start, end in zip(group_starts.tolist(), group_ends.tolist())]
+
+    def _group_flow_delta(self, group_in):
+        """
+        Computes the flow added between node pairs by adding the edges of a
+        prune group to the edges added so far.
+
+        With A the adjacency of the edges added so far and dA the adjacency of
+        the group's edges, the flow between a pair of distinct nodes is their
+        entry in A.A (the sum of the weights of all 2 hop paths between them),
+        so the flow added by the group is dA.A + A.dA + dA.dA. Only the rows of
+        A of the group's nodes are needed, and A.dA is the transpose of dA.A.
+        Each pair's flow is scaled by the larger weight of its two nodes.
+
+        :param group_in: edge index slice of the group
+        :type group_in: slice
+        :return: flow delta as a symmetric matrix with an empty diagonal
+        :rtype: scipy.sparse.coo_matrix
+        """
+        num_pts = self.graph.num_nodes
+
+        # nodes of the group's edges, mapped to local row numbers
+        group_nodes, group_edge_nodes = np.unique(
+            np.concatenate((self.graph.edge_src[group_in], self.graph.edge_dst[group_in])),
+            return_inverse=True
+        )
+        num_group_nodes = len(group_nodes)
+        local_src, local_dst = np.split(group_edge_nodes, 2)
+        group_weights = self.graph.edge_weights[group_in]
+
+        # dA restricted to the group's nodes
+        group_adjacency = csr_matrix(
+            (np.tile(group_weights, 2), (group_edge_nodes, np.concatenate((local_dst, local_src)))),
+            shape=(num_group_nodes, num_group_nodes)
+        )
+
+        # rows of A of the group's nodes, i.e. their nbrs added so far
+        entry_rows, entry_nbrs, entry_weights = self.graph.row_prefixes(group_nodes, self.nbr_fill[group_nodes])
+        group_rows = csr_matrix((entry_weights, (entry_rows, entry_nbrs)), shape=(num_group_nodes, num_pts))
+
+        # dA.A, its transpose A.dA, and dA.dA
+        nbr_flow = (group_adjacency @ group_rows).tocoo()
+        group_flow = (group_adjacency @ group_adjacency).tocoo()
+        rows = np.concatenate((group_nodes[nbr_flow.row], nbr_flow.col, group_nodes[group_flow.row]))
+        cols = np.concatenate((nbr_flow.col, group_nodes[nbr_flow.row], group_nodes[group_flow.col]))
+        flows = np.concatenate((nbr_flow.data, nbr_flow.data, group_flow.data))
 
-            # now save this edge in the right group, also we don't want duplicates a,b is same as b,a
-            edge_groups[weight_idx].add(edge_idx)
+        # nodes have no flow with themselves
+        off_diagonal = rows != cols
+        rows = rows[off_diagonal]
+        cols = cols[off_diagonal]
+        flows = flows[off_diagonal]
 
-            edge_idx += 1
+        # todo try multiplicative flow weighting later. we weight by points also
+        #flow_inc = nbr_weight * weight * ((self.node_weights[nbr_node_id] + self.node_weights[node2])/2.0)
+        flows *= np.maximum(self.node_weights[rows], self.node_weights[cols])
 
-        return edge_groups
+        flow_delta = coo_matrix((flows, (rows, cols)), shape=(num_pts, num_pts))
+        flow_delta.sum_duplicates()
+        return flow_delta
 
-    def _update_nbr_flow(self, edge_idx, node_pos):
+    def _update_flow_with_next_level(self, group_in, algo, states=()):
         """
-        Given an edge (node1, node2) and a target node pos (0 or 1) in the
-        edge, update the flow between the target node's neighbors and the
-        non-target node.
-        :param edge_idx:
-        :param node_pos:
+        Apply the next prune group to the flow graph incrementally.
+        Updates the flow graph with all of the group's edges at once.
+
+        The node algo only reads the total flow of every node, so only the
+        edge algo keeps the flows of node pairs in the flow graph. Pair flows
+        only increase, so the edge algo finds the pairs that became dense for
+        a state as their flows are added and sets them as the state's
+        new_dense_pairs.
+
+        :param group_in: edge index slice of the group
+        :type group_in: slice
+        :param algo: node or edge
+        :param states: states of the level, done states are skipped
+        :type states: collections.Iterable[ShavingState]
+        :return: nodes involved in new edges, nodes whose flow changed
+        :rtype: (np.ndarray, np.ndarray)
         """
+        start_time = default_timer()
 
-        if node_pos == 0:
-            node1, node2, weight = self.graph[edge_idx]
-        else:  # node_pos == 1
-            node2, node1, weight = self.graph[edge_idx]
-
-        for nbr_edge_idx in self.nbrs[node1]:
-            node_a, node_b, nbr_weight = self.graph[nbr_edge_idx]
-            nbr_node_id = node_a if node_a != node1 else node_b
+        num_pts = self.graph.num_nodes
+        flow_delta = self._group_flow_delta(group_in)
 
-            # todo try multiplicative flow weighting later. we weight by points also
-            #flow_inc = nbr_weight * weight * ((self.node_weights[nbr_node_id] + self.node_weights[node2])/2.0)
-            flow_inc = nbr_weight * weight * max(self.node_weights[nbr_node_id], self.node_weights[node2])
+        # keep track of total flow to a point. actual flow at point is adjusted by its weight
+        self.node_flows += np.bincount(flow_delta.row, weights=flow_delta.data, minlength=num_pts) * self.node_weights
 
-            # keep track of total flow to a point. actual flow at point is adjusted by its weight
-            self.node_flows[node2] += flow_inc * self.node_weights[node2]
-            self.node_flows[nbr_node_id] += flow_inc * self.node_weights[nbr_node_id]
+        # the flow graph only stores half of the symmetric flow matrix
+        if algo == "edge":
+            upper = flow_delta.row < flow_delta.col
+            active_states = [state for state in states if not state.done]
+            crossings = self.flow_graph.add(flow_delta.row[upper], flow_delta.col[upper], flow_delta.data[upper],
+                                            [state.min_flow for state in active_states])
+            for state, new_dense_pairs in zip(active_states, crossings):
+                state.new_dense_pairs = new_dense_pairs
 
-            if (node2 not in self.dense_nodes) and (self.node_flows[node2] >= self.min_flow):
-                self.dense_nodes.add(node2)
-            if (nbr_node_id not in self.dense_nodes) and (self.node_flows[nbr_node_id] > self.min_flow):
-                self.dense_nodes.add(nbr_node_id)
+        # update the nbrs, the group's edges are the next entries of their CSR rows
+        group_src = self.graph.edge_src[group_in]
+        group_dst = self.graph.edge_dst[group_in]
+        self.nbr_fill += np.bincount(group_src, minlength=num_pts) + np.bincount(group_dst, minlength=num_pts)
 
-            # this is native tuple edge id as we need random access for flow updates
-            node2_to_nbr_edge = (node2, nbr_node_id) if node2 < nbr_node_id else (nbr_node_id, node2)
+        # set of all points touched by these edges
+        nodes_processed = np.union1d(group_src, group_dst)
 
-            # update the flow from nod2 to node1's nbr
-            if node2_to_nbr_edge not in self.flow_graph:
-                self.flow_graph[node2_to_nbr_edge] = 0
+        # flows only increase, so only nodes whose flow changed can become dense
+        flow_nodes = np.union1d(nodes_processed, flow_delta.row)
 
-            self.flow_graph[node2_to_nbr_edge] += flow_inc
+        print("flow update took: {:.3f} seconds".format(default_timer() - start_time))
+        return nodes_processed, flow_nodes
 
-    def _update_flow_with_next_level(self, group_in):
+    def _update_dense_nodes(self, state, flow_nodes):
         """
-        Apply the next prune group to the flow graph incrementally.
-        Updates the flow graph with the group's edges.
+        Marks the nodes whose flow reached the state's min_flow as dense.
+
+        A node is dense once its flow is >= min_flow, the same threshold as
+        the pair flows. The old per-edge update used >= for the end node of a
+        new edge but > for its nbrs, so whether a node with a flow of exactly
+        min_flow became dense depended on the order of the updates. All flows
+        of a level are updated at once here, which has no such order.
+        :param state:
+        :type state: ShavingState
+        :param flow_nodes: nodes whose flow changed at this level
+        :type flow_nodes: np.ndarray
+        :return: nodes that became dense
+        :rtype: np.ndarray
+        """
+        new_dense_nodes = flow_nodes[~state.dense_nodes[flow_nodes] & (self.node_flows[flow_nodes] >= state.min_flow)]
+        state.dense_nodes[new_dense_nodes] = True
+        return new_dense_nodes
 
-        :param group_in:
-        :type group_in: set[int]
-        :return: set of nodes involved in new edges
-        :rtype: set[int]
+    def _compute_edge_flow_clusters(self, state):
+        """
+        Updates the clusters given the threshold for min flow of edges by
+        merging the end nodes of pairs whose flow reached min_flow since the
+        last level, as found by _update_flow_with_next_level.
+        :param state:
+        :type state: ShavingState
+        :return: Cluster label of every node, 0 for points not clustered.
+        :rtype: np.ndarray
         """
         start_time = default_timer()
 
-        # set of all points touched by these edges
-        nodes_processed = set()
+        # flows only increase so dense pairs stay dense, only new ones can merge clusters
+        new_rows, new_cols = state.new_dense_pairs
+        state.clusters.union_pairs(new_rows, new_cols)
 
-        # update current prune group neighbors
-        for edge_idx in group_in:
-            # update flow for neighbors of node1 and node2 in edge_idx caused by this new connection
-            self._update_nbr_flow(edge_idx, 0)
-            self._update_nbr_flow(edge_idx, 1)
+        # nodes of dense pairs are always in clusters of at least 2 points
+        labels = state.clusters.labels()
 
-            node1, node2, _ = self.graph[edge_idx]
+        print("cluster labeling took: {:.3f} seconds".format(default_timer() - start_time))
 
-            # update the nbrs set
-            self.nbrs[node1].add(edge_idx)
-            self.nbrs[node2].add(edge_idx)
+        return labels
 
-            nodes_processed.add(node1)
-            nodes_processed.add(node2)
+    def _node_flow_cluster_pairs(self, state, new_dense_nodes, group_in):
+        """
+        Finds the node pairs to merge given the threshold for min flow of
+        total flow of nodes. Dense nodes are merged with their dense nbrs.
+        Only nodes that became dense at this level and edges added at this
+        level need to be looked at since clusters only ever merge going down
+        the levels.
+        :param state:
+        :type state: ShavingState
+        :param new_dense_nodes: nodes that became dense at this level
+        :type new_dense_nodes: np.ndarray
+        :param group_in: edge index slice added at this level
+        :type group_in: slice
+        :return: node ID 1 and node ID 2 of the pairs to merge, in merge order
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        dense_nodes = state.dense_nodes
 
-        print("flow update took: {:.3f} seconds".format(default_timer() - start_time))
-        return nodes_processed
+        # new dense nodes connect to all of their dense nbrs added so far
+        entry_rows, nbr_node_ids, _ = self.graph.row_prefixes(new_dense_nodes, self.nbr_fill[new_dense_nodes])
 
-    def _compute_edge_flow_clusters(self):
+        # nbr is not dense, skip. we are only clustering connected dense nodes
+        dense_nbrs = dense_nodes[nbr_node_ids]
+
+        # new edges can connect nodes that were already dense
+        node1s = self.graph.edge_src[group_in]
+        node2s = self.graph.edge_dst[group_in]
+        dense_edges = dense_nodes[node1s] & dense_nodes[node2s]
+
+        return (np.concatenate((new_dense_nodes[entry_rows[dense_nbrs]], node1s[dense_edges])),
+                np.concatenate((nbr_node_ids[dense_nbrs], node2s[dense_edges])))
+
+    def _compute_node_flow_clusters(self, state, new_dense_nodes, group_in):
         """
-        Computes current clusters given the threshold for min flow of edges
-        using flood fill algorithm.
-        :return: The sparse cluster labels as set of of points clustered.
+        Updates the clusters given the threshold for min flow of total flow of
+        nodes, see _node_flow_cluster_pairs.
+        :param state:
+        :type state: ShavingState
+        :param new_dense_nodes: nodes that became dense at this level
+        :type new_dense_nodes: np.ndarray
+        :param group_in: edge index slice added at this level
+        :type group_in: slice
+        :return: Cluster label of every node, 0 for points not clustered.
+        :rtype: np.ndarray
         """
+
         start_time = default_timer()
 
-        cluster_labels = dict()  # dict: node ID -> cluster ID
-        cluster_points = dict()  # dict: cluster ID -> set of node IDs
-
-        new_label = 0
-        for (node1, node2), flow in self.flow_graph.items():
-            if flow >= self.min_flow:
-
-                if (node1 not in cluster_labels) and (node2 not in cluster_labels):
-                    # neither of the nodes have been encountered before
-                    # put them together in a new cluster
-                    new_label += 1
-                    cluster_points[new_label] = {node1, node2}
-                    cluster_labels[node1] = new_label
-                    cluster_labels[node2] = new_label
-
-                elif (node1 in cluster_labels) and (node2 not in cluster_labels):
-                    # add node2 to node1 cluster
-                    label = cluster_labels[node1]
-                    cluster_labels[node2] = label
-                    cluster_points[label].add(node2)
-
-                elif (node1 not in cluster_labels) and (node2 in cluster_labels):
-                    # add node1 to node2 cluster
-                    label = cluster_labels[node2]
-                    cluster_labels[node1] = label
-                    cluster_points[label].add(node1)
-
-                elif (node1 in cluster_labels) and (node2 in cluster_labels):
-                    # both are in cluster already merge the two clusters into one
-                    node1_cluster_label = cluster_labels[node1]
-                    node2_cluster_label = cluster_labels[node2]
-                    if node2_cluster_label == node1_cluster_label:
-                        # nothing to do, the points are already in the same cluster!
-                        continue
-
-                    # relabel points in node2 cluster points to node1 cluster label
-                    node2_cluster_points = cluster_points[node2_cluster_label]
-                    for node2_cluster_point in node2_cluster_points:
-                        # add the node2 points to cluster of node1
-                        cluster_labels[node2_cluster_point] = node1_cluster_label
-                        cluster_points[node1_cluster_label].add(node2_cluster_point)
-                    # remove the node2 cluster as it is merged
-                    del cluster_points[node2_cluster_label]
+        state.clusters.union_pairs(*self._node_flow_cluster_pairs(state, new_dense_nodes, group_in))
 
-                else:
-                    # Regardless of the data, reaching this point should be
-                    #     impossible.
-                    # All possibilities of node1 and node2 being or not being
-                    #     in cluster_labels were covered.
-                    raise AssertionError
+        # a dense node is only clustered once it is connected to another dense node
+        labels = state.clusters.labels()
 
-        print("cluster labeling took: {:.3f} seconds".format(default_timer() - start_time))
+        print("cluster labeling took: {} seconds".format(default_timer()-start_time))
 
-        return cluster_points
+        return labels
 
-    def _compute_node_flow_clusters(self):
+    def _checkpoint_params(self, algo):
         """
-        Computes current clusters given the threshold for min flow of total flow of nodes using
-        flood fill algorithm.
-        :return: The sparse cluster labels as set of of points clustered.
+        :return: run parameters a checkpoint has to match to be resumed
+        :rtype: dict
+        """
+        return {
+            "algo": algo,
+            "min_flows": self.min_flows,
+            "shave_rates": self.shave_rates,
+            "min_shave": self.min_shave,
+            "weight_scale": self.weight_scale,
+            "num_nodes": self.graph.num_nodes,
+            "num_edges": self.num_edges,
+            "stream_levels": self.states[0].levels_file is not None,
+            "flow_dtype": self.flow_dtype.name,
+            # layout of the saved state arrays
+            "checkpoint_version": 4
+        }
+
+    def _save_checkpoint(self, algo, next_level, num_edge_kept, points_processed):
+        """
+        Saves the incremental shaving state after a completed level to
+        self.checkpoint_file. The file is written next to the checkpoint and
+        then moved in place so an interrupted save keeps the last checkpoint.
+        :param algo:
+        :param next_level: index of the first prune group not applied yet
+        :type next_level: int
+        :param num_edge_kept:
+        :param points_processed:
         """
-
         start_time = default_timer()
 
-        cluster_labels = dict()  # dict: node ID -> cluster ID
-        cluster_points = dict()  # dict: cluster ID -> set of node IDs
+        state_arrays = dict()
+        for state_idx, state in enumerate(self.states):
+            state_arrays.update(state.checkpoint_arrays("state{}_".format(state_idx)))
+
+        tmp_file = self.checkpoint_file + ".tmp.npz"
+        np.savez_compressed(
+            tmp_file,
+            params=np.array(json.dumps(self._checkpoint_params(algo), sort_keys=True)),
+            edge_shave_percentiles=np.array(self.edge_shave_percentiles, dtype=np.float64),
+            next_level=next_level,
+            num_edge_kept=num_edge_kept,
+            points_processed=points_processed,
+            node_flows=self.node_flows,
+            nbr_fill=self.nbr_fill,
+            flow_keys=self.flow_graph.keys,
+            flow_values=self.flow_graph.flows,
+            **state_arrays
+        )
+        os.replace(tmp_file, self.checkpoint_file)
 
-        new_label = 0
-        for node1 in self.dense_nodes:
-            dense_node_edges = self.nbrs[node1]
+        print("Saved checkpoint before level index {} to {} in {:.3f} seconds".format(
+            next_level, self.checkpoint_file, default_timer() - start_time))
 
-            for edge_id in dense_node_edges:
-                node_a, node_b, _ = self.graph[edge_id]
-                if node_a != node1:
-                    node2 = node_a
-                else:
-                    node2 = node_b
+    def _load_checkpoint(self, algo):
+        """
+        Restores the incremental shaving state from self.checkpoint_file.
+        :param algo:
+        :return: next_level, num_edge_kept, points_processed as passed to
+                 _save_checkpoint
+        """
+        num_pts = self.graph.num_nodes
+
+        with np.load(self.checkpoint_file) as checkpoint:
+            params = json.loads(str(checkpoint["params"]))
+            if params != json.loads(json.dumps(self._checkpoint_params(algo))):
+                raise GraphHDSException("Checkpoint {} was made with different parameters: {}, current: {}".format(
+                    self.checkpoint_file, params, self._checkpoint_params(algo)))
+            if not np.array_equal(checkpoint["edge_shave_percentiles"], self.edge_shave_percentiles):
+                raise GraphHDSException("Checkpoint {} was made with different edge shave thresholds, was the graph "
+                                        "changed?".format(self.checkpoint_file))
+
+            self.node_flows = checkpoint["node_flows"]
+            self.nbr_fill = checkpoint["nbr_fill"]
+            self.flow_graph = PairFlowStore(num_pts, dtype=self.flow_dtype, keys=checkpoint["flow_keys"],
+                                            flows=checkpoint["flow_values"])
+
+            for state_idx, state in enumerate(self.states):
+                state.restore_checkpoint_arrays(checkpoint, "state{}_".format(state_idx))
+
+            return int(checkpoint["next_level"]), int(checkpoint["num_edge_kept"]), checkpoint["points_processed"]
+
+    def _state_output_dir(self, min_flow, shave_rate):
+        """
+        :return: output dir of the hierarchy of a min flow and shave rate,
+                 sub dirs are only used for swept parameters
+        :rtype: str
+        """
+        output_dir = self.output_dir
+        if len(self.min_flows) > 1:
+            output_dir = os.path.join(output_dir, "min_flow_{}".format(min_flow))
+        if len(self.shave_rates) > 1:
+            output_dir = os.path.join(output_dir, "shave_rate_{}".format(shave_rate))
+        return output_dir
+
+    def _coarse_shave_levels(self, shave_rate, prune_groups):
+        """
+        Maps each shave threshold of a coarser shave rate to the fine level
+        keeping the nearest number of edges.
+        :param shave_rate: coarser shave rate
+        :type shave_rate: float
+        :param prune_groups: edge slices of the fine levels
+        :type prune_groups: list[slice]
+        :return: fine level index of every coarse threshold, ascending
+        :rtype: np.ndarray
+        """
+        # no. of edges kept at each fine and coarse level
+        fine_kept = np.array([prune_group.stop for prune_group in prune_groups], dtype=np.int64)
+        coarse_thresholds = np.array(self._calc_edge_shave_thresholds(shave_rate), dtype=np.float64)
+        if self.graph.weight_sorted:
+            coarse_kept = np.searchsorted(-self.graph.edge_weights, -coarse_thresholds, side="right")
+        else:
+            coarse_kept = np.array([np.count_nonzero(self.graph.edge_weights >= threshold)
+                                    for threshold in coarse_thresholds.tolist()], dtype=np.int64)
+
+        # nearest fine level, ties go to the coarser level
+        upper = np.minimum(np.searchsorted(fine_kept, coarse_kept), len(fine_kept) - 1)
+        lower = np.maximum(upper - 1, 0)
+        return np.where(np.abs(fine_kept[lower] - coarse_kept) <= np.abs(fine_kept[upper] - coarse_kept),
+                        lower, upper)
+
+    def _derive_shave_rate_state(self, state, shave_rate, prune_groups):
+        """
+        Derives the hierarchy of a coarser shave rate from the level snapshots
+        of a state shaved at the finest rate, without recomputing any flows.
+        Each coarse shave threshold is mapped to the fine level keeping the
+        nearest number of edges, then the fine levels are replayed through the
+        usual redundant level and max fraction clustered rules.
+
+        The result approximates a run at the coarser rate: every level is the
+        clustering (and edge threshold) of the nearest fine level, not of the
+        coarse threshold itself, so the no. of levels usually matches a
+        separate run but some partitions can differ. The derived state keeps
+        the fine rate in derived_from_shave_rate and the saved label matrix
+        sidecar records it.
+        :param state: state shaved at the finest rate with level snapshots
+        :type state: ShavingState
+        :param shave_rate: coarser shave rate
+        :type shave_rate: float
+        :param prune_groups: edge slices of the fine levels
+        :type prune_groups: list[slice]
+        :return: state with the level clusters of the coarser shave rate
+        :rtype: ShavingState
+        """
+        num_pts = self.graph.num_nodes
+        num_snapshots = len(state.level_snapshots)
+
+        derived_state = ShavingState(state.min_flow, num_pts, self._state_output_dir(state.min_flow, shave_rate))
+        derived_state.derived_from_shave_rate = self.shave_rate
+        if num_snapshots == 0:
+            derived_state.build_level_clusters(self.min_shave)
+            return derived_state
+
+        fine_levels = self._coarse_shave_levels(shave_rate, prune_groups)
+        # the fine run stopped after its last snapshot, later levels are at least as clustered
+        np.minimum(fine_levels, num_snapshots - 1, out=fine_levels)
+
+        # fine levels only go down, so the snapshots are replayed once
+        snapshots = enumerate(state.snapshots())
+        snapshot_level, snapshot = next(snapshots)
+        for fine_level in fine_levels.tolist():
+            while snapshot_level < fine_level:
+                snapshot_level, snapshot = next(snapshots)
+            derived_state.record_level(snapshot, self.edge_shave_percentiles[fine_level])
+            if derived_state.num_pts_clustered / num_pts >= 1 - self.min_shave:
+                break
+        derived_state.build_level_clusters(self.min_shave)
 
-                # nbr is not dense, skip. we are only clustering connected dense nodes
-                if node2 not in self.dense_nodes:
+        print("Derived {} levels at shave rate {} for min flow {} from the nearest of {} levels at shave rate {} "
+              "(approximate)".format(len(derived_state.hierarchy), shave_rate, state.min_flow, num_snapshots,
+                                     self.shave_rate))
+
+        return derived_state
+
+    def _record_state_level(self, state, clusters, level, threshold, num_edge_kept, points_processed):
+        """
+        Records the clusters of a level in a state, reports the level and marks
+        the state done once the maximum fraction of points is clustered.
+        :param state:
+        :type state: ShavingState
+        :param clusters: cluster label of every node, 0 for background
+        :type clusters: np.ndarray
+        :param level: level number for reporting
+        :type level: int
+        :param threshold: edge similarity threshold of the level
+        :type threshold: float
+        :param num_edge_kept: no. of edges added so far
+        :type num_edge_kept: int
+        :param points_processed: True for nodes touched by the edges added so far
+        :type points_processed: np.ndarray
+        """
+        num_pts = len(points_processed)
+
+        level_status, cluster_sizes = state.record_level(clusters, threshold)
+
+        if len(self.states) > 1:
+            print("min_flow {}: ".format(state.min_flow), end='')
+        print("{}:".format(level_status), end='')
+        print("    Level: {}"
+              "    Edge: kept:{}, total:{}"
+              "    Points: processed:{}, kept: {}, total:{}"
+              "    No. of clusters: {}, cluster sizes: {}"
+              .format(level, num_edge_kept, self.num_edges,
+                      np.count_nonzero(points_processed), state.num_pts_clustered, num_pts,
+                      len(cluster_sizes), cluster_sizes))
+
+        fraction_clustered = state.num_pts_clustered / num_pts
+        if fraction_clustered >= 1 - self.min_shave:
+            print("Clustered maximum fraction data of {}, done clustering!".format(1-self.min_shave))
+            state.done = True
+
+    def _connected_components(self):
+        """
+        :return: no. of connected components, component of every node
+        :rtype: (int, np.ndarray)
+        """
+        num_pts = self.graph.num_nodes
+        adjacency = csr_matrix((np.ones(self.num_edges, dtype=np.int8), (self.graph.edge_src, self.graph.edge_dst)),
+                               shape=(num_pts, num_pts))
+        return connected_components(adjacency, directed=False)
+
+    def _component_batches(self, num_batches, node_mask=None):
+        """
+        Splits the graph's connected components into batches of about the same
+        number of edges (largest components first, each to the batch with the
+        fewest edges so far). Isolated nodes are left out as they are never
+        clustered.
+        :param num_batches: max no. of batches
+        :type num_batches: int
+        :param node_mask: only batch the components of these nodes, whole
+                          components must be masked. None for all components.
+        :type node_mask: np.ndarray | None
+        :return: sorted node IDs and sorted edge indices of each batch
+        :rtype: list[(np.ndarray, np.ndarray)]
+        """
+        num_components, node_components = self._connected_components()
+        if node_mask is not None:
+            # left out nodes go to an extra component that is never batched
+            node_components = np.where(node_mask, node_components, num_components)
+            num_components += 1
+
+        edge_components = node_components[self.graph.edge_src]
+        component_edges = np.bincount(edge_components, minlength=num_components)
+        if node_mask is not None:
+            component_edges[-1] = 0
+        components = np.flatnonzero(component_edges)
+
+        print("Found {} connected components with edges".format(len(components)))
+
+        # greedy balancing, largest components first
+        num_batches = max(1, min(num_batches, len(components)))
+        component_batches = np.full(num_components, -1, dtype=np.int64)
+        batch_edges = [(0, batch) for batch in range(num_batches)]
+        heapq.heapify(batch_edges)
+        for component in components[np.argsort(-component_edges[components], kind="stable")].tolist():
+            num_edges, batch = heapq.heappop(batch_edges)
+            component_batches[component] = batch
+            heapq.heappush(batch_edges, (num_edges + int(component_edges[component]), batch))
+
+        # stable sorts keep nodes and edges in their global order within a batch, left out nodes sort last
+        node_batches = component_batches[node_components]
+        node_batches[node_batches < 0] = num_batches
+        node_order = np.argsort(node_batches, kind="stable")
+        node_splits = np.searchsorted(node_batches[node_order], np.arange(num_batches + 1))
+        edge_batches = node_batches[self.graph.edge_src]
+        edge_order = np.argsort(edge_batches, kind="stable")
+        edge_splits = np.searchsorted(edge_batches[edge_order], np.arange(num_batches + 1))
+
+        return [(node_order[node_splits[batch]:node_splits[batch + 1]],
+                 edge_order[edge_splits[batch]:edge_splits[batch + 1]])
+                for batch in range(num_batches)]
+
+    def _hds_components(self, algo, prune_groups, num_workers, node_mask=None, base_level_changes=None):
+        """
+        Shaves the connected components in a process pool. Flows and clusters
+        never cross components, so every worker shaves a batch of components
+        through the global shave levels and reports the label changes of each
+        level. Labels are the global node ID of the cluster's root + 1, so they
+        are unique over all batches. The changes are then merged level by level
+        and recorded in the states exactly like a serial run.
+        :param algo:
+        :param prune_groups: edge slices of the levels
+        :type prune_groups: list[slice]
+        :param num_workers: no. of processes
+        :type num_workers: int
+        :param node_mask: only shave the components of these nodes, see
+                          _component_batches
+        :type node_mask: np.ndarray | None
+        :param base_level_changes: (nodes, labels) label changes of every state
+                                   and level of the nodes that are not
+                                   shaved, eg. from an earlier run
+        :type base_level_changes: list[list[list[(np.ndarray, np.ndarray)]]] | None
+        :return: (nodes, labels) label changes of every state and level, over
+                 all levels even if the states were done earlier
+        :rtype: list[list[(np.ndarray, np.ndarray)]]
+        """
+        num_pts = self.graph.num_nodes
+        num_levels = len(prune_groups)
+
+        edge_groups = np.repeat(np.arange(num_levels, dtype=np.int64),
+                                [prune_group.stop - prune_group.start for prune_group in prune_groups])
+
+        tasks = list()
+        for batch_nodes, batch_edges in self._component_batches(num_workers * 4, node_mask=node_mask):
+            if len(batch_edges) == 0:
+                continue
+            tasks.append((
+                batch_nodes,
+                np.searchsorted(batch_nodes, self.graph.edge_src[batch_edges]),
+                np.searchsorted(batch_nodes, self.graph.edge_dst[batch_edges]),
+                self.graph.edge_weights[batch_edges],
+                edge_groups[batch_edges],
+                self.node_weights[batch_nodes],
+                self.flow_dtype,
+                algo,
+                self.min_flows,
+                num_levels
+            ))
+
+        # label changes of every state by level
+        if base_level_changes is None:
+            level_changes = [[list() for _ in range(num_levels)] for _ in self.states]
+        else:
+            level_changes = base_level_changes
+
+        start_time = default_timer()
+        if tasks:
+            with Pool(min(num_workers, len(tasks))) as pool:
+                for batch_idx, batch_changes in enumerate(pool.imap_unordered(_shave_component_batch, tasks), 1):
+                    for state_idx, state_changes in enumerate(batch_changes):
+                        for level_idx, nodes, labels in state_changes:
+                            level_changes[state_idx][level_idx].append((nodes, labels))
+                    print("\tShaved {} of {} component batches ({:.2f} s cumulative)".format(
+                        batch_idx, len(tasks), default_timer() - start_time))
+
+        # level each node is first touched by an edge
+        node_first_levels = np.full(num_pts, num_levels, dtype=np.int64)
+        np.minimum.at(node_first_levels, self.graph.edge_src, edge_groups)
+        np.minimum.at(node_first_levels, self.graph.edge_dst, edge_groups)
+
+        labels = [np.zeros(num_pts, dtype=np.uint32) for _ in self.states]
+        num_edge_kept = 0
+        for edge_shave_level, prune_group in enumerate(prune_groups):
+            if all(state.done for state in self.states):
+                break
+
+            level = num_levels - edge_shave_level
+            num_edge_kept += prune_group.stop - prune_group.start
+            points_processed = node_first_levels <= edge_shave_level
+
+            for state_idx, state in enumerate(self.states):
+                if state.done:
                     continue
+                for nodes, node_labels in level_changes[state_idx][edge_shave_level]:
+                    labels[state_idx][nodes] = node_labels
+                self._record_state_level(state, labels[state_idx].copy(), level,
+                                         self.edge_shave_percentiles[edge_shave_level], num_edge_kept, points_processed)
 
-                if (node1 not in cluster_labels) and (node2 not in cluster_labels):
-                    # neither of the nodes have been encountered before
-                    # put them together in a new cluster
-                    new_label += 1
-                    cluster_points[new_label] = {node1, node2}
-                    cluster_labels[node1] = new_label
-                    cluster_labels[node2] = new_label
-
-                elif (node1 in cluster_labels) and (node2 not in cluster_labels):
-                    # add node2 to node1 cluster
-                    label = cluster_labels[node1]
-                    cluster_labels[node2] = label
-                    cluster_points[label].add(node2)
-
-                elif (node1 not in cluster_labels) and (node2 in cluster_labels):
-                    # add node1 to node2 cluster
-                    label = cluster_labels[node2]
-                    cluster_labels[node1] = label
-                    cluster_points[label].add(node1)
-
-                elif (node1 in cluster_labels) and (node2 in cluster_labels):
-                    # both are in cluster already merge the two clusters into one
-                    node1_cluster_label = cluster_labels[node1]
-                    node2_cluster_label = cluster_labels[node2]
-                    if node2_cluster_label == node1_cluster_label:
-                        # nothing to do, the points are already in the same cluster!
-                        continue
-
-                    # print("Merging cluster {} with {} points with {} with {} points".format(node1_cluster_label, len(node1_cluster_points), node2_cluster_label, len(node2_cluster_points)))
-
-                    # relabel points in node2 cluster points to node1 cluster label
-                    node2_cluster_points = cluster_points[node2_cluster_label]
-                    for node2_cluster_point in node2_cluster_points:
-                        # add the node2 points to cluster of node1
-                        cluster_labels[node2_cluster_point] = node1_cluster_label
-                        cluster_points[node1_cluster_label].add(node2_cluster_point)
-                    # remove the node2 cluster as it is merged
-                    del cluster_points[node2_cluster_label]
+        return [[_concat_changes(changes) for changes in state_changes] for state_changes in level_changes]
 
-                else:
-                    # Regardless of the data, reaching this point should be
-                    #     impossible.
-                    # All possibilities of node1 and node2 being or not being
-                    #     in cluster_labels were covered.
-                    raise AssertionError
+    def _hds_pipeline(self, algo, prune_groups, queue_depth):
+        """
+        Shaves with the flow updates and the level labeling of the states in
+        two pipelined processes. This process updates the flows of every level
+        and finds the node pairs every state merges at it (the only inputs the
+        clusters need), then queues them for a labeling process that owns the
+        states' clusters and records every level. The flows of the next levels
+        are updated while a level is labeled.
+
+        The queue holds at most queue_depth levels to cap memory. States the
+        labeling process finished are flagged in shared memory so no more
+        pairs are found for them, flow updates stop once all are done (at most
+        queue_depth + 1 levels too late). The result is the same as a serial
+        run. A timing breakdown of both stages is printed at the end.
+        :param algo:
+        :param prune_groups: edge slices of the levels
+        :type prune_groups: list[slice]
+        :param queue_depth: max no. of levels queued for labeling
+        :type queue_depth: int
+        """
+        num_pts = self.graph.num_nodes
+        num_levels = len(prune_groups)
 
-        print("cluster labeling took: {} seconds".format(default_timer()-start_time))
+        # set by the labeling process when a state is done
+        done_flags = Array("b", len(self.states))
+        level_queue = Queue(maxsize=queue_depth)
+        result_queue = Queue()
+        labeler = Process(target=_label_levels, args=(
+            self._level_recorder(self.states, self.num_edges, self.min_shave), num_pts, level_queue, result_queue,
+            done_flags))
+        labeler.start()
+
+        start_time = default_timer()
+        flow_time = 0.0
+        blocked_time = 0.0
+        num_edge_kept = 0
+        try:
+            for edge_shave_level, prune_group in enumerate(prune_groups):
+                active = [state_idx for state_idx in range(len(self.states)) if not done_flags[state_idx]]
+                if not active:
+                    break
+
+                level_start_time = default_timer()
+                active_states = [self.states[state_idx] for state_idx in active]
+                level_points_processed, flow_nodes = self._update_flow_with_next_level(prune_group, algo,
+                                                                                       active_states)
+                num_edge_kept += prune_group.stop - prune_group.start
+
+                state_pairs = [None] * len(self.states)
+                for state_idx, state in zip(active, active_states):
+                    if algo == "node":
+                        new_dense_nodes = self._update_dense_nodes(state, flow_nodes)
+                        state_pairs[state_idx] = self._node_flow_cluster_pairs(state, new_dense_nodes, prune_group)
+                    else:
+                        state_pairs[state_idx] = state.new_dense_pairs
+                flow_time += default_timer() - level_start_time
+
+                level_start_time = default_timer()
+                _put_checked(level_queue, labeler, (num_levels - edge_shave_level,
+                                                    self.edge_shave_percentiles[edge_shave_level], num_edge_kept,
+                                                    level_points_processed, state_pairs))
+                blocked_time += default_timer() - level_start_time
+
+            _put_checked(level_queue, labeler, None)
+            states, label_time, idle_time = _get_checked(result_queue, labeler)
+            labeler.join()
+        finally:
+            if labeler.is_alive():
+                labeler.terminate()
+
+        # dense nodes were only updated here
+        for state, flow_state in zip(states, self.states):
+            state.dense_nodes = flow_state.dense_nodes
+        self.states = states
+
+        wall_time = default_timer() - start_time
+        overlap = (flow_time + label_time - wall_time) / max(min(flow_time, label_time), 1e-9)
+        print("Pipeline stages: flow updates {:.2f} s (blocked on a full queue {:.2f} s), level labeling {:.2f} s "
+              "(idle {:.2f} s), wall {:.2f} s, {:.0%} of the shorter stage overlapped".format(
+                flow_time, blocked_time, label_time, idle_time, wall_time, min(max(overlap, 0.0), 1.0)))
+
+    def _shaving_snapshot(self, states):
+        """
+        :param states: states whose clustering is kept
+        :type states: list[ShavingState]
+        :return: copy of the flows and of the clustering of the states, to
+                 roll a level back with _restore_shaving_snapshot
+        :rtype: tuple
+        """
+        state_snapshots = [(state.dense_nodes.copy(), state.clusters.parent.copy(), state.clusters.rank.copy(),
+                            state.clusters.size.copy(), state.new_dense_pairs) for state in states]
+        return self.node_flows.copy(), self.nbr_fill.copy(), self.flow_graph.copy(), state_snapshots
+
+    def _restore_shaving_snapshot(self, snapshot, states):
+        """
+        :param snapshot: returned by _shaving_snapshot
+        :type snapshot: tuple
+        :param states: the states passed to _shaving_snapshot
+        :type states: list[ShavingState]
+        """
+        self.node_flows, self.nbr_fill, self.flow_graph, state_snapshots = snapshot
+        for state, (dense_nodes, parent, rank, size, new_dense_pairs) in zip(states, state_snapshots):
+            state.dense_nodes = dense_nodes
+            state.clusters.parent = parent
+            state.clusters.rank = rank
+            state.clusters.size = size
+            state.new_dense_pairs = new_dense_pairs
+
+    def _hds_adaptive(self, algo, prune_groups, coarse_shave_rate):
+        """
+        Shaves at a coarse shave rate and refines down to the levels of the
+        (finest) shave rate only where clusters change.
+
+        The levels of the coarse rate are mapped onto the fine levels and the
+        edges up to the next coarse level are added in one step. If the number
+        of points clustered or the number of clusters of any state changed in
+        the step, the flows and clusters are rolled back and the step is
+        halved, down to a single fine level. Points only join clusters and
+        clusters only merge, so a step that changes neither spans fine levels
+        that would all be redundant and only its last level is recorded.
+        Steps double again after every step without changes, up to the next
+        coarse level, so runs of changing levels are shaved level by level
+        without rollbacks. Every level saved by a fine run is recorded, with
+        the same clusters, so the hierarchy is that of a run at the fine shave
+        rate.
+        :param algo:
+        :param prune_groups: edge slices of the fine levels
+        :type prune_groups: list[slice]
+        :param coarse_shave_rate: shave rate of the first steps
+        :type coarse_shave_rate: float
+        """
+        num_pts = self.graph.num_nodes
+        num_levels = len(prune_groups)
+        all_points = np.arange(num_pts)
+
+        # fine level of every coarse level, steps never go past the next one
+        coarse_levels = np.unique(np.append(self._coarse_shave_levels(coarse_shave_rate, prune_groups),
+                                            num_levels - 1))
+
+        # (no. of points clustered, no. of clusters) of every state at the last recorded level
+        summaries = [(0, 0)] * len(self.states)
+        points_processed = np.zeros(num_pts, dtype=bool)
+        last_level = -1
+        # max no. of fine levels of the next step
+        step = num_levels
+        num_steps = 0
+        num_rollbacks = 0
+        while last_level < num_levels - 1:
+            active = [state_idx for state_idx, state in enumerate(self.states) if not state.done]
+            if not active:
+                break
+            active_states = [self.states[state_idx] for state_idx in active]
+            next_coarse_level = int(coarse_levels[np.searchsorted(coarse_levels, last_level, side="right")])
+            target = min(last_level + step, next_coarse_level)
+
+            step_in = slice(prune_groups[last_level + 1].start, prune_groups[target].stop)
+            snapshot = self._shaving_snapshot(active_states) if target - last_level > 1 else None
+            step_points_processed, flow_nodes = self._update_flow_with_next_level(step_in, algo, active_states)
+            num_steps += 1
+
+            state_clusters = list()
+            state_summaries = list()
+            for state in active_states:
+                if algo == "node":
+                    new_dense_nodes = self._update_dense_nodes(state, flow_nodes)
+                    clusters = self._compute_node_flow_clusters(state, new_dense_nodes, step_in)
+                else:
+                    clusters = self._compute_edge_flow_clusters(state)
+                state_clusters.append(clusters)
+                # labels() fully compressed the paths, so the roots are their own parents
+                state_summaries.append((
+                    np.count_nonzero(clusters),
+                    np.count_nonzero((state.clusters.parent == all_points) & (state.clusters.size >= 2))))
+            changed = any(state_summaries[active_idx] != summaries[state_idx]
+                          for active_idx, state_idx in enumerate(active))
+
+            if snapshot is not None and changed:
+                # refine: roll the step back and try the first half of it
+                self._restore_shaving_snapshot(snapshot, active_states)
+                step = (target - last_level) // 2
+                num_rollbacks += 1
+                print("Clusters changed between levels {} and {}, refining".format(
+                    num_levels - last_level - 1, num_levels - target))
+                continue
+
+            if not changed:
+                step = 2 * (target - last_level)
+            points_processed[step_points_processed] = True
+            for state_idx, state, clusters, summary in zip(active, active_states, state_clusters, state_summaries):
+                self._record_state_level(state, clusters, num_levels - target, self.edge_shave_percentiles[target],
+                                         prune_groups[target].stop, points_processed)
+                summaries[state_idx] = summary
+            last_level = target
+
+        print("Adaptive refinement: {} flow update steps ({} rolled back) over {} of {} levels at shave rate {} "
+              "starting at shave rate {}".format(num_steps, num_rollbacks, last_level + 1, num_levels, self.shave_rate,
+                                                 coarse_shave_rate))
+
+    def _build_output_states(self, prune_groups):
+        """
+        Builds the level clusters of every min flow and shave rate once
+        shaving is finished.
+        :param prune_groups: edge slices of the levels shaved
+        :type prune_groups: list[slice]
+        """
+        self.output_states = list()
+        for state in self.states:
+            for shave_rate in self.shave_rates:
+                if shave_rate == self.shave_rate:
+                    state.build_level_clusters(self.min_shave)
+                    self.output_states.append(state)
+                else:
+                    self.output_states.append(self._derive_shave_rate_state(state, shave_rate, prune_groups))
+        self.hierarchy = self.output_states[0].hierarchy
 
-        return cluster_points
+    @property
+    def level_clusters(self):
+        """
+        :return: dense levels x points matrix of the first min flow and shave
+                 rate, see ShavingState.level_clusters
+        :rtype: np.ndarray | None
+        """
+        if self.hierarchy is None:
+            return None
+        return self.hierarchy.to_dense()
 
-    def hds(self, algo):
+    def _create_states(self, keep_snapshots, stream_levels):
+        """
+        :param keep_snapshots: see ShavingState
+        :type keep_snapshots: bool
+        :param stream_levels: stream the saved levels of every state to
+                              hds_levels.bin in its output dir
+        :type stream_levels: bool
+        :return: one clustering state per min flow at the (finest) shave rate
+        :rtype: list[ShavingState]
+        """
+        states = list()
+        for min_flow in self.min_flows:
+            output_dir = self._state_output_dir(min_flow, self.shave_rate)
+            levels_file = os.path.join(output_dir, "hds_levels.bin") if stream_levels else None
+            states.append(ShavingState(min_flow, self.graph.num_nodes, output_dir, keep_snapshots=keep_snapshots,
+                                       levels_file=levels_file))
+        return states
+
+    def hds(self, algo, checkpoint_every_levels=None, checkpoint_every_seconds=None, resume=False, num_workers=None,
+            stream_levels=True, save_update_state=False, pipeline_depth=None, coarse_shave_rate=None):
         """
         Computes hierarchical density shaving on graph using the V2 algorithms
         described in the docstring of this class.
+
+        With several min_flow values one flow pass is shared by all of them and
+        every min_flow keeps its own clustering state (see ShavingState). With
+        several shave rates shaving runs at the finest one and the coarser
+        hierarchies are derived from its level snapshots, approximately (see
+        _derive_shave_rate_state).
+
+        The shaving state can be checkpointed to self.checkpoint_file every
+        checkpoint_every_levels levels and/or checkpoint_every_seconds seconds.
+        A resumed run continues after the last checkpointed level and gives
+        the same result as an uninterrupted run.
         :param algo: dense total flow node or dense flow edge based
+        :param checkpoint_every_levels: levels between checkpoints, None to
+                                        not checkpoint by levels
+        :type checkpoint_every_levels: int | None
+        :param checkpoint_every_seconds: seconds between checkpoints, None to
+                                         not checkpoint by time
+        :type checkpoint_every_seconds: float | None
+        :param resume: continue from the checkpoint if there is one
+        :type resume: bool
+        :param num_workers: if more than 1, shave the connected components in
+                            a pool of this many processes (see
+                            _hds_components), can not be checkpointed or
+                            pipelined
+        :type num_workers: int | None
+        :param stream_levels: append every saved level to hds_levels.bin in
+                              its output dir as soon as it is computed instead
+                              of keeping it in memory (see graphHDS.level_file)
+        :type stream_levels: bool
+        :param save_update_state: save the graph and the labels of every level
+                                  to self.update_state_file so the run can be
+                                  updated with new edges later (see update).
+                                  Shaves by components (in a single process
+                                  unless num_workers is more than 1), can not
+                                  be checkpointed
+        :type save_update_state: bool
+        :param pipeline_depth: if set, label the levels in a separate process
+                               pipelined with the flow updates, with at most
+                               this many levels queued (see _hds_pipeline),
+                               can not be checkpointed or shave components
+                               in parallel
+        :type pipeline_depth: int | None
+        :param coarse_shave_rate: if set, shave at this coarser rate and only
+                                  refine down to the levels of shave_rate
+                                  where clusters change (see _hds_adaptive),
+                                  saves the same levels as a run at
+                                  shave_rate. Needs a single shave rate, can
+                                  not be checkpointed
+        :type coarse_shave_rate: float | None
         :return:
         """
 
         start_time = default_timer()
 
+        if algo not in ("node", "edge"):
+            raise GraphHDSException("Unsupported algo passed: {}".format(algo))
+        if pipeline_depth is not None and pipeline_depth < 1:
+            raise ValueError("pipeline_depth must be at least 1")
+        if checkpoint_every_levels is not None and checkpoint_every_levels < 1:
+            raise ValueError("checkpoint_every_levels must be at least 1")
+        checkpointing = checkpoint_every_levels is not None or checkpoint_every_seconds is not None
+        parallel = num_workers is not None and num_workers > 1
+        if save_update_state:
+            # the update state needs the labels of all levels, which only component shaving computes
+            parallel = True
+            num_workers = max(num_workers or 1, 1)
+        pipelined = pipeline_depth is not None
+        adaptive = coarse_shave_rate is not None
+        if adaptive:
+            if not self.shave_rate < coarse_shave_rate <= 1:
+                raise ValueError("coarse_shave_rate must be above shave_rate and at most 1")
+            if len(self.shave_rates) > 1:
+                raise ValueError("adaptive refinement needs a single shave_rate")
+            if parallel or pipelined or checkpointing or resume:
+                raise ValueError("adaptive refinement can not be parallel, pipelined, checkpointed or resumed")
+        if parallel and (checkpointing or resume):
+            raise ValueError("component parallel shaving can not be checkpointed or resumed")
+        if parallel and pipelined:
+            raise ValueError("component parallel shaving can not be pipelined")
+        if pipelined and (checkpointing or resume):
+            raise ValueError("pipelined shaving can not be checkpointed or resumed")
+        if self.edge_stream is not None:
+            if parallel or pipelined or adaptive or checkpointing or resume:
+                raise ValueError("shaving a similarity graph computed on the fly can not be parallel, pipelined, "
+                                 "adaptive, checkpointed or resumed")
+            self._hds_streaming(algo, stream_levels)
+            print(" done. (time={:.2f} s)".format(default_timer() - start_time))
+            return
+
         print("Computing using Graph Auto-HDS {} Algo!".format(algo))
         # Compute edge percentile thresholds based on shaving rate.
         # A list of values
         self.edge_shave_percentiles = self._calc_edge_shave_thresholds()
 
         # Compute pruning groups for edges by edge shave thresholds.
-        # A set of edges grouped by idx into edge percentile thresholds
+        # Slices of edges grouped by idx into edge percentile thresholds
         prune_groups = self._compute_edge_prune_groups()
 
-        num_edge_kept = 0
-        num_pts = len(self.node_flows)
-        num_edges = len(self.graph)
+        num_pts = self.graph.num_nodes
         num_levels = len(prune_groups)
-        points_processed = set()
-        num_pts_clustered = None
 
-        clusters_for_saved_levels = list()
-
-        for edge_shave_level, prune_group in enumerate(prune_groups, 0):
+        # one clustering state per min flow, each saved to its own output dir if sweeping. coarser shave rates are
+        #     derived from snapshots of all levels
+        derive_shave_rates = len(self.shave_rates) > 1
+        self.states = self._create_states(derive_shave_rates, stream_levels)
+
+        if parallel:
+            for state in self.states:
+                state.start_levels_file()
+            level_changes = self._hds_components(algo, prune_groups, num_workers)
+            if save_update_state:
+                self._save_update_state(algo, level_changes)
+            first_level = num_levels
+            num_edge_kept = 0
+            points_processed = None
+        elif pipelined:
+            for state in self.states:
+                state.start_levels_file()
+            self._hds_pipeline(algo, prune_groups, pipeline_depth)
+            first_level = num_levels
+            num_edge_kept = 0
+            points_processed = None
+        elif adaptive:
+            for state in self.states:
+                state.start_levels_file()
+            self._hds_adaptive(algo, prune_groups, coarse_shave_rate)
+            first_level = num_levels
+            num_edge_kept = 0
+            points_processed = None
+        elif resume and os.path.isfile(self.checkpoint_file):
+            print("Resuming from checkpoint: {}".format(self.checkpoint_file))
+            first_level, num_edge_kept, points_processed = self._load_checkpoint(algo)
+        else:
+            if resume:
+                print("No checkpoint found at {}, starting from the first level".format(self.checkpoint_file))
+            for state in self.states:
+                state.start_levels_file()
+            first_level = 0
+            num_edge_kept = 0
+            points_processed = np.zeros(num_pts, dtype=bool)
+
+        last_checkpoint_level = first_level
+        last_checkpoint_time = default_timer()
+
+        for edge_shave_level in range(first_level, num_levels):
+            active_states = [state for state in self.states if not state.done]
+            if not active_states:
+                break
 
+            prune_group = prune_groups[edge_shave_level]
             level = num_levels - edge_shave_level
 
             # Compute flow graph using all edges above sim_eps threshold which
             #     is given by previous groups, then add the flow because of the
             #     extra edges appearing in the next group.
-            level_points_processed = self._update_flow_with_next_level(prune_group)
-
-            points_processed.update(level_points_processed)
-            num_edge_kept += len(prune_group)
-            # now threshold by min_flow and find the number of clusters
-            if algo == "node":
-                clusters = self._compute_node_flow_clusters()
-            elif algo == "edge":
-                clusters = self._compute_edge_flow_clusters()
-            else:
-                raise GraphHDSException("Unsupported algo passed: {}".format(algo))
-
-            num_clusters = len(clusters)
-            cluster_sizes = list()
-            for cluster in clusters.values():
-                cluster_sizes.append(len(cluster))
-            # track no. of points clustered in this level vs last
-            num_pts_clustered_last_level = num_pts_clustered
-            num_pts_clustered = sum(cluster_sizes)
-
-            # you need skip duplicate levels that can happen as edge shaving is not predictable w.r.t point shavings
-            if (num_pts_clustered_last_level is not None) and (num_pts_clustered == num_pts_clustered_last_level):
-                print("Redundant:", end='')
-            elif num_pts_clustered == 0:
-                print("No Clusters:", end='')
-            else:
-                clusters_for_saved_levels.append(clusters)
-                print("Clustered:", end='')
-
-            print("    Level: {}"
-                  "    Edge: kept:{}, total:{}"
-                  "    Points: processed:{}, kept: {}, total:{}"
-                  "    No. of clusters: {}, cluster sizes: {}"
-                  .format(level, num_edge_kept, num_edges,
-                          len(points_processed), num_pts_clustered, num_pts,
-                          num_clusters, cluster_sizes))
-
-            fraction_clustered = num_pts_clustered / num_pts
-            if fraction_clustered >= 1 - self.min_shave:
-                print("Clustered maximum fraction data of {}, done clustering!".format(1-self.min_shave))
-                break
+            level_points_processed, flow_nodes = self._update_flow_with_next_level(prune_group, algo, active_states)
 
-        # add a fake level if min shave is not 0 to make sure hma index are correct
-        if self.min_shave > 0.0:
-            # all points in one cluster
-            clusters = dict()
-            clusters[1] = self.get_all_nodes_set()
-            clusters_for_saved_levels.append(clusters)
+            points_processed[level_points_processed] = True
+            num_edge_kept += prune_group.stop - prune_group.start
 
-        # Initialize cluster labels for each level.
-        num_levels_saved = len(clusters_for_saved_levels)
-        self.level_clusters = np.zeros((num_levels_saved, num_pts), dtype=np.uint32)
-
-        # save clusters from all saved levels since number of points clustered increased (non redundant levels)
-        save_level = 1
-        for clusters in clusters_for_saved_levels:
-            save_level_idx = num_levels_saved - save_level
-            for cluster_id, cluster_nodes in clusters.items():
-                for node_id in cluster_nodes:
-                    self.level_clusters[save_level_idx, self.sorted_node_mapping[node_id]] = cluster_id
+            for state in active_states:
+                # now threshold by min_flow and find the number of clusters
+                if algo == "node":
+                    new_dense_nodes = self._update_dense_nodes(state, flow_nodes)
+                    clusters = self._compute_node_flow_clusters(state, new_dense_nodes, prune_group)
+                else:
+                    clusters = self._compute_edge_flow_clusters(state)
 
-            save_level += 1
+                self._record_state_level(state, clusters, level, self.edge_shave_percentiles[edge_shave_level],
+                                         num_edge_kept, points_processed)
 
+            if checkpointing and (
+                    all(state.done for state in self.states) or edge_shave_level + 1 == num_levels
+                    or (checkpoint_every_levels is not None
+                        and edge_shave_level + 1 - last_checkpoint_level >= checkpoint_every_levels)
+                    or (checkpoint_every_seconds is not None
+                        and default_timer() - last_checkpoint_time >= checkpoint_every_seconds)):
+                self._save_checkpoint(algo, edge_shave_level + 1, num_edge_kept, points_processed)
+                last_checkpoint_level = edge_shave_level + 1
+                last_checkpoint_time = default_timer()
 
+        self._build_output_states(prune_groups)
 
         # # shaving is finished as after this there is no info all clusters have merged into one
         # if num_clusters == 1 and max_level_cluster_count > 1:
@@ -714,31 +1614,694 @@ class GraphHDSV2:
         print("Auto-HDS clustering finished!")
         print(" done. (time={:.2f} s)".format(default_timer() - start_time))
 
-    def save(self, cluster_labels_file=None):
-        level_clusters = self.level_clusters
+    def _update_params(self, algo):
+        """
+        :return: run parameters an update state has to match to be updated
+        :rtype: dict
+        """
+        return {
+            "algo": algo,
+            "min_flows": self.min_flows,
+            "shave_rates": self.shave_rates,
+            "min_shave": self.min_shave,
+            "weight_scale": self.weight_scale,
+            "id_mapping": self.graph_index_file is not None,
+            "flow_dtype": self.flow_dtype.name,
+            # layout of the saved state arrays
+            "update_state_version": 1
+        }
+
+    def _save_update_state(self, algo, level_changes):
+        """
+        Saves the graph, node weights, edge shave thresholds and the label
+        changes of every level to self.update_state_file for update. The file
+        is written next to the state and then moved in place.
+        :param algo:
+        :param level_changes: (nodes, labels) label changes of every state and
+                              level, see _hds_components
+        :type level_changes: list[list[(np.ndarray, np.ndarray)]]
+        """
+        start_time = default_timer()
+
+        state_arrays = dict()
+        for state_idx, state_changes in enumerate(level_changes):
+            prefix = "state{}_".format(state_idx)
+            state_arrays[prefix + "offsets"] = np.cumsum([0] + [len(nodes) for nodes, _ in state_changes])
+            state_arrays[prefix + "points"], state_arrays[prefix + "labels"] = _concat_changes(state_changes)
+
+        if self.source_id_mappings is not None:
+            state_arrays["mapping_ids"] = np.array(list(self.source_id_mappings.keys()), dtype=np.int64)
+            state_arrays["mapping_names"] = np.array(list(self.source_id_mappings.values()), dtype=str)
+
+        tmp_file = self.update_state_file + ".tmp.npz"
+        np.savez_compressed(
+            tmp_file,
+            params=np.array(json.dumps(self._update_params(algo), sort_keys=True)),
+            edge_shave_percentiles=np.array(self.edge_shave_percentiles, dtype=np.float64),
+            node_ids=self.graph.node_ids,
+            edge_src=self.graph.edge_src,
+            edge_dst=self.graph.edge_dst,
+            edge_weights=self.graph.edge_weights,
+            node_weights=self.node_weights,
+            weight_normalizer=np.nan if self.weight_normalizer is None else self.weight_normalizer,
+            **state_arrays
+        )
+        os.replace(tmp_file, self.update_state_file)
+
+        print("Saved update state of {} points and {} edges to {} in {:.3f} seconds".format(
+            self.graph.num_nodes, self.num_edges, self.update_state_file, default_timer() - start_time))
+
+    def update(self, algo, delta_graph_file, delta_mapping_file=None, load_workers=None, num_workers=None,
+               stream_levels=True):
+        """
+        Updates the run saved to self.update_state_file (see hds
+        save_update_state) with the new nodes and edges of a delta graph,
+        instead of shaving the whole grown graph again.
+
+        Flows and clusters never cross connected components, so only the
+        components of the grown graph with a new node or edge are shaved
+        again, from the first level. Every other component keeps its saved
+        labels. The edge shave thresholds and the node weight normalization of
+        the saved run are kept, so the result is the same as shaving the grown
+        graph by components with those thresholds. Edges already in the graph
+        keep their weight (the first occurrence of an edge wins as when
+        loading a graph file), edges can not be removed.
+
+        The update state is saved again for the next update, then the output
+        states are built so save writes the updated HMA and Gene DIVER files.
+        :param algo: must be the algo of the saved run
+        :param delta_graph_file: autoHDS-G graph file of the new edges
+        :type delta_graph_file: str
+        :param delta_mapping_file: id mapping file of at least the new nodes,
+                                   needed if the saved run had an id mapping
+        :type delta_mapping_file: str | None
+        :param load_workers: number of processes parsing the delta graph file
+        :type load_workers: int | None
+        :param num_workers: number of processes shaving the components
+        :type num_workers: int | None
+        :param stream_levels: see hds
+        :type stream_levels: bool
+        """
+        start_time = default_timer()
+
+        if algo not in ("node", "edge"):
+            raise GraphHDSException("Unsupported algo passed: {}".format(algo))
+        if not os.path.isfile(self.update_state_file):
+            raise GraphHDSException("Could not find the update state of a previous run: {}, run hds with "
+                                    "save_update_state first".format(self.update_state_file))
+        if not os.path.isfile(delta_graph_file):
+            raise GraphHDSException("Could not find delta graph file: {}".format(delta_graph_file))
+
+        with np.load(self.update_state_file) as update_state:
+            params = json.loads(str(update_state["params"]))
+            if params != json.loads(json.dumps(self._update_params(algo))):
+                raise GraphHDSException("Update state {} was made with different parameters: {}, current: {}".format(
+                    self.update_state_file, params, self._update_params(algo)))
+
+            self.edge_shave_percentiles = update_state["edge_shave_percentiles"].tolist()
+            old_node_ids = update_state["node_ids"]
+            old_edge_src = update_state["edge_src"]
+            old_edge_dst = update_state["edge_dst"]
+            old_edge_weights = update_state["edge_weights"]
+            old_node_weights = update_state["node_weights"]
+            weight_normalizer = float(update_state["weight_normalizer"])
+            self.weight_normalizer = None if math.isnan(weight_normalizer) else weight_normalizer
+            if "mapping_ids" in update_state:
+                self.source_id_mappings = dict(zip(update_state["mapping_ids"].tolist(),
+                                                   update_state["mapping_names"].tolist()))
+            else:
+                self.source_id_mappings = None
+
+            old_changes = list()
+            for state_idx in range(len(self.min_flows)):
+                prefix = "state{}_".format(state_idx)
+                offsets = update_state[prefix + "offsets"]
+                points = update_state[prefix + "points"]
+                labels = update_state[prefix + "labels"]
+                old_changes.append([(points[start:end], labels[start:end])
+                                    for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())])
+
+        delta = load_array_graph(delta_graph_file, num_workers=load_workers)
+
+        # grown graph, old edges first so they keep their order (and weight) within the weight sort
+        node_ids = np.union1d(old_node_ids, delta.node_ids)
+        old_to_new = np.searchsorted(node_ids, old_node_ids)
+        delta_to_new = np.searchsorted(node_ids, delta.node_ids)
+        edge_src, edge_dst, edge_weights, _ = dedupe_edges(
+            np.concatenate((old_to_new[old_edge_src], delta_to_new[delta.edge_src])),
+            np.concatenate((old_to_new[old_edge_dst], delta_to_new[delta.edge_dst])),
+            np.concatenate((old_edge_weights, delta.edge_weights))
+        )
+        num_old_edges = len(old_edge_weights)
+        self.graph = ArrayGraph(node_ids, edge_src, edge_dst, edge_weights)
+        self.graph.sort_by_weight()
+        self._init_flow_state()
+
+        num_pts = self.graph.num_nodes
+        new_nodes = np.ones(num_pts, dtype=bool)
+        new_nodes[old_to_new] = False
+
+        print("Delta graph at: {} adds {} points and {} edges, grown graph has {} points and {} edges".format(
+            delta_graph_file, np.count_nonzero(new_nodes), self.num_edges - num_old_edges, num_pts, self.num_edges))
+
+        # new node weights and names from the delta id mapping, normalized like the saved run
+        self.node_weights = np.ones(num_pts, dtype=np.float64)
+        self.node_weights[old_to_new] = old_node_weights
+        if self.source_id_mappings is not None and new_nodes.any():
+            if delta_mapping_file is None or not os.path.isfile(delta_mapping_file):
+                raise GraphHDSException("Could not find the id mapping file of the new points: {}".format(
+                    delta_mapping_file))
+            mapping_ids, mapping_weights, mapping_names = self._read_id_mapping(delta_mapping_file)
+            self.source_id_mappings.update(zip(mapping_ids.tolist(), mapping_names))
+
+            last_rows = len(mapping_ids) - 1 - np.unique(mapping_ids[::-1], return_index=True)[1]
+            weight_ids = mapping_ids[last_rows]
+            new_node_ids = node_ids[new_nodes]
+            pos = np.searchsorted(weight_ids, new_node_ids)
+            pos[pos == len(weight_ids)] = 0
+            missing = weight_ids[pos] != new_node_ids
+            if missing.any():
+                raise GraphHDSException("Missing node id {} in id mapping file {}".format(
+                    new_node_ids[missing][0], delta_mapping_file))
+            if self.weight_normalizer is not None:
+                weights = self._scale_raw_weights(mapping_weights[last_rows])
+                self.node_weights[new_nodes] = weights[pos] / (self.weight_normalizer + 0.000000000000000000000000000001)
+
+        prune_groups = self._compute_edge_prune_groups()
+        num_levels = len(prune_groups)
+
+        # components of the grown graph with a new node or edge
+        touched = new_nodes.copy()
+        touched[edge_src[num_old_edges:]] = True
+        touched[edge_dst[num_old_edges:]] = True
+        num_components, node_components = self._connected_components()
+        touched_components = np.zeros(num_components, dtype=bool)
+        touched_components[node_components[touched]] = True
+        affected = touched_components[node_components]
+
+        # saved labels of the untouched components, in the node IDs of the grown graph
+        base_level_changes = list()
+        for state_changes in old_changes:
+            base_state_changes = list()
+            for points, labels in state_changes:
+                points = old_to_new[points]
+                labels = (old_to_new[labels.astype(np.int64) - 1] + 1).astype(np.uint32)
+                keep = ~affected[points]
+                base_state_changes.append([(points[keep], labels[keep])])
+            base_level_changes.append(base_state_changes)
+        if any(len(state_changes) != num_levels for state_changes in base_level_changes):
+            raise GraphHDSException("Update state {} does not match its edge shave thresholds".format(
+                self.update_state_file))
+
+        print("Updating {} of {} points in the components touched by the delta".format(
+            np.count_nonzero(affected), num_pts))
+
+        self.states = self._create_states(len(self.shave_rates) > 1, stream_levels)
+        for state in self.states:
+            state.start_levels_file()
+        level_changes = self._hds_components(algo, prune_groups, max(num_workers or 1, 1), node_mask=affected,
+                                             base_level_changes=base_level_changes)
+        self._save_update_state(algo, level_changes)
+        self._build_output_states(prune_groups)
+
+        print("Auto-HDS clustering updated!")
+        print(" done. (time={:.2f} s)".format(default_timer() - start_time))
+
+    def _hds_streaming(self, algo, stream_levels):
+        """
+        Shaves a similarity graph computed on the fly (see
+        load_similarity_graph). The total no. of edges is not known up front,
+        so the shave levels are spaced by the shave rate from the densest end:
+        each level keeps 1 / (1 - shave_rate) times the edges of the last one,
+        the same geometric spacing as the percentile thresholds of a full
+        graph. Edges are pulled from the edge stream in doubling batches as the
+        levels need them, so shaving stops computing similarities once the
+        maximum fraction of points is clustered.
+        :param algo: dense total flow node or dense flow edge based
+        :param stream_levels: see hds
+        :type stream_levels: bool
+        """
+        if len(self.shave_rates) > 1:
+            raise ValueError("coarser shave rates can not be derived for a similarity graph computed on the fly")
+
+        print("Computing using Graph Auto-HDS {} Algo on a similarity graph computed on the fly!".format(algo))
+
+        num_pts = self.graph.num_nodes
+        self.states = self._create_states(False, stream_levels)
+        for state in self.states:
+            state.start_levels_file()
+        self.edge_shave_percentiles = list()
+        prune_groups = list()
+
+        growth = 1.0 / (1.0 - self.shave_rate) if self.shave_rate < 1 else math.inf
+        edge_src = [self.graph.edge_src]
+        edge_dst = [self.graph.edge_dst]
+        edge_weights = [self.graph.edge_weights]
+        num_fetched = 0
+        stream_done = False
+
+        num_edge_kept = 0
+        points_processed = np.zeros(num_pts, dtype=bool)
+        edges_wanted = 1.0
+        while not all(state.done for state in self.states):
+            num_needed = math.ceil(edges_wanted) if edges_wanted < math.inf else math.inf
+
+            # edges come in complete ties, so the fetched edges always end on a whole threshold
+            if num_fetched < num_needed and not stream_done:
+                new_src, new_dst, new_weights = self.edge_stream.next_edges(max(num_needed - num_fetched, num_fetched))
+                if len(new_weights) == 0:
+                    stream_done = True
+                    continue
+
+                edge_src.append(new_src)
+                edge_dst.append(new_dst)
+                edge_weights.append(new_weights)
+                num_fetched += len(new_weights)
+
+                # new edges come last in their nodes' CSR rows, so nbr_fill stays valid
+                self.graph = ArrayGraph(self.graph.node_ids, np.concatenate(edge_src), np.concatenate(edge_dst),
+                                        np.concatenate(edge_weights), weight_sorted=True)
+                edge_src = [self.graph.edge_src]
+                edge_dst = [self.graph.edge_dst]
+                edge_weights = [self.graph.edge_weights]
+                self.num_edges = num_fetched
+                continue
+
+            group_end = min(num_needed, num_fetched)
+            if group_end <= num_edge_kept:
+                break
+
+            threshold = float(self.graph.edge_weights[group_end - 1])
+            group_end = int(np.searchsorted(-self.graph.edge_weights, -threshold, side="right"))
+            prune_group = slice(num_edge_kept, group_end)
+            self.edge_shave_percentiles.append(threshold)
+            prune_groups.append(prune_group)
+
+            level_points_processed, flow_nodes = self._update_flow_with_next_level(prune_group, algo, self.states)
+            points_processed[level_points_processed] = True
+            num_edge_kept = group_end
+
+            for state in self.states:
+                if state.done:
+                    continue
+                if algo == "node":
+                    new_dense_nodes = self._update_dense_nodes(state, flow_nodes)
+                    clusters = self._compute_node_flow_clusters(state, new_dense_nodes, prune_group)
+                else:
+                    clusters = self._compute_edge_flow_clusters(state)
+
+                self._record_state_level(state, clusters, len(prune_groups), threshold, num_edge_kept,
+                                         points_processed)
+
+            edges_wanted = max(edges_wanted * growth, num_edge_kept + 1)
+
+        print("Shaved {} levels using the {} most similar edges, down to similarity {}".format(
+            len(prune_groups), num_edge_kept, self.edge_shave_percentiles[-1] if prune_groups else None))
+
+        self._build_output_states(prune_groups)
+
+        print("Auto-HDS clustering finished!")
+
+    def _with_graph(self, graph, node_weights):
+        """
+        :return: shallow copy using the same parameters and output dirs on
+                 another in memory graph, eg. a coarsened graph or a sample
+        :rtype: GraphHDSV2
+        """
+        graph_hds = copy.copy(self)
+        graph_hds.graph = graph
+        graph_hds.node_weights = node_weights
+        graph_hds.edge_stream = None
+        graph_hds.states = None
+        graph_hds.output_states = None
+        graph_hds.hierarchy = None
+        graph_hds._init_flow_state()
+        return graph_hds
+
+    def hds_multilevel(self, algo, coarsen_levels=1, refine_passes=1, stream_levels=True):
+        """
+        Multilevel coarsen-shave-refine HDS for graphs too large to explore at
+        full resolution. The graph is coarsened coarsen_levels times by heavy
+        edge matching with summed node weights (see graphHDS.multilevel), HDS
+        runs on the coarsest graph, and its hierarchies are projected back onto
+        each finer graph, refining the cluster boundary nodes of every level.
+
+        More coarsen levels are faster and less faithful to a full resolution
+        run, more refine passes are slower and more faithful. 0 coarsen levels
+        is a plain hds run. See multilevel_report to measure the difference.
+        :param algo: dense total flow node or dense flow edge based
+        :param coarsen_levels: no. of times the graph is coarsened, each
+                               roughly halves the no. of nodes
+        :type coarsen_levels: int
+        :param refine_passes: boundary refinement passes per projection
+        :type refine_passes: int
+        :param stream_levels: see hds, the levels of the coarsest graph are
+                              streamed
+        :type stream_levels: bool
+        """
+        start_time = default_timer()
+
+        if coarsen_levels < 0:
+            raise ValueError("coarsen_levels must be at least 0")
+        if refine_passes < 0:
+            raise ValueError("refine_passes must be at least 0")
+        if self.edge_stream is not None:
+            raise ValueError("a similarity graph computed on the fly can not be coarsened")
+
+        # the edges of a level are a prefix of the edges of a weight sorted graph when refining
+        self.graph.sort_by_weight()
+
+        # graphs from the finest to the coarsest, and the coarse ids of each graph's nodes in the next one
+        graphs = [(self.graph, self.node_weights)]
+        coarsenings = list()
+        for coarsen_level in range(coarsen_levels):
+            graph, node_weights = graphs[-1]
+            coarse_ids, num_coarse = multilevel.heavy_edge_matching(graph)
+            if num_coarse == graph.num_nodes:
+                print("No more nodes could be matched, stopping coarsening at level {}".format(coarsen_level))
+                break
+
+            graphs.append(multilevel.coarsen_graph(graph, node_weights, coarse_ids, num_coarse))
+            coarsenings.append(coarse_ids)
+            print("Coarsened graph level {} to {} points and {} edges".format(
+                coarsen_level + 1, graphs[-1][0].num_nodes, graphs[-1][0].num_edges))
+
+        coarse_graph_hds = self._with_graph(*graphs[-1])
+        coarse_graph_hds.hds(algo, stream_levels=stream_levels)
+
+        self.edge_shave_percentiles = coarse_graph_hds.edge_shave_percentiles
+        self.states = coarse_graph_hds.states
+        self.output_states = coarse_graph_hds.output_states
+
+        for state in self.output_states:
+            for (fine_graph, fine_node_weights), coarse_ids in reversed(list(zip(graphs[:-1], coarsenings))):
+                state.hierarchy = multilevel.project_hierarchy(
+                    state.hierarchy, state.level_thresholds, coarse_ids, fine_graph, fine_node_weights,
+                    state.min_flow, algo, refine_passes=refine_passes
+                )
+        self.hierarchy = self.output_states[0].hierarchy
+
+        print("Multilevel Auto-HDS clustering finished!")
+        print(" done. (time={:.2f} s)".format(default_timer() - start_time))
+
+    def multilevel_report(self, algo, sample_size, coarsen_levels=1, refine_passes=1):
+        """
+        Measures how far hds_multilevel is from a full resolution hds run on a
+        connected sample of the graph. Every multilevel level is compared to
+        the full run level with the closest number of clustered points by the
+        adjusted Rand index (background counts as a cluster), for the first
+        min flow and shave rate. The report is written to
+        output dir/multilevel_report.json.
+        :param algo:
+        :param sample_size: no. of sampled points
+        :type sample_size: int
+        :param coarsen_levels: see hds_multilevel
+        :param refine_passes: see hds_multilevel
+        :return: the report
+        :rtype: dict
+        """
+        start_time = default_timer()
+
+        if self.edge_stream is not None:
+            raise ValueError("a similarity graph computed on the fly can not be sampled")
+
+        nodes = multilevel.sample_connected_nodes(self.graph, sample_size, self.random)
+        subgraph, sub_node_weights = multilevel.induced_subgraph(self.graph, self.node_weights, nodes)
+        print("Comparing multilevel and full resolution HDS on a sample of {} points and {} edges".format(
+            subgraph.num_nodes, subgraph.num_edges))
+
+        full_graph_hds = self._with_graph(subgraph, sub_node_weights)
+        full_graph_hds.hds(algo, stream_levels=False)
+        multilevel_graph_hds = self._with_graph(subgraph, sub_node_weights)
+        multilevel_graph_hds.hds_multilevel(algo, coarsen_levels=coarsen_levels, refine_passes=refine_passes,
+                                            stream_levels=False)
+
+        full_levels = full_graph_hds.level_clusters
+        multilevel_levels = multilevel_graph_hds.level_clusters
+        full_clustered = np.count_nonzero(full_levels, axis=1)
+
+        level_reports = list()
+        for level_idx, labels in enumerate(multilevel_levels):
+            num_clustered = int(np.count_nonzero(labels))
+            full_level_idx = int(np.argmin(np.abs(full_clustered - num_clustered)))
+            level_reports.append({
+                "level": level_idx,
+                "full_level": full_level_idx,
+                "points_clustered": num_clustered,
+                "full_points_clustered": int(full_clustered[full_level_idx]),
+                "ari": multilevel.adjusted_rand_index(labels, full_levels[full_level_idx])
+            })
+
+        report = {
+            "algo": algo,
+            "coarsen_levels": coarsen_levels,
+            "refine_passes": refine_passes,
+            "min_flow": self.min_flow,
+            "shave_rate": self.shave_rate,
+            "sample_points": subgraph.num_nodes,
+            "sample_edges": subgraph.num_edges,
+            "full_levels": len(full_levels),
+            "multilevel_levels": len(multilevel_levels),
+            "mean_ari": float(np.mean([level["ari"] for level in level_reports])) if level_reports else None,
+            "min_ari": float(np.min([level["ari"] for level in level_reports])) if level_reports else None,
+            "levels": level_reports
+        }
+
+        report_file = os.path.join(self.output_dir, "multilevel_report.json")
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+        print("Multilevel vs full resolution HDS on {} sampled points: mean ARI: {}, min ARI: {}, levels: {} vs {}. "
+              "Report saved to {} (time={:.2f} s)".format(report["sample_points"], report["mean_ari"],
+                                                         report["min_ari"], report["multilevel_levels"],
+                                                         report["full_levels"], report_file,
+                                                         default_timer() - start_time))
+        return report
+
+    def save(self, cluster_labels_file=None, runt_size=1, label_matrix_jsonl=True):
+        """
+        Saves the HMA, Gene DIVER files and HMA clusters by stability of every
+        min_flow and shave_rate to its output dir.
+        :param cluster_labels_file: optional sparse point labels
+        :type cluster_labels_file: str | None
+        :param runt_size: sub-clusters of at most this many points do not split
+                          an HMA cluster
+        :type runt_size: int
+        :param label_matrix_jsonl: also save the label matrix as
+                                   full_label_matrix.jsonl, one line per level
+                                   and point, next to full_label_matrix.npy
+        :type label_matrix_jsonl: bool
+        """
+        # output states are every state at every shave rate
+        for state, shave_rate in zip(self.output_states, itertools.cycle(self.shave_rates)):
+            self._save_level_clusters(state.hierarchy, state.output_dir, cluster_labels_file, shave_rate, runt_size,
+                                      level_thresholds=state.level_thresholds, label_matrix_jsonl=label_matrix_jsonl,
+                                      derived_from_shave_rate=state.derived_from_shave_rate)
+
+    def _save_level_clusters(self, hierarchy, output_dir, cluster_labels_file, shave_rate, runt_size,
+                             level_thresholds=None, label_matrix_jsonl=True, derived_from_shave_rate=None):
+        """
+        :param hierarchy: hierarchy of the internal node IDs
+        :type hierarchy: autoHDS.CompactHierarchy.CompactHierarchy
+        :param output_dir:
+        :param cluster_labels_file:
+        :param shave_rate: shave rate of the hierarchy
+        :type shave_rate: float
+        :param runt_size:
+        :type runt_size: int
+        :param level_thresholds: edge similarity threshold of every level
+        :type level_thresholds: np.ndarray | None
+        :param label_matrix_jsonl:
+        :type label_matrix_jsonl: bool
+        :param derived_from_shave_rate: finer shave rate the hierarchy was
+                                        approximated from, None for a shaved
+                                        hierarchy
+        :type derived_from_shave_rate: float | None
+        """
+        if not os.path.exists(output_dir):
+            print("Creating output dir: {}".format(output_dir))
+            os.makedirs(output_dir)
 
         # sort level_clusters
-        print("Sorting HMA Matrix, this may take some time if f ({}) is small and num points ({}) is large...".format(self.shave_rate, len(self.node_flows)))
-        sort_indices = np.lexsort(level_clusters[::-1])
+        print("Sorting HMA Matrix, this may take some time if f ({}) is small and num points ({}) is large...".format(self.shave_rate, self.graph.num_nodes))
+        sort_indices = hierarchy.lexsort_order()
 
         cluster_processor = ClusterProcessor(
-            sorted_labels=level_clusters[:, sort_indices],
-            node_map=reverse_dict(self.sorted_node_mapping),
+            sorted_labels=hierarchy.take_points(sort_indices),
+            node_map=dict(zip(self.graph.node_ids.tolist(), range(self.graph.num_nodes))),
             sort_indices=sort_indices
         )
 
-        del level_clusters
+        del hierarchy
         del sort_indices
 
-        cluster_processor.save_full_label_matrix_jsonl(
-            os.path.join(self.output_dir, "full_label_matrix.jsonl")
+        cluster_processor.save_full_label_matrix_npy(
+            os.path.join(output_dir, "full_label_matrix.npy"),
+            level_thresholds=level_thresholds,
+            shave_rate=shave_rate,
+            derived_from_shave_rate=derived_from_shave_rate
+        )
+        if label_matrix_jsonl:
+            cluster_processor.save_full_label_matrix_jsonl(
+                os.path.join(output_dir, "full_label_matrix.jsonl")
+            )
+        cluster_processor.save_full_label_matrix_hierarchy(
+            os.path.join(output_dir, "full_label_matrix.hierarchy.npz")
         )
 
         print("Saving Gene Diver compatible output...", end="", flush=True)
         start_time = default_timer()
         cluster_processor.save_genediver_data(
-            output_dir=self.output_dir,
+            output_dir=output_dir,
             point_mapping=self.source_id_mappings,
             cluster_labels_file=cluster_labels_file
         )
         print(" done. (time={:.2f} s)".format(default_timer() - start_time))
+
+        print("Saving HMA clusters by stability...", end="", flush=True)
+        start_time = default_timer()
+        num_hma_clusters = cluster_processor.save_graph_lab(
+            output_dir=output_dir,
+            point_mapping=self.source_id_mappings,
+            runt_size=runt_size,
+            shave_rate=shave_rate
+        )
+        print(" {} clusters. (time={:.2f} s)".format(num_hma_clusters, default_timer() - start_time))
+
+
+def _concat_changes(changes):
+    """
+    :param changes: (nodes, labels) label changes of a level
+    :type changes: list[(np.ndarray, np.ndarray)]
+    :return: all nodes and labels of the changes
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    if not changes:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+    return (np.concatenate([nodes for nodes, _ in changes]).astype(np.int64),
+            np.concatenate([labels for _, labels in changes]).astype(np.uint32))
+
+
+def _shave_component_batch(task):
+    """
+    Pool worker shaving a batch of connected components through the global
+    shave levels, see GraphHDSV2._hds_components.
+    :param task: (sorted global node IDs of the batch, edge src and dst as
+                 positions in the node IDs, edge weights, global level of each
+                 edge, node weights, flow dtype, algo, min flows, no. of
+                 levels), edges are in global (weight sorted) order
+    :return: for every min flow, (level, global node IDs, new labels) of each
+             level where labels changed
+    :rtype: list[list[(int, np.ndarray, np.ndarray)]]
+    """
+    node_ids, edge_src, edge_dst, edge_weights, edge_groups, node_weights, flow_dtype, algo, min_flows, num_levels = task
+
+    graph = ArrayGraph(node_ids, edge_src, edge_dst, edge_weights, weight_sorted=True)
+    num_pts = graph.num_nodes
+
+    group_starts = np.searchsorted(edge_groups, np.arange(num_levels), side="left")
+    group_ends = np.searchsorted(edge_groups, np.arange(num_levels), side="right")
+
+    state_changes = [list() for _ in min_flows]
+    # per level timings are only noise from a worker
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        graph_hds = GraphHDSV2._component_shaver(graph, node_weights, flow_dtype)
+        states = [ShavingState(min_flow, num_pts, None) for min_flow in min_flows]
+        previous_labels = [np.zeros(num_pts, dtype=np.uint32) for _ in min_flows]
+
+        # levels without edges of this batch change nothing
+        for level_idx in np.unique(edge_groups).tolist():
+            prune_group = slice(int(group_starts[level_idx]), int(group_ends[level_idx]))
+            _, flow_nodes = graph_hds._update_flow_with_next_level(prune_group, algo, states)
+
+            for state_idx, state in enumerate(states):
+                if algo == "node":
+                    new_dense_nodes = graph_hds._update_dense_nodes(state, flow_nodes)
+                    clusters = graph_hds._compute_node_flow_clusters(state, new_dense_nodes, prune_group)
+                else:
+                    clusters = graph_hds._compute_edge_flow_clusters(state)
+
+                # label of the cluster root's global node ID + 1
+                labels = np.where(clusters > 0, node_ids[np.maximum(clusters, 1) - 1] + 1, 0).astype(np.uint32)
+                changed = np.flatnonzero(labels != previous_labels[state_idx])
+                if len(changed):
+                    state_changes[state_idx].append((level_idx, node_ids[changed], labels[changed]))
+                previous_labels[state_idx] = labels
+
+    return state_changes
+
+
+def _put_checked(level_queue, labeler, item):
+    """
+    Puts an item on the labeling queue, waiting while it is full as long as
+    the labeling process is alive.
+    """
+    while True:
+        try:
+            level_queue.put(item, timeout=1.0)
+            return
+        except queue.Full:
+            if not labeler.is_alive():
+                raise GraphHDSException("Level labeling process exited with code {}".format(labeler.exitcode))
+
+
+def _get_checked(result_queue, labeler):
+    """
+    :return: the result of the labeling process, see _label_levels
+    """
+    while True:
+        try:
+            result = result_queue.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if not labeler.is_alive():
+                raise GraphHDSException("Level labeling process exited with code {}".format(labeler.exitcode))
+    if isinstance(result, str):
+        raise GraphHDSException("Level labeling process failed:\n{}".format(result))
+    return result
+
+
+def _label_levels(recorder, num_pts, level_queue, result_queue, done_flags):
+    """
+    Level labeling process of GraphHDSV2._hds_pipeline. Merges the queued
+    pairs of every level into the states' clusters and records the level
+    until the None sentinel.
+    :param recorder: see GraphHDSV2._level_recorder
+    :type recorder: GraphHDSV2
+    :param num_pts:
+    :type num_pts: int
+    :param level_queue: (level, threshold, no. of edges kept, nodes of the
+                        level's edges, pairs to merge of every state or None)
+                        of every level, then None
+    :param result_queue: gets the states, the time spent labeling and the
+                         time spent waiting for levels, or the traceback of an
+                         error
+    :param done_flags: done flag of every state, shared with the flow process
+    """
+    try:
+        points_processed = np.zeros(num_pts, dtype=bool)
+        label_time = 0.0
+        idle_time = 0.0
+        while True:
+            wait_start_time = default_timer()
+            item = level_queue.get()
+            idle_time += default_timer() - wait_start_time
+            if item is None:
+                break
+
+            label_start_time = default_timer()
+            level, threshold, num_edge_kept, level_points_processed, state_pairs = item
+            points_processed[level_points_processed] = True
+            for state_idx, (state, pairs) in enumerate(zip(recorder.states, state_pairs)):
+                if state.done or pairs is None:
+                    continue
+                state.clusters.union_pairs(*pairs)
+                recorder._record_state_level(state, state.clusters.labels(), level, threshold, num_edge_kept,
+                                             points_processed)
+                if state.done:
+                    done_flags[state_idx] = 1
+            label_time += default_timer() - label_start_time
+
+        result_queue.put((recorder.states, label_time, idle_time))
+    except BaseException:
+        result_queue.put(traceback.format_exc())
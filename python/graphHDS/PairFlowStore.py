@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import numpy as np
+
+
+class PairFlowStore:
+    """
+    Flows of node pairs (upper triangle, node ID 1 < node ID 2) as sorted
+    runs of two arrays: one integer key per pair (node ID 1 * no. of nodes +
+    node ID 2) and its flow. Every pair is in exactly one run.
+
+    Adding the flow delta of a level updates the existing pairs in place in
+    their runs and appends the new pairs as a new sorted run. Runs are merged
+    like a log-structured merge tree, the last run into the one before it
+    while it is at least half its size, so there are O(log pairs) runs and
+    every pair is merged O(log pairs) times over the whole shaving. Unlike
+    adding sparse matrices or inserting into one sorted array, a level does
+    not copy the whole flow graph.
+
+    Keys are uint32 if every pair fits, else int64, and flows are float64 or
+    float32.
+    """
+
+    def __init__(self, num_nodes, dtype=np.float64, keys=None, flows=None):
+        """
+        :param num_nodes:
+        :type num_nodes: int
+        :param dtype: flow dtype
+        :param keys: sorted pair keys to start from, eg. from a checkpoint
+        :type keys: np.ndarray | None
+        :param flows: flow of every key
+        :type flows: np.ndarray | None
+        """
+        self.num_nodes = num_nodes
+        self.dtype = np.dtype(dtype)
+        self.key_dtype = np.dtype(np.uint32) if num_nodes * num_nodes <= np.iinfo(np.uint32).max else np.dtype(np.int64)
+
+        if keys is None:
+            keys = np.zeros(0, dtype=self.key_dtype)
+            flows = np.zeros(0, dtype=self.dtype)
+        keys = np.asarray(keys, dtype=self.key_dtype)
+        flows = np.asarray(flows, dtype=self.dtype)
+
+        if len(keys) != len(flows):
+            raise ValueError("keys and flows must have the same length")
+
+        # (keys, flows) of every run, largest first
+        self.runs = [(keys, flows)] if len(keys) else list()
+
+    def __len__(self):
+        return sum(len(keys) for keys, _ in self.runs)
+
+    @property
+    def nbytes(self):
+        return sum(keys.nbytes + flows.nbytes for keys, flows in self.runs)
+
+    @property
+    def keys(self):
+        """
+        :return: sorted keys of all pairs, merges the runs into one
+        :rtype: np.ndarray
+        """
+        self._merge_runs(1)
+        return self.runs[0][0] if self.runs else np.zeros(0, dtype=self.key_dtype)
+
+    @property
+    def flows(self):
+        """
+        :return: flow of every key of keys, merges the runs into one
+        :rtype: np.ndarray
+        """
+        self._merge_runs(1)
+        return self.runs[0][1] if self.runs else np.zeros(0, dtype=self.dtype)
+
+    def copy(self):
+        """
+        :return: copy of the store, eg. to roll a level back
+        :rtype: PairFlowStore
+        """
+        store = PairFlowStore(self.num_nodes, dtype=self.dtype)
+        store.runs = [(keys.copy(), flows.copy()) for keys, flows in self.runs]
+        return store
+
+    def _merge_runs(self, max_runs=None):
+        """
+        Merges the last run into the one before it while it is at least half
+        its size, or until at most max_runs runs are left.
+        :param max_runs:
+        :type max_runs: int | None
+        """
+        while len(self.runs) > 1 and ((max_runs is not None and len(self.runs) > max_runs) or
+                                      2 * len(self.runs[-1][0]) >= len(self.runs[-2][0])):
+            last_keys, last_flows = self.runs.pop()
+            keys, flows = self.runs.pop()
+            keys = np.concatenate((keys, last_keys))
+            # the stable sort finds and merges the two sorted runs
+            order = np.argsort(keys, kind="stable")
+            self.runs.append((keys[order], np.concatenate((flows, last_flows))[order]))
+
+    def _pair_keys(self, rows, cols):
+        return np.asarray(rows, dtype=np.int64) * self.num_nodes + np.asarray(cols, dtype=np.int64)
+
+    def add(self, rows, cols, flows, min_flows=()):
+        """
+        Adds flow to pairs. Flows only increase, so every pair crosses a
+        min flow exactly once, when its flow is added to. The crossings are
+        found among the added pairs only.
+        :param rows: lower node ID of every pair, pairs must be unique
+        :type rows: np.ndarray
+        :param cols: higher node ID of every pair
+        :type cols: np.ndarray
+        :param flows: flow added to every pair
+        :type flows: np.ndarray
+        :param min_flows: min flows to detect crossings of
+        :type min_flows: collections.Iterable[float]
+        :return: for every min flow, lower and higher node IDs of the pairs
+                 whose flow reached it, sorted by lower then higher node ID
+        :rtype: list[(np.ndarray, np.ndarray)]
+        """
+        keys = self._pair_keys(rows, cols)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order].astype(self.key_dtype)
+        flows = np.asarray(flows)[order]
+
+        # update the pairs already stored in place, in whichever run they are
+        found = np.zeros(len(keys), dtype=bool)
+        old_flows = np.zeros(len(keys), dtype=self.dtype)
+        updated_flows = np.zeros(len(keys), dtype=self.dtype)
+        remaining = np.arange(len(keys))
+        for run_keys, run_flows in self.runs:
+            if len(remaining) == 0:
+                break
+            pos = np.searchsorted(run_keys, keys[remaining])
+            hit = pos < len(run_keys)
+            hit[hit] = run_keys[pos[hit]] == keys[remaining[hit]]
+            hit_idx = remaining[hit]
+            hit_pos = pos[hit]
+            old_flows[hit_idx] = run_flows[hit_pos]
+            run_flows[hit_pos] += flows[hit_idx]
+            updated_flows[hit_idx] = run_flows[hit_pos]
+            found[hit_idx] = True
+            remaining = remaining[~hit]
+
+        new = ~found
+        new_keys = keys[new]
+        new_flows = flows[new].astype(self.dtype)
+        if len(new_keys):
+            self.runs.append((new_keys, new_flows))
+            self._merge_runs()
+
+        found_keys = keys[found]
+        old_flows = old_flows[found]
+        updated_flows = updated_flows[found]
+        crossings = list()
+        for min_flow in min_flows:
+            crossed = np.sort(np.concatenate((
+                found_keys[(old_flows < min_flow) & (updated_flows >= min_flow)],
+                new_keys[new_flows >= min_flow]
+            ))).astype(np.int64)
+            crossings.append((crossed // self.num_nodes, crossed % self.num_nodes))
+        return crossings
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+import itertools
+import os
+
+import numpy as np
+
+from autoHDS.CompactHierarchy import CompactHierarchy
+from graphHDS import level_file
+from graphHDS.DisjointSet import DisjointSet
+
+
+class ShavingState:
+    """
+    Clustering state of one min_flow value during a GraphHDSV2 shaving run.
+
+    The flows computed while shaving do not depend on min_flow, only the
+    dense node / dense pair thresholding and the clustering on top of it do.
+    So a single flow pass can drive several ShavingStates, eg. to sweep
+    min_flow values, with one state per value. States can also keep snapshots
+    of every level so hierarchies of coarser shave rates can be derived from
+    a run at a fine shave rate.
+
+    Levels are kept as deltas against the previous level (the points whose
+    label changed and their new labels) since labels only change for the
+    points of merging clusters, and the final hierarchy is a CompactHierarchy.
+    With a level file the saved level deltas are appended to it as they are
+    computed instead of being kept in memory (see graphHDS.level_file).
+    """
+
+    def __init__(self, min_flow, num_pts, output_dir, keep_snapshots=False, levels_file=None):
+        """
+        :param min_flow: min flow of a dense node (node algo) or dense node
+                         pair (edge algo)
+        :type min_flow: float
+        :param num_pts: number of nodes in the graph
+        :type num_pts: int
+        :param output_dir: directory the HMA of this state is saved to
+        :type output_dir: str
+        :param keep_snapshots: keep the clusters of every level, not only the
+                               saved ones, eg. to derive coarser shave rates
+        :type keep_snapshots: bool
+        :param levels_file: level file the saved levels are streamed to, None
+                            to keep them in memory. Must be created with
+                            start_levels_file or restored from a checkpoint
+                            before the first level.
+        :type levels_file: str | None
+        """
+        self.min_flow = min_flow
+        self.output_dir = output_dir
+
+        # dense_nodes[i] is True if node i has flow >= min_flow
+        self.dense_nodes = np.zeros(num_pts, dtype=bool)
+
+        # clusters of the current level as a DisjointSet over internal node
+        #     IDs, clusters only merge going down the levels so they are kept
+        #     incrementally for the whole run
+        self.clusters = DisjointSet(num_pts)
+
+        # (node ID 1, node ID 2) of the flow graph pairs whose flow reached min_flow at the current level, set by
+        #     the edge algo's flow update
+        self.new_dense_pairs = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+        # no. of points clustered at the last level, None before the first level
+        self.num_pts_clustered = None
+
+        # (points, labels) changed by every non redundant level vs the last one, in shaving order, written to
+        #     levels_file instead if set
+        self.levels_file = levels_file
+        self.saved_level_deltas = list()
+        # cluster labels of the last saved level
+        self.last_saved_labels = np.zeros(num_pts, dtype=np.uint32)
+        # edge similarity threshold of every saved level
+        self.saved_level_thresholds = list()
+
+        # (points, labels) changed by every level vs the last one in shaving order if keep_snapshots, else None
+        self.level_snapshots = list() if keep_snapshots else None
+        # cluster labels of the last level
+        self.last_snapshot_labels = np.zeros(num_pts, dtype=np.uint32)
+
+        # True once the maximum fraction of points is clustered
+        self.done = False
+
+        # finer shave rate whose nearest levels this state was derived from, None if it was shaved itself
+        self.derived_from_shave_rate = None
+
+        # clusters at each level, not re-labeled these are converted into HMA hierarchy at the end
+        # no relabeling needed as that happens in gene diver
+        self.hierarchy = None  # CompactHierarchy
+        # edge similarity threshold of each level of the hierarchy, nan for the fake all clustered level
+        self.level_thresholds = None
+
+    @property
+    def level_clusters(self):
+        """
+        :return: dense levels x points matrix of the hierarchy, densest level
+                 last, None before build_level_clusters
+        :rtype: np.ndarray | None
+        """
+        if self.hierarchy is None:
+            return None
+        return self.hierarchy.to_dense()
+
+    @level_clusters.setter
+    def level_clusters(self, level_clusters):
+        self.hierarchy = CompactHierarchy.from_dense(level_clusters)
+
+    @staticmethod
+    def _level_delta(previous, clusters):
+        """
+        :return: points whose label changed from previous to clusters and
+                 their new labels
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        changed = np.flatnonzero(previous != clusters)
+        return changed, clusters[changed]
+
+    def snapshots(self):
+        """
+        :return: cluster labels of every level in shaving order, replayed from
+                 the snapshot deltas
+        :rtype: collections.Iterator[np.ndarray]
+        """
+        labels = np.zeros(len(self.dense_nodes), dtype=np.uint32)
+        for points, point_labels in self.level_snapshots:
+            labels[points] = point_labels
+            yield labels.copy()
+
+    def start_levels_file(self):
+        """
+        Creates an empty level file for a run from the first level.
+        """
+        if self.levels_file is not None:
+            level_file.create_level_file(self.levels_file)
+
+    def record_level(self, clusters, threshold):
+        """
+        Keeps the clusters of a level unless the level is redundant (same
+        number of points clustered as the last level) or has no clusters.
+        :param clusters: cluster label of every node, 0 for background
+        :type clusters: np.ndarray
+        :param threshold: edge similarity threshold of the level
+        :type threshold: float
+        :return: "Redundant", "No Clusters" or "Clustered", cluster sizes
+        :rtype: (str, list[int])
+        """
+        if self.level_snapshots is not None:
+            self.level_snapshots.append(self._level_delta(self.last_snapshot_labels, clusters))
+            self.last_snapshot_labels = clusters
+
+        cluster_sizes = np.unique(clusters[clusters > 0], return_counts=True)[1].tolist()
+        # track no. of points clustered in this level vs last
+        num_pts_clustered_last_level = self.num_pts_clustered
+        self.num_pts_clustered = sum(cluster_sizes)
+
+        # you need skip duplicate levels that can happen as edge shaving is not predictable w.r.t point shavings
+        if (num_pts_clustered_last_level is not None) and (self.num_pts_clustered == num_pts_clustered_last_level):
+            return "Redundant", cluster_sizes
+        elif self.num_pts_clustered == 0:
+            return "No Clusters", cluster_sizes
+
+        points, labels = self._level_delta(self.last_saved_labels, clusters)
+        if self.levels_file is None:
+            self.saved_level_deltas.append((points, labels))
+        else:
+            level_file.append_level(self.levels_file, points, labels, threshold)
+        self.last_saved_labels = clusters
+        self.saved_level_thresholds.append(threshold)
+        return "Clustered", cluster_sizes
+
+    def build_level_clusters(self, min_shave):
+        """
+        Builds the hierarchy from the saved levels, densest level last.
+        :param min_shave:
+        :type min_shave: float
+        """
+        num_pts = len(self.dense_nodes)
+        saved_level_thresholds = list(self.saved_level_thresholds)
+
+        if self.levels_file is None:
+            deltas = self.saved_level_deltas
+            num_changed = sum(len(points) for points, _ in deltas)
+        else:
+            # read back one level at a time
+            deltas = ((points, labels) for points, labels, _ in level_file.read_levels(self.levels_file))
+            num_saved_levels, num_changed = level_file.level_file_summary(self.levels_file)
+            if num_saved_levels != len(saved_level_thresholds):
+                raise ValueError("Level file {} has {} levels, expected {}".format(
+                    self.levels_file, num_saved_levels, len(saved_level_thresholds)))
+
+        # add a fake level if min shave is not 0 to make sure hma index are correct
+        if min_shave > 0.0:
+            # all points in one cluster
+            fake_delta = self._level_delta(self.last_saved_labels, np.ones(num_pts, dtype=np.uint32))
+            deltas = itertools.chain(deltas, [fake_delta])
+            num_changed += len(fake_delta[0])
+            saved_level_thresholds.append(np.nan)
+
+        # the first saved level is the densest
+        self.hierarchy = CompactHierarchy.from_delta_stream(num_pts, len(saved_level_thresholds), num_changed, deltas)
+        self.level_thresholds = np.array(saved_level_thresholds[::-1], dtype=np.float64)
+
+    @staticmethod
+    def _delta_arrays(deltas, prefix):
+        """
+        :return: level deltas as flat arrays, for np.savez
+        :rtype: dict[str, np.ndarray]
+        """
+        return {
+            prefix + "offsets": np.cumsum([0] + [len(points) for points, _ in deltas]),
+            prefix + "points": np.concatenate([points for points, _ in deltas] + [np.zeros(0, dtype=np.int64)]),
+            prefix + "labels": np.concatenate([labels for _, labels in deltas] + [np.zeros(0, dtype=np.uint32)])
+        }
+
+    @staticmethod
+    def _restore_deltas(arrays, prefix):
+        """
+        :return: level deltas from arrays returned by _delta_arrays
+        :rtype: list[(np.ndarray, np.ndarray)]
+        """
+        offsets = arrays[prefix + "offsets"].tolist()
+        points = arrays[prefix + "points"]
+        labels = arrays[prefix + "labels"]
+        return [(points[start:end], labels[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def checkpoint_arrays(self, prefix):
+        """
+        :param prefix: prefix of the array names, unique per state
+        :type prefix: str
+        :return: arrays holding the state, for np.savez
+        :rtype: dict[str, np.ndarray]
+        """
+        arrays = {
+            prefix + "dense_nodes": self.dense_nodes,
+            prefix + "cluster_parent": self.clusters.parent,
+            prefix + "cluster_rank": self.clusters.rank,
+            prefix + "cluster_size": self.clusters.size,
+            prefix + "num_pts_clustered": np.array(-1 if self.num_pts_clustered is None else self.num_pts_clustered),
+            prefix + "last_saved_labels": self.last_saved_labels,
+            prefix + "saved_level_thresholds": np.array(self.saved_level_thresholds, dtype=np.float64),
+            prefix + "done": np.array(self.done)
+        }
+        if self.levels_file is None:
+            arrays.update(self._delta_arrays(self.saved_level_deltas, prefix + "saved_level_"))
+        else:
+            arrays[prefix + "levels_file_size"] = np.array(os.path.getsize(self.levels_file))
+        if self.level_snapshots is not None:
+            arrays[prefix + "last_snapshot_labels"] = self.last_snapshot_labels
+            arrays.update(self._delta_arrays(self.level_snapshots, prefix + "snapshot_"))
+        return arrays
+
+    def restore_checkpoint_arrays(self, arrays, prefix):
+        """
+        Restores the state from arrays returned by checkpoint_arrays.
+        :param arrays: mapping of array name to array, eg. a loaded .npz
+        :param prefix:
+        :type prefix: str
+        """
+        self.dense_nodes = arrays[prefix + "dense_nodes"]
+        self.clusters.parent = arrays[prefix + "cluster_parent"]
+        self.clusters.rank = arrays[prefix + "cluster_rank"]
+        self.clusters.size = arrays[prefix + "cluster_size"]
+
+        num_pts_clustered = int(arrays[prefix + "num_pts_clustered"])
+        self.num_pts_clustered = None if num_pts_clustered < 0 else num_pts_clustered
+        if self.levels_file is None:
+            self.saved_level_deltas = self._restore_deltas(arrays, prefix + "saved_level_")
+        else:
+            # drop levels saved after the checkpoint
+            level_file.truncate_level_file(self.levels_file, int(arrays[prefix + "levels_file_size"]))
+        self.last_saved_labels = arrays[prefix + "last_saved_labels"]
+        self.saved_level_thresholds = arrays[prefix + "saved_level_thresholds"].tolist()
+        self.done = bool(arrays[prefix + "done"])
+        if self.level_snapshots is not None:
+            self.level_snapshots = self._restore_deltas(arrays, prefix + "snapshot_")
+            self.last_snapshot_labels = arrays[prefix + "last_snapshot_labels"]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Binary on-disk cache of a parsed autoHDS-G graph so repeated HDS runs on the
+same graph (eg. sweeping min flow or shave rate) don't re-parse the jsonl and
+mapping files.
+
+The cache is a directory next to the graph file holding one .npy file per
+array, so every array can be memory mapped with np.load(mmap_mode='r'), and a
+meta.json with the cache version and the size and mtime of every source file
+the cache was built from. A cache is only used if all of those still match.
+
+Cached arrays:
+* node_ids: sorted external node IDs (internal ID is the position)
+* edge_src, edge_dst, edge_weights: deduped edges in internal IDs, sorted by
+  decreasing weight (stable on input order)
+* indptr, indices, weights, edge_idx: CSR adjacency of the ArrayGraph
+* mapping_ids, mapping_weights, mapping_names: rows of the mapping file, the
+  original string IDs as one newline joined UTF-8 blob
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from graphHDS.ArrayGraph import ArrayGraph
+
+# bump whenever the layout or meaning of the cached arrays changes
+CACHE_VERSION = 1
+
+_META_FILE = "meta.json"
+_GRAPH_ARRAYS = ("node_ids", "edge_src", "edge_dst", "edge_weights", "indptr", "indices", "weights", "edge_idx")
+_MAPPING_ARRAYS = ("mapping_ids", "mapping_weights", "mapping_names")
+
+
+def cache_dir_for(graph_file):
+    """
+    :param graph_file: graph .jsonl file
+    :type graph_file: str
+    :return: cache directory of the graph file, eg. {data_name}.jsonl ->
+             {data_name}.graph_cache
+    :rtype: str
+    """
+    root, _ = os.path.splitext(graph_file)
+    return root + ".graph_cache"
+
+
+def source_signature(source_files):
+    """
+    :param source_files: files the cache is built from
+    :type source_files: list[str]
+    :return: name, size and mtime of every source file
+    :rtype: list[dict]
+    """
+    signature = list()
+    for source_file in source_files:
+        stat = os.stat(source_file)
+        signature.append({
+            "file": os.path.basename(source_file),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns
+        })
+    return signature
+
+
+def read_graph_cache(cache_dir, signature):
+    """
+    Loads a cached graph if the cache exists and is fresh. Arrays are memory
+    mapped read only.
+    :param cache_dir:
+    :type cache_dir: str
+    :param signature: source_signature() of the current source files
+    :type signature: list[dict]
+    :return: None if there is no fresh cache, else the weight sorted graph and
+             the mapping IDs, raw weights and original string IDs (None if the
+             cache was built without a mapping file)
+    :rtype: (ArrayGraph, np.ndarray | None, np.ndarray | None, list[str] | None) | None
+    """
+    meta_file = os.path.join(cache_dir, _META_FILE)
+    if not os.path.isfile(meta_file):
+        return None
+
+    with open(meta_file) as f:
+        meta = json.load(f)
+
+    if meta.get("version") != CACHE_VERSION:
+        print("Ignoring graph cache {} with version {}, expected {}".format(cache_dir, meta.get("version"),
+                                                                          CACHE_VERSION))
+        return None
+    if meta.get("sources") != signature:
+        print("Ignoring stale graph cache {}, source files changed".format(cache_dir))
+        return None
+
+    def _load(name):
+        return np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r")
+
+    arrays = {name: _load(name) for name in _GRAPH_ARRAYS}
+    graph = ArrayGraph(arrays["node_ids"], arrays["edge_src"], arrays["edge_dst"], arrays["edge_weights"],
+                       csr=(arrays["indptr"], arrays["indices"], arrays["weights"], arrays["edge_idx"]),
+                       weight_sorted=True)
+
+    if not meta["has_mapping"]:
+        return graph, None, None, None
+
+    mapping_names = _load("mapping_names").tobytes().decode("utf-8")
+    mapping_names = mapping_names.split("\n") if mapping_names else list()
+    return graph, _load("mapping_ids"), _load("mapping_weights"), mapping_names
+
+
+def write_graph_cache(cache_dir, signature, graph, mapping_ids=None, mapping_weights=None, mapping_names=None):
+    """
+    Writes the cache of a weight sorted graph. The cache is written to a
+    temporary directory first and then moved in place, so a crash never
+    leaves a half written cache behind.
+    :param cache_dir:
+    :type cache_dir: str
+    :param signature: source_signature() of the source files
+    :type signature: list[dict]
+    :param graph: graph with edges sorted by decreasing weight
+    :type graph: ArrayGraph
+    :param mapping_ids: node IDs of the mapping file rows, None if no mapping
+    :type mapping_ids: np.ndarray | None
+    :param mapping_weights: raw weights of the mapping file rows
+    :type mapping_weights: np.ndarray | None
+    :param mapping_names: original string IDs of the mapping file rows
+    :type mapping_names: list[str] | None
+    """
+    if not graph.weight_sorted:
+        raise ValueError("only weight sorted graphs can be cached")
+
+    tmp_dir = cache_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    def _save(name, array):
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(array))
+
+    for name in _GRAPH_ARRAYS:
+        _save(name, getattr(graph, name))
+
+    has_mapping = mapping_ids is not None
+    if has_mapping:
+        _save("mapping_ids", np.asarray(mapping_ids, dtype=np.int64))
+        _save("mapping_weights", np.asarray(mapping_weights, dtype=np.float64))
+        _save("mapping_names", np.frombuffer("\n".join(mapping_names).encode("utf-8"), dtype=np.uint8))
+
+    with open(os.path.join(tmp_dir, _META_FILE), "w") as f:
+        json.dump({
+            "version": CACHE_VERSION,
+            "sources": signature,
+            "has_mapping": has_mapping,
+            "num_nodes": graph.num_nodes,
+            "num_edges": graph.num_edges
+        }, f, indent=2)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Fast loaders for graph line JSON files.
+
+The file is split into byte ranges that start and end on line boundaries, and
+the ranges are parsed in a process pool. Parsed chunks come back as NumPy
+arrays and are concatenated in file order, so the result does not depend on
+the number of workers.
+
+Two formats are supported:
+* autoHDS-G graph format, one node per line:
+  {"connections": [[1, 0.5], [1241, 0.5151515151515151]], "id": 0}
+* edge format read by AutoHDSGraphConverter, one edge per line:
+  {"id1": "a", "id2": "b", "sim": 0.5}
+"""
+import json
+from multiprocessing import Pool
+import os
+import re
+from timeit import default_timer
+
+import numpy as np
+
+from graphHDS.ArrayGraph import ArrayGraph
+
+# size of the byte ranges handed to the workers
+DEFAULT_CHUNK_SIZE = 1 << 24  # 16 MiB
+
+_NON_ASCII_RE = re.compile(r'[^\x00-\x7F]+')
+
+
+def _chunk_ranges(filepath, chunk_size):
+    """
+    Splits a file into byte ranges of about chunk_size bytes that start and
+    end on line boundaries.
+    :param filepath:
+    :type filepath: str
+    :param chunk_size:
+    :type chunk_size: int
+    :return: list of (start byte, end byte)
+    :rtype: list[(int, int)]
+    """
+    file_size = os.path.getsize(filepath)
+
+    ranges = list()
+    with open(filepath, "rb") as f:
+        start = 0
+        while start < file_size:
+            f.seek(min(start + chunk_size, file_size))
+            # move the end of the chunk to the end of the line it falls in
+            f.readline()
+            end = min(f.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def _read_chunk_lines(filepath, start, end):
+    """
+    :return: the lines of the byte range [start, end)
+    :rtype: list[bytes]
+    """
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).splitlines()
+
+
+def _parse_connections_chunk(task):
+    """
+    Pool worker parsing a byte range of an autoHDS-G graph file.
+    :param task: (filepath, start byte, end byte)
+    :return: line node IDs, number of connections of each line, connection
+             node IDs, connection weights
+    :rtype: (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+    """
+    filepath, start, end = task
+
+    line_ids = list()
+    connection_counts = list()
+    connection_ids = list()
+    connection_weights = list()
+
+    for line in _read_chunk_lines(filepath, start, end):
+        if not line.strip():
+            # ignore empty line
+            continue
+
+        point_data = json.loads(line)
+        connections = point_data["connections"]
+
+        line_ids.append(point_data["id"])
+        connection_counts.append(len(connections))
+        for neighbor, weight in connections:
+            connection_ids.append(neighbor)
+            connection_weights.append(weight)
+
+    return (np.array(line_ids, dtype=np.int64),
+            np.array(connection_counts, dtype=np.int64),
+            np.array(connection_ids, dtype=np.int64),
+            np.array(connection_weights, dtype=np.float64))
+
+
+def _parse_edge_chunk(task):
+    """
+    Pool worker parsing a byte range of an edge line JSON file. Non-ASCII
+    characters are replaced by spaces and IDs are ASCII encoded.
+    :param task: (filepath, start byte, end byte, sim threshold)
+    :return: number of lines, id1 of each kept edge, id2 of each kept edge,
+             sim of each kept edge
+    :rtype: (int, list[bytes], list[bytes], list[float])
+    """
+    filepath, start, end, sim_threshold = task
+
+    num_lines = 0
+    ids1 = list()
+    ids2 = list()
+    sims = list()
+
+    for line_b in _read_chunk_lines(filepath, start, end):
+        edge_line = _NON_ASCII_RE.sub(" ", line_b.decode("utf-8", errors="ignore"))
+        num_lines += 1
+        if not edge_line.strip():
+            continue
+        edge = json.loads(edge_line)
+        try:
+            node1 = edge["id1"].encode("ascii", "ignore")
+            node2 = edge["id2"].encode("ascii", "ignore")
+            sim = edge["sim"]
+        except KeyError:
+            raise ValueError("One or more of required edge keys not found: id1, id2, sim "
+                             "in line: {} of byte range [{}, {})".format(edge_line, start, end))
+
+        # Exclude undesired edges
+        if sim < sim_threshold:
+            continue
+
+        ids1.append(node1)
+        ids2.append(node2)
+        sims.append(sim)
+
+    return num_lines, ids1, ids2, sims
+
+
+def _map_chunks(filepath, parse_chunk, task_args, num_workers, chunk_size):
+    """
+    Parses all byte ranges of a file with parse_chunk, in a process pool if
+    there is more than one range and worker. Progress is reported in bytes.
+    :param filepath:
+    :param parse_chunk: function taking (filepath, start, end, *task_args)
+    :param task_args: extra arguments passed to parse_chunk
+    :type task_args: tuple
+    :param num_workers: number of processes, defaults to the CPU count
+    :type num_workers: int | None
+    :param chunk_size:
+    :type chunk_size: int
+    :return: yields parse_chunk's result of every range, in file order
+    """
+    ranges = _chunk_ranges(filepath, chunk_size)
+    tasks = [(filepath, start, end) + tuple(task_args) for start, end in ranges]
+    file_size = os.path.getsize(filepath)
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, len(tasks)))
+
+    start_time = default_timer()
+    bytes_read = 0
+
+    def _report():
+        print("\tRead {:,} of {:,} bytes ({:.1%}) of {} ({:.2f} s cumulative)"
+              .format(bytes_read, file_size, bytes_read / file_size if file_size else 1.0, filepath,
+                      default_timer() - start_time))
+
+    if num_workers == 1:
+        for task in tasks:
+            result = parse_chunk(task)
+            bytes_read += task[2] - task[1]
+            _report()
+            yield result
+    else:
+        with Pool(num_workers) as pool:
+            for task, result in zip(tasks, pool.imap(parse_chunk, tasks)):
+                bytes_read += task[2] - task[1]
+                _report()
+                yield result
+
+
+def read_connections_graph(filepath, num_workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads an autoHDS-G graph file as flat arrays. The connections of line i
+    are connection_ids[offsets[i]:offsets[i + 1]] where offsets is the
+    cumulative sum of connection_counts starting at 0.
+    :param filepath: graph .jsonl file
+    :type filepath: str
+    :param num_workers: number of parser processes, defaults to the CPU count
+    :type num_workers: int | None
+    :param chunk_size: approximate number of bytes per parser task
+    :type chunk_size: int
+    :return: line node IDs, number of connections of each line, connection
+             node IDs, connection weights
+    :rtype: (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+    """
+    chunks = list(_map_chunks(filepath, _parse_connections_chunk, (), num_workers, chunk_size))
+    if not chunks:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
+
+    return tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+
+
+def connection_sources(line_ids, connection_counts):
+    """
+    :return: the line node ID of every connection returned by
+             read_connections_graph
+    :rtype: np.ndarray
+    """
+    return np.repeat(line_ids, connection_counts)
+
+
+def dedupe_edges(src, dst, weights, drop_self_loops=True):
+    """
+    Dedupes undirected edges, keeping the first occurrence of every edge (so
+    a->b followed by b->a keeps the weight of a->b). Edges come back with
+    src <= dst in the order of their first occurrence.
+    :param src:
+    :type src: np.ndarray
+    :param dst:
+    :type dst: np.ndarray
+    :param weights:
+    :type weights: np.ndarray
+    :param drop_self_loops: remove edges from a node to itself
+    :type drop_self_loops: bool
+    :return: src, dst, weights, number of self loop edges found
+    :rtype: (np.ndarray, np.ndarray, np.ndarray, int)
+    """
+    low = np.minimum(src, dst)
+    high = np.maximum(src, dst)
+
+    self_loops = low == high
+    num_self_loops = int(np.count_nonzero(self_loops))
+    if drop_self_loops and num_self_loops:
+        keep = ~self_loops
+        low = low[keep]
+        high = high[keep]
+        weights = weights[keep]
+
+    # contiguous IDs so a node pair fits into a single integer key
+    node_ids, inverse = np.unique(np.concatenate((low, high)), return_inverse=True)
+    low_idx, high_idx = np.split(inverse.astype(np.int64), 2)
+    pair_keys = low_idx * len(node_ids) + high_idx
+
+    _, first_idx = np.unique(pair_keys, return_index=True)
+    first_idx.sort()
+
+    return low[first_idx], high[first_idx], weights[first_idx], num_self_loops
+
+
+def load_array_graph(filepath, num_workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Loads an autoHDS-G graph file as a deduped ArrayGraph.
+    :param filepath: graph .jsonl file
+    :type filepath: str
+    :param num_workers: number of parser processes, defaults to the CPU count
+    :type num_workers: int | None
+    :param chunk_size: approximate number of bytes per parser task
+    :type chunk_size: int
+    :rtype: ArrayGraph
+    """
+    line_ids, connection_counts, connection_ids, connection_weights = read_connections_graph(
+        filepath, num_workers=num_workers, chunk_size=chunk_size
+    )
+
+    src, dst, weights, num_self_loops = dedupe_edges(
+        connection_sources(line_ids, connection_counts), connection_ids, connection_weights
+    )
+    if num_self_loops:
+        print("Warning: removed {} referenced edges to self, please fix your graph!".format(num_self_loops))
+
+    return ArrayGraph.from_external_edges(np.concatenate((line_ids, connection_ids)), src, dst, weights)
+
+
+def read_edge_lines(filepath, sim_threshold, num_workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads an edge line JSON file ({"id1": ..., "id2": ..., "sim": ...} per
+    line), keeping edges with sim >= sim_threshold.
+    :param filepath:
+    :type filepath: str
+    :param sim_threshold:
+    :type sim_threshold: float
+    :param num_workers: number of parser processes, defaults to the CPU count
+    :type num_workers: int | None
+    :param chunk_size: approximate number of bytes per parser task
+    :type chunk_size: int
+    :return: yields (number of lines, id1s, id2s, sims) of every chunk in file
+             order. IDs are ASCII encoded bytes.
+    :rtype: collections.Iterator[(int, list[bytes], list[bytes], list[float])]
+    """
+    return _map_chunks(filepath, _parse_edge_chunk, (sim_threshold,), num_workers, chunk_size)
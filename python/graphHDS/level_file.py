@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Append-only binary file of the levels saved by a GraphHDSV2 shaving run, so
+saved levels are written out as soon as they are computed instead of being
+held in memory until shaving is finished.
+
+The file starts with MAGIC followed by one record per saved level in shaving
+order (densest level first). A record is a little endian header of the no. of
+points whose label changed since the previous saved level (int64) and the
+edge similarity threshold of the level (float64), then those points (int64)
+and their new labels (uint32). Records are only ever appended, so truncating
+the file to an earlier size restores the levels saved up to then (eg. when
+resuming from a checkpoint).
+"""
+import os
+
+import numpy as np
+
+MAGIC = b"HDSLVL01"
+
+_HEADER = np.dtype([("num_changed", "<i8"), ("threshold", "<f8")])
+_POINT_DTYPE = np.dtype("<i8")
+_LABEL_DTYPE = np.dtype("<u4")
+
+
+def create_level_file(level_file):
+    """
+    Creates an empty level file, replacing any existing one.
+    :param level_file:
+    :type level_file: str
+    """
+    level_dir = os.path.dirname(level_file)
+    if level_dir and not os.path.exists(level_dir):
+        os.makedirs(level_dir)
+
+    with open(level_file, "wb") as f:
+        f.write(MAGIC)
+
+
+def append_level(level_file, points, labels, threshold):
+    """
+    :param level_file:
+    :type level_file: str
+    :param points: points whose label changed since the previous saved level
+    :type points: np.ndarray
+    :param labels: new label of each point
+    :type labels: np.ndarray
+    :param threshold: edge similarity threshold of the level
+    :type threshold: float
+    """
+    header = np.array([(len(points), threshold)], dtype=_HEADER)
+    with open(level_file, "ab") as f:
+        f.write(header.tobytes())
+        f.write(np.ascontiguousarray(points, dtype=_POINT_DTYPE).tobytes())
+        f.write(np.ascontiguousarray(labels, dtype=_LABEL_DTYPE).tobytes())
+
+
+def _open(level_file):
+    f = open(level_file, "rb")
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise ValueError("Not a level file: {}".format(level_file))
+    return f
+
+
+def read_levels(level_file):
+    """
+    Reads the levels back one record at a time.
+    :param level_file:
+    :type level_file: str
+    :return: changed points, their labels and the threshold of every saved
+             level in shaving order
+    :rtype: collections.Iterator[(np.ndarray, np.ndarray, float)]
+    """
+    with _open(level_file) as f:
+        while True:
+            header = f.read(_HEADER.itemsize)
+            if not header:
+                return
+            if len(header) < _HEADER.itemsize:
+                raise ValueError("Truncated level file: {}".format(level_file))
+
+            num_changed, threshold = np.frombuffer(header, dtype=_HEADER)[0].tolist()
+            points = np.fromfile(f, dtype=_POINT_DTYPE, count=num_changed)
+            labels = np.fromfile(f, dtype=_LABEL_DTYPE, count=num_changed)
+            if len(points) < num_changed or len(labels) < num_changed:
+                raise ValueError("Truncated level file: {}".format(level_file))
+            yield points.astype(np.int64), labels.astype(np.uint32), threshold
+
+
+def level_file_summary(level_file):
+    """
+    Counts the levels by skipping from header to header without reading any
+    points.
+    :param level_file:
+    :type level_file: str
+    :return: no. of levels, total no. of changed points
+    :rtype: (int, int)
+    """
+    num_levels = 0
+    num_changed_total = 0
+    with _open(level_file) as f:
+        while True:
+            header = f.read(_HEADER.itemsize)
+            if not header:
+                return num_levels, num_changed_total
+            if len(header) < _HEADER.itemsize:
+                raise ValueError("Truncated level file: {}".format(level_file))
+
+            num_changed = int(np.frombuffer(header, dtype=_HEADER)[0]["num_changed"])
+            f.seek(num_changed * (_POINT_DTYPE.itemsize + _LABEL_DTYPE.itemsize), os.SEEK_CUR)
+            num_levels += 1
+            num_changed_total += num_changed
+
+
+def truncate_level_file(level_file, size):
+    """
+    Drops all levels appended after the file had the given size.
+    :param level_file:
+    :type level_file: str
+    :param size: earlier size of the file in bytes
+    :type size: int
+    """
+    if not os.path.isfile(level_file) or os.path.getsize(level_file) < size:
+        raise ValueError("Level file {} is missing or shorter than {} bytes".format(level_file, size))
+
+    with open(level_file, "r+b") as f:
+        f.truncate(size)
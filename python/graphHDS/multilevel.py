@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Building blocks of multilevel graph HDS: coarsen a graph by heavy edge
+matching, shave the small coarse graph, then project the coarse hierarchy back
+onto the finer graphs, refining only the nodes on cluster boundaries.
+
+Coarse node weights are the sums of the matched node weights so coarse nodes
+carry the density of the nodes they stand for. Parallel edges between two
+coarse nodes keep the max similarity, so coarse edge weights stay similarities
+between 0 and 1.
+"""
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from autoHDS.CompactHierarchy import CompactHierarchy
+from graphHDS.ArrayGraph import ArrayGraph
+
+
+def _first_entry_order(graph):
+    """
+    :return: permutation of the CSR entries that orders every row by
+             decreasing weight, ties by edge index
+    :rtype: np.ndarray
+    """
+    if graph.weight_sorted:
+        # rows are ordered by edge index which is already by decreasing weight
+        return np.arange(len(graph.indices))
+    rows = np.repeat(np.arange(graph.num_nodes), graph.degrees())
+    return np.lexsort((graph.edge_idx, -graph.weights, rows))
+
+
+def heavy_edge_matching(graph, max_rounds=8):
+    """
+    Matches nodes along heavy edges. In every round each unmatched node
+    proposes to its heaviest unmatched nbr (ties by edge index, so both ends of
+    an edge rank it the same) and mutual proposals are matched. The heaviest
+    edge between unmatched nodes is always mutual so every round with
+    unmatched nbrs left matches at least one pair.
+    :param graph:
+    :type graph: ArrayGraph
+    :param max_rounds: max no. of proposal rounds
+    :type max_rounds: int
+    :return: coarse node ID of every node, no. of coarse nodes. Coarse IDs are
+             ordered by the lowest node ID they contain.
+    :rtype: (np.ndarray, int)
+    """
+    num_nodes = graph.num_nodes
+    order = _first_entry_order(graph)
+    rows = np.repeat(np.arange(num_nodes), graph.degrees())[order]
+    nbrs = graph.indices[order]
+
+    matched = np.full(num_nodes, -1, dtype=np.int64)
+    for _ in range(max_rounds):
+        free = matched < 0
+        candidates = free[rows] & free[nbrs]
+        if not candidates.any():
+            break
+
+        candidate_rows = rows[candidates]
+        candidate_nbrs = nbrs[candidates]
+        first = np.ones(len(candidate_rows), dtype=bool)
+        first[1:] = candidate_rows[1:] != candidate_rows[:-1]
+
+        proposals = np.full(num_nodes, -1, dtype=np.int64)
+        proposals[candidate_rows[first]] = candidate_nbrs[first]
+
+        proposers = np.flatnonzero(proposals >= 0)
+        mutual = proposers[proposals[proposals[proposers]] == proposers]
+        matched[mutual] = proposals[mutual]
+
+    representatives = np.arange(num_nodes)
+    is_matched = matched >= 0
+    representatives[is_matched] = np.minimum(representatives[is_matched], matched[is_matched])
+    unique_representatives, coarse_ids = np.unique(representatives, return_inverse=True)
+
+    return coarse_ids.astype(np.int64), len(unique_representatives)
+
+
+def coarsen_graph(graph, node_weights, coarse_ids, num_coarse):
+    """
+    Contracts the nodes of the graph into their coarse nodes.
+    :param graph:
+    :type graph: ArrayGraph
+    :param node_weights: weight of each node
+    :type node_weights: np.ndarray
+    :param coarse_ids: coarse node ID of every node
+    :type coarse_ids: np.ndarray
+    :param num_coarse: no. of coarse nodes
+    :type num_coarse: int
+    :return: weight sorted coarse graph with coarse node IDs as node IDs,
+             summed weight of each coarse node
+    :rtype: (ArrayGraph, np.ndarray)
+    """
+    src = coarse_ids[graph.edge_src]
+    dst = coarse_ids[graph.edge_dst]
+
+    # edges inside a coarse node disappear
+    keep = src != dst
+    low = np.minimum(src[keep], dst[keep])
+    high = np.maximum(src[keep], dst[keep])
+    weights = graph.edge_weights[keep]
+
+    # parallel edges keep the max similarity
+    pair_keys = low * num_coarse + high
+    order = np.lexsort((-weights, pair_keys))
+    pair_keys = pair_keys[order]
+    first = np.ones(len(pair_keys), dtype=bool)
+    first[1:] = pair_keys[1:] != pair_keys[:-1]
+    order = order[first]
+
+    coarse_graph = ArrayGraph(np.arange(num_coarse, dtype=np.int64), low[order], high[order], weights[order])
+    coarse_graph.sort_by_weight()
+
+    coarse_node_weights = np.bincount(coarse_ids, weights=node_weights, minlength=num_coarse)
+
+    return coarse_graph, coarse_node_weights
+
+
+def level_edge_counts(graph, level_thresholds):
+    """
+    :param graph: weight sorted graph
+    :type graph: ArrayGraph
+    :param level_thresholds: edge similarity threshold of every level, nan for
+                             none
+    :type level_thresholds: np.ndarray
+    :return: no. of edges of every level, the heaviest edges with a
+             similarity >= its threshold, 0 without a threshold
+    :rtype: np.ndarray
+    """
+    level_thresholds = np.asarray(level_thresholds, dtype=np.float64)
+    num_level_edges = graph.num_edges - np.searchsorted(graph.edge_weights[::-1], level_thresholds, side="left")
+    num_level_edges[np.isnan(level_thresholds)] = 0
+    return num_level_edges
+
+
+def boundary_nodes(graph, labels, num_edges):
+    """
+    :param graph: weight sorted graph
+    :type graph: ArrayGraph
+    :param labels: cluster label of every node, 0 for background
+    :type labels: np.ndarray
+    :param num_edges: no. of edges of the level, see level_edge_counts
+    :type num_edges: int
+    :return: sorted nodes with an edge of the level to a node with a different
+             label, background included
+    :rtype: np.ndarray
+    """
+    src = graph.edge_src[:num_edges]
+    dst = graph.edge_dst[:num_edges]
+    differ = labels[src] != labels[dst]
+    return np.union1d(src[differ], dst[differ])
+
+
+def refine_boundary_labels(graph, node_weights, labels, num_edges, level_degrees, min_flow, algo, passes=1):
+    """
+    Refines the projected cluster labels of one level on its boundary nodes,
+    i.e. nodes with an edge of the level (similarity >= threshold) to a node
+    with a different label, background included.
+
+    The flows of the boundary nodes are computed exactly on the fine graph
+    and they are re-clustered like in GraphHDSV2:
+    node : a boundary node is in the background unless its total flow is at
+           least min_flow, then it joins the cluster it has the most edge
+           weight to among its clustered nbrs.
+    edge : a boundary node is in the background unless it has a pair flow of
+           at least min_flow, then it joins the cluster of the clustered node
+           it has the highest such pair flow to.
+    Dense boundary nodes without a clustered nbr or pair keep their label.
+
+    Only the edges of the boundary nodes and of their nbrs (their 2 hop
+    paths) are read. Every edge of the level is compared once to find the
+    boundary, later passes only check the nodes next to a changed label.
+    :param graph: weight sorted fine graph
+    :type graph: ArrayGraph
+    :param node_weights: weight of each fine node
+    :type node_weights: np.ndarray
+    :param labels: projected cluster label of every node, 0 for background
+    :type labels: np.ndarray
+    :param num_edges: no. of edges of the level, see level_edge_counts
+    :type num_edges: int
+    :param level_degrees: no. of edges of the level at each node, the prefix
+                          of its weight sorted row
+    :type level_degrees: np.ndarray
+    :param min_flow:
+    :type min_flow: float
+    :param algo: "node" or "edge"
+    :type algo: str
+    :param passes: no. of refinement passes
+    :type passes: int
+    :return: refined labels
+    :rtype: np.ndarray
+    """
+    labels = labels.copy()
+    if num_edges == 0 or passes < 1:
+        return labels
+
+    num_nodes = graph.num_nodes
+    refine_nodes = boundary_nodes(graph, labels, num_edges)
+
+    for _ in range(passes):
+        if len(refine_nodes) == 0:
+            break
+
+        # 2 hop path weights from each boundary node to every node, weighted like the flows of GraphHDSV2
+        entry_rows, entry_nbrs, entry_weights = graph.row_prefixes(refine_nodes, level_degrees[refine_nodes])
+        nbr_nodes, entry_nbr_idx = np.unique(entry_nbrs, return_inverse=True)
+        nbr_entry_rows, nbr_entry_nbrs, nbr_entry_weights = graph.row_prefixes(nbr_nodes, level_degrees[nbr_nodes])
+        first_hops = csr_matrix((entry_weights, (entry_rows, entry_nbr_idx.reshape(-1))),
+                                shape=(len(refine_nodes), len(nbr_nodes)))
+        second_hops = csr_matrix((nbr_entry_weights, (nbr_entry_rows, nbr_entry_nbrs)),
+                                 shape=(len(nbr_nodes), num_nodes))
+        paths = (first_hops @ second_hops).tocoo()
+        not_self = refine_nodes[paths.row] != paths.col
+        pair_rows = paths.row[not_self]
+        pair_nodes = paths.col[not_self]
+        pair_flows = paths.data[not_self] * np.maximum(node_weights[refine_nodes][pair_rows], node_weights[pair_nodes])
+
+        # dense nodes without a clustered nbr to join keep their label
+        new_labels = labels[refine_nodes].copy()
+        if algo == "node":
+            node_flows = np.bincount(pair_rows, weights=pair_flows, minlength=len(refine_nodes))
+            dense = node_flows * node_weights[refine_nodes] >= min_flow
+
+            # strongest clustered nbr cluster of each dense boundary node
+            entries = labels[entry_nbrs] > 0
+            entry_rows = entry_rows[entries]
+            entry_labels = labels[entry_nbrs[entries]]
+            entry_scores = entry_weights[entries]
+        else:
+            # nodes of dense pairs are clustered
+            dense_pair_flows = pair_flows >= min_flow
+            dense = np.bincount(pair_rows[dense_pair_flows], minlength=len(refine_nodes)) > 0
+
+            # highest dense pair flow to a clustered node
+            entries = dense_pair_flows & (labels[pair_nodes] > 0)
+            entry_rows = pair_rows[entries]
+            entry_labels = labels[pair_nodes[entries]]
+            entry_scores = pair_flows[entries]
+
+        if len(entry_rows):
+            num_labels = int(entry_labels.max()) + 1
+            keys, key_idx = np.unique(entry_rows.astype(np.int64) * num_labels + entry_labels, return_inverse=True)
+            if algo == "node":
+                label_scores = np.bincount(key_idx, weights=entry_scores)
+            else:
+                label_scores = np.zeros(len(keys), dtype=np.float64)
+                np.maximum.at(label_scores, key_idx, entry_scores)
+            key_rows = keys // num_labels
+            key_labels = keys % num_labels
+
+            # best label of each boundary node, ties to the lowest label
+            order = np.lexsort((key_labels, -label_scores, key_rows))
+            best = order[np.r_[True, key_rows[order][1:] != key_rows[order][:-1]]]
+            new_labels[key_rows[best]] = key_labels[best]
+
+        new_labels[~dense] = 0
+        changed = new_labels != labels[refine_nodes]
+        if not changed.any():
+            break
+        changed_nodes = refine_nodes[changed]
+        labels[changed_nodes] = new_labels[changed]
+
+        # only the changed nodes and their nbrs can join or leave the boundary
+        _, changed_nbrs, _ = graph.row_prefixes(changed_nodes, level_degrees[changed_nodes])
+        near_nodes = np.union1d(changed_nodes, changed_nbrs)
+        near_rows, near_nbrs, _ = graph.row_prefixes(near_nodes, level_degrees[near_nodes])
+        near_boundary = near_nodes[np.unique(near_rows[labels[near_nodes[near_rows]] != labels[near_nbrs]])]
+        refine_nodes = np.union1d(np.setdiff1d(refine_nodes, near_nodes, assume_unique=True), near_boundary)
+
+    return labels
+
+
+def project_hierarchy(hierarchy, level_thresholds, coarse_ids, fine_graph, fine_node_weights, min_flow, algo,
+                      refine_passes=1):
+    """
+    Projects the hierarchy of a coarse graph onto the finer graph it was
+    coarsened from and refines the boundary nodes of every level. Levels are
+    projected and refined one at a time, from the densest, and kept as
+    transitions so no levels x fine nodes matrix is built.
+    :param hierarchy: coarse hierarchy, levels x coarse nodes
+    :type hierarchy: CompactHierarchy
+    :param level_thresholds: edge similarity threshold of each level
+    :type level_thresholds: np.ndarray
+    :param coarse_ids: coarse node ID of every fine node
+    :type coarse_ids: np.ndarray
+    :param fine_graph: weight sorted fine graph
+    :type fine_graph: ArrayGraph
+    :param fine_node_weights:
+    :type fine_node_weights: np.ndarray
+    :param min_flow:
+    :type min_flow: float
+    :param algo: "node" or "edge"
+    :type algo: str
+    :param refine_passes: no. of boundary refinement passes per level, 0 for a
+                          plain projection
+    :type refine_passes: int
+    :return: fine hierarchy, levels x fine nodes
+    :rtype: CompactHierarchy
+    """
+    if refine_passes < 1:
+        return hierarchy.take_points(coarse_ids)
+
+    num_nodes = fine_graph.num_nodes
+    num_level_edges = level_edge_counts(fine_graph, level_thresholds)
+
+    # no. of edges of the current level at each node, kept up to date with the edges added or removed from level to
+    #     level (denser levels have fewer edges)
+    level_degrees = np.zeros(num_nodes, dtype=np.int64)
+    num_edges = 0
+
+    # (points, labels) of every refined level from the densest, see CompactHierarchy.from_deltas
+    deltas = list()
+    denser_labels = None
+    for level_idx in reversed(range(hierarchy.num_levels)):
+        labels = hierarchy.level(level_idx)[coarse_ids]
+        if not np.isnan(level_thresholds[level_idx]):
+            next_num_edges = int(num_level_edges[level_idx])
+            low, high = sorted((num_edges, next_num_edges))
+            degree_delta = (np.bincount(fine_graph.edge_src[low:high], minlength=num_nodes) +
+                            np.bincount(fine_graph.edge_dst[low:high], minlength=num_nodes))
+            if next_num_edges > num_edges:
+                level_degrees += degree_delta
+            else:
+                level_degrees -= degree_delta
+            num_edges = next_num_edges
+
+            labels = refine_boundary_labels(fine_graph, fine_node_weights, labels, num_edges, level_degrees,
+                                            min_flow, algo, passes=refine_passes)
+
+        if denser_labels is None:
+            points = np.flatnonzero(labels)
+        else:
+            points = np.flatnonzero(labels != denser_labels)
+        deltas.append((points, labels[points]))
+        denser_labels = labels
+
+    return CompactHierarchy.from_deltas(num_nodes, deltas, dtype=hierarchy.labels.dtype)
+
+
+def sample_connected_nodes(graph, sample_size, random):
+    """
+    Samples nodes by breadth first search from random seed nodes so the
+    sample keeps the local structure of the graph.
+    :param graph:
+    :type graph: ArrayGraph
+    :param sample_size: no. of nodes to sample
+    :type sample_size: int
+    :param random:
+    :type random: random.Random
+    :return: sorted sampled node IDs
+    :rtype: np.ndarray
+    """
+    sample_size = min(sample_size, graph.num_nodes)
+    degrees = graph.degrees()
+    selected = np.zeros(graph.num_nodes, dtype=bool)
+    num_selected = 0
+
+    while num_selected < sample_size:
+        unselected = np.flatnonzero(~selected)
+        frontier = unselected[random.randrange(len(unselected))].reshape(1)
+        while len(frontier) and num_selected < sample_size:
+            frontier = np.unique(frontier[~selected[frontier]])[:sample_size - num_selected]
+            selected[frontier] = True
+            num_selected += len(frontier)
+            _, frontier, _ = graph.row_prefixes(frontier, degrees[frontier])
+
+    return np.flatnonzero(selected)
+
+
+def induced_subgraph(graph, node_weights, nodes):
+    """
+    :param graph:
+    :type graph: ArrayGraph
+    :param node_weights:
+    :type node_weights: np.ndarray
+    :param nodes: sorted node IDs
+    :type nodes: np.ndarray
+    :return: subgraph of the nodes (same external node IDs, edges in the
+             graph's order), weights of the nodes
+    :rtype: (ArrayGraph, np.ndarray)
+    """
+    is_selected = np.zeros(graph.num_nodes, dtype=bool)
+    is_selected[nodes] = True
+    edges = is_selected[graph.edge_src] & is_selected[graph.edge_dst]
+
+    subgraph = ArrayGraph(graph.node_ids[nodes],
+                          np.searchsorted(nodes, graph.edge_src[edges]),
+                          np.searchsorted(nodes, graph.edge_dst[edges]),
+                          graph.edge_weights[edges],
+                          weight_sorted=graph.weight_sorted)
+    return subgraph, node_weights[nodes]
+
+
+def adjusted_rand_index(labels_a, labels_b):
+    """
+    Adjusted Rand index of two labelings of the same points. The background
+    (label 0) counts as one more cluster.
+    :param labels_a:
+    :type labels_a: np.ndarray
+    :param labels_b:
+    :type labels_b: np.ndarray
+    :rtype: float
+    """
+    _, labels_a = np.unique(labels_a, return_inverse=True)
+    _, labels_b = np.unique(labels_b, return_inverse=True)
+
+    def _pairs(counts):
+        counts = counts.astype(np.float64)
+        return float((counts * (counts - 1) / 2).sum())
+
+    num_b = int(labels_b.max()) + 1 if len(labels_b) else 1
+    contingency = np.unique(labels_a.astype(np.int64) * num_b + labels_b, return_counts=True)[1]
+
+    index = _pairs(contingency)
+    pairs_a = _pairs(np.bincount(labels_a))
+    pairs_b = _pairs(np.bincount(labels_b))
+    expected_index = pairs_a * pairs_b / max(_pairs(np.array([len(labels_a)])), 1.0)
+    max_index = (pairs_a + pairs_b) / 2
+
+    if max_index == expected_index:
+        return 1.0
+    return (index - expected_index) / (max_index - expected_index)
@@ -5,6 +5,9 @@ CLI for autoHDS-G v2. See GraphHDSV2 class for more details.
 import json
 import os
 
+import numpy as np
+
+from graphHDS import similarity
 from graphHDS.GraphHDSV2 import GraphHDSV2
 from graphHDS.LSAIExperimentLogger import LSAIExperimentLogger
 
@@ -16,8 +19,16 @@ def main():  # function exists to avoid global variables
     parser.add_argument("--staging-dir", "-t", required=True)
     parser.add_argument("--no-mapping", "-m", action="store_true", help="use if {staging-dir}/{data-name}.mapping.tsv "
                                                                         "does not exist")
-    parser.add_argument("--min-flow", "-n", default=10.0, type=float)
-    parser.add_argument("--shave-rate", "-r", default=0.05, type=float)
+    parser.add_argument("--min-flow", "-n", default="10.0", help="min flow, or a comma separated list of min flows "
+                                                                "(e.g. 5,10,20,40) sharing one flow pass, each saved "
+                                                                "to {data-name}/min_flow_{value}")
+    parser.add_argument("--shave-rate", "-r", default="0.05", help="shave rate, or a comma separated list of shave "
+                                                                   "rates (e.g. 0.01,0.05,0.1). shaving runs once at "
+                                                                   "the finest rate and the coarser hierarchies are "
+                                                                   "approximated by its nearest levels (same no. of "
+                                                                   "levels, some partitions can differ from a run at "
+                                                                   "that rate), each saved to "
+                                                                   "{data-name}/shave_rate_{value}")
     parser.add_argument("--min-shave", "-f", default=0.3, type=float, help="fraction least dense data that is never "
                                                                            "clustered (stops early)")
     parser.add_argument("--seed", type=int, required=True, help="Randomization seed (e.g. 123)")
@@ -38,11 +49,108 @@ def main():  # function exists to avoid global variables
                              "cause weights to be interpreded as abs(log(weight,base) where base is value passed for this"
                              "parameter"
                         )
+    parser.add_argument("--load-workers", type=int, default=None, help="number of processes used to parse the graph "
+                                                                       "file (default: CPU count)")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the binary graph cache "
+                                                                "{staging-dir}/{data-name}.graph_cache")
+    parser.add_argument("--checkpoint-every-levels", type=int, default=None,
+                        help="save the shaving state every this many levels so the run can be resumed")
+    parser.add_argument("--checkpoint-every-seconds", type=float, default=None,
+                        help="save the shaving state every this many seconds so the run can be resumed")
+    parser.add_argument("--float32-flows", action="store_true",
+                        help="keep node and pair flows as float32 instead of float64 to halve the flow memory")
+    parser.add_argument("--hds-workers", type=int, default=None, help="shave connected components in a pool of this "
+                                                                      "many processes (no checkpointing or pipelining)")
+    parser.add_argument("--pipeline-depth", type=int, default=None,
+                        help="label the levels in a separate process while the flows of up to this many next levels "
+                             "are updated (no checkpointing or --hds-workers)")
+    parser.add_argument("--coarse-shave-rate", type=float, default=None,
+                        help="shave at this coarser rate and refine down to the shave rate only around the levels "
+                             "where clusters change, same levels as a run at the shave rate (no checkpointing)")
+    parser.add_argument("--levels-in-memory", action="store_true",
+                        help="keep the saved levels in memory instead of streaming them to "
+                             "{data-name}/hds_levels.bin as they are computed")
+    parser.add_argument("--coarsen-levels", type=int, default=0,
+                        help="multilevel mode: coarsen the graph this many times by heavy edge matching, shave the "
+                             "coarse graph and refine back. more levels are faster and less exact (default: 0, off)")
+    parser.add_argument("--refine-passes", type=int, default=1,
+                        help="multilevel mode: boundary refinement passes per projected level")
+    parser.add_argument("--multilevel-report-sample", type=int, default=None,
+                        help="multilevel mode: compare against a full resolution run on a connected sample of this "
+                             "many points, see {data-name}/multilevel_report.json")
+    parser.add_argument("--points-file", default=None,
+                        help="compute the graph on the fly from point coordinates (.npy, points x dimensions, row i "
+                             "is node id i) instead of {staging-dir}/{data-name}.jsonl, with similarity "
+                             "(1 - distance / max distance) ** power")
+    parser.add_argument("--similarity-power", type=float, default=1.0, help="points file: power of the similarity")
+    parser.add_argument("--min-similarity", type=float, default=0.0,
+                        help="points file: no edges below this similarity are computed")
+    parser.add_argument("--sparsify-top-k", type=int, default=None,
+                        help="keep only the top k heaviest edges of every node before shaving, see "
+                             "{data-name}/sparsify_report.json")
+    parser.add_argument("--sparsify-mutual", action="store_true",
+                        help="with --sparsify-top-k keep an edge only if it is in the top k of both its nodes")
+    parser.add_argument("--sparsify-hub-degree", type=int, default=None,
+                        help="sample (and reweight) the edges of nodes with more than this many edges before shaving")
+    parser.add_argument("--save-update-state", action="store_true",
+                        help="save the graph and labels of all levels to {data-name}/hds_update_state.npz so the run "
+                             "can be updated with --update-delta later (shaves by components, no checkpointing)")
+    parser.add_argument("--update-delta", default=None,
+                        help="update the run saved with --save-update-state with the new nodes and edges of this "
+                             "graph file instead of running hds, only the components it touches are shaved again")
+    parser.add_argument("--update-delta-mapping", default=None,
+                        help="id mapping file of the new nodes of --update-delta (default: the delta file with "
+                             ".mapping.tsv instead of .jsonl)")
+    parser.add_argument("--runt-size", type=int, default=1,
+                        help="HMA sub-clusters of at most this many points do not split a cluster in graph_lab.csv")
+    parser.add_argument("--no-label-matrix-jsonl", action="store_true",
+                        help="only save the label matrix as full_label_matrix.npy (and .hierarchy.npz), not as the "
+                             "one line per level and point full_label_matrix.jsonl")
+    parser.add_argument("--resume", action="store_true", help="continue hds from the last checkpoint in the "
+                                                              "output dir, if there is one")
     args = parser.parse_args()
 
+    if args.multilevel_report_sample is not None and args.coarsen_levels <= 0:
+        parser.error("--multilevel-report-sample needs --coarsen-levels")
+
+    if args.update_delta is not None:
+        # update grows the saved graph by the delta and shaves the touched components from scratch
+        ignored = [flag for flag, is_set in (
+            ("--resume", args.resume),
+            ("--checkpoint-every-levels", args.checkpoint_every_levels is not None),
+            ("--checkpoint-every-seconds", args.checkpoint_every_seconds is not None),
+            ("--pipeline-depth", args.pipeline_depth is not None),
+            ("--coarse-shave-rate", args.coarse_shave_rate is not None),
+            ("--coarsen-levels", args.coarsen_levels > 0),
+            ("--points-file", args.points_file is not None),
+            ("--sparsify-top-k", args.sparsify_top_k is not None),
+            ("--sparsify-mutual", args.sparsify_mutual),
+            ("--sparsify-hub-degree", args.sparsify_hub_degree is not None)
+        ) if is_set]
+        if ignored:
+            parser.error("--update-delta can not be used with {}".format(", ".join(ignored)))
+    elif args.coarsen_levels > 0:
+        # hds_multilevel shaves the coarsest graph in one sequential pass
+        ignored = [flag for flag, is_set in (
+            ("--resume", args.resume),
+            ("--checkpoint-every-levels", args.checkpoint_every_levels is not None),
+            ("--checkpoint-every-seconds", args.checkpoint_every_seconds is not None),
+            ("--hds-workers", args.hds_workers is not None),
+            ("--pipeline-depth", args.pipeline_depth is not None),
+            ("--coarse-shave-rate", args.coarse_shave_rate is not None),
+            ("--save-update-state", args.save_update_state),
+            ("--points-file", args.points_file is not None)
+        ) if is_set]
+        if ignored:
+            parser.error("--coarsen-levels can not be used with {}".format(", ".join(ignored)))
+
     staging_dir = os.path.expanduser(args.staging_dir)
-    min_flow = args.min_flow
-    shave_rate = args.shave_rate
+    min_flow = [float(flow) for flow in args.min_flow.split(",")]
+    if len(min_flow) == 1:
+        min_flow = min_flow[0]
+    shave_rate = [float(rate) for rate in args.shave_rate.split(",")]
+    if len(shave_rate) == 1:
+        shave_rate = shave_rate[0]
     seed = args.seed
     no_mapping = args.no_mapping
     min_shave = args.min_shave
@@ -84,22 +192,59 @@ def main():  # function exists to avoid global variables
         min_flow=min_flow,
         shave_rate=shave_rate,
         min_shave=min_shave,
-        id_mapping=not no_mapping,
-        weight_scale=weight_log_scale
+        id_mapping=not no_mapping and args.points_file is None,
+        weight_scale=weight_log_scale,
+        flow_dtype=np.float32 if args.float32_flows else np.float64
     )
-    graph_hds.load_graph()
+    # an update loads the saved graph and the delta itself
+    if args.update_delta is None:
+        if args.points_file is not None:
+            provider = similarity.EuclideanSimilarity(np.load(os.path.expanduser(args.points_file)),
+                                                      power=args.similarity_power)
+            graph_hds.load_similarity_graph(similarity.EdgeStream(provider,
+                                                                  similarity.SpatialIndexCandidates(provider),
+                                                                  min_similarity=args.min_similarity))
+        else:
+            graph_hds.load_graph(num_workers=args.load_workers, use_cache=not args.no_cache)
+        if args.sparsify_top_k is not None or args.sparsify_hub_degree is not None:
+            graph_hds.sparsify(top_k=args.sparsify_top_k, mutual=args.sparsify_mutual,
+                               hub_degree=args.sparsify_hub_degree)
 
     # run hds minus auto-hds - this should give the HMA hierarchy we can save and use in Gene DIVER
-    graph_hds.hds(algo)
+    if args.update_delta is not None:
+        update_delta = os.path.expanduser(args.update_delta)
+        update_delta_mapping = args.update_delta_mapping
+        if update_delta_mapping is None and not no_mapping:
+            update_delta_mapping = os.path.splitext(update_delta)[0] + ".mapping.tsv"
+        graph_hds.update(algo, update_delta, delta_mapping_file=update_delta_mapping, load_workers=args.load_workers,
+                         num_workers=args.hds_workers, stream_levels=not args.levels_in_memory)
+    elif args.coarsen_levels > 0:
+        if args.multilevel_report_sample is not None:
+            graph_hds.multilevel_report(algo, args.multilevel_report_sample, coarsen_levels=args.coarsen_levels,
+                                        refine_passes=args.refine_passes)
+        graph_hds.hds_multilevel(algo, coarsen_levels=args.coarsen_levels, refine_passes=args.refine_passes,
+                                 stream_levels=not args.levels_in_memory)
+    else:
+        graph_hds.hds(
+            algo,
+            checkpoint_every_levels=args.checkpoint_every_levels,
+            checkpoint_every_seconds=args.checkpoint_every_seconds,
+            resume=args.resume,
+            num_workers=args.hds_workers,
+            stream_levels=not args.levels_in_memory,
+            save_update_state=args.save_update_state,
+            pipeline_depth=args.pipeline_depth,
+            coarse_shave_rate=args.coarse_shave_rate
+        )
 
     # save output for Gene DIVER
-    graph_hds.save(cluster_labels_file)
+    graph_hds.save(cluster_labels_file, runt_size=args.runt_size, label_matrix_jsonl=not args.no_label_matrix_jsonl)
 
     exp_params_file = os.path.join(staging_dir, "experiment_params.txt")
     exp_params = {
         "runGraphHDS.seed": args.seed,
-        "runGraphHDS.shave_rate": args.shave_rate,
-        "runGraphHDS.min_flow": args.min_flow
+        "runGraphHDS.shave_rate": shave_rate,
+        "runGraphHDS.min_flow": min_flow
     }
 
     with open(exp_params_file, "a") as ef:
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+On the fly similarity graphs for GraphHDSV2, so a full graph does not have to
+be pre-produced and stored.
+
+A similarity provider computes the similarity of point pairs and a candidate
+generator returns every pair that can have at least a given similarity (eg.
+from an inverted index or a spatial index). An EdgeStream combines the two to
+produce the edges of the graph lazily in decreasing similarity order, one
+similarity band at a time, so only the edges that shaving actually reaches
+before min_shave stops it are ever computed. Similarities are cached in a
+memory bounded LRU cache since the candidates of a band include the pairs of
+all earlier bands.
+
+Providers and candidate generators implement:
+* provider.num_points: no. of points, point IDs are 0..num_points-1
+* provider.similarity(points_a, points_b): similarity of each pair, between 0
+  and 1
+* candidates.candidate_pairs(min_similarity): (points_a, points_b) with
+  points_a < points_b of a superset of the pairs with similarity >=
+  min_similarity, without duplicates
+"""
+from collections import OrderedDict
+import math
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class EuclideanSimilarity:
+    """
+    Similarity of points in a euclidean space, the same formula as
+    spatial2graph: (1 - distance / max distance) ** power. The max distance
+    defaults to the diagonal of the bounding box of the points, an upper
+    bound of the max distance between any two points, so similarities stay
+    between 0 and 1.
+    """
+
+    def __init__(self, points, power=1, max_distance=None):
+        """
+        :param points: coordinates, points x dimensions
+        :type points: np.ndarray
+        :param power:
+        :type power: float
+        :param max_distance: distance scale
+        :type max_distance: float | None
+        """
+        self.points = np.asarray(points, dtype=np.float64)
+        if self.points.ndim == 1:
+            self.points = self.points[:, None]
+        self.power = power
+
+        if max_distance is None:
+            max_distance = float(np.linalg.norm(self.points.max(axis=0) - self.points.min(axis=0)))
+        self.max_distance = max_distance if max_distance > 0 else 1.0
+
+    @property
+    def num_points(self):
+        return len(self.points)
+
+    def similarity(self, points_a, points_b):
+        """
+        :param points_a:
+        :type points_a: np.ndarray
+        :param points_b:
+        :type points_b: np.ndarray
+        :rtype: np.ndarray
+        """
+        distances = np.linalg.norm(self.points[points_a] - self.points[points_b], axis=1)
+        return np.clip(1.0 - distances / self.max_distance, 0.0, 1.0) ** self.power
+
+    def max_distance_for(self, min_similarity):
+        """
+        :return: max distance of a pair with at least min_similarity
+        :rtype: float
+        """
+        return self.max_distance * (1.0 - min_similarity ** (1.0 / self.power))
+
+
+class JaccardSimilarity:
+    """
+    Jaccard similarity of token sets, eg. the items a user interacted with.
+    """
+
+    def __init__(self, token_sets):
+        """
+        :param token_sets: tokens (hashable) of every point
+        :type token_sets: collections.Sequence[collections.Iterable]
+        """
+        self.token_sets = [frozenset(tokens) for tokens in token_sets]
+
+    @property
+    def num_points(self):
+        return len(self.token_sets)
+
+    def similarity(self, points_a, points_b):
+        """
+        :param points_a:
+        :type points_a: np.ndarray
+        :param points_b:
+        :type points_b: np.ndarray
+        :rtype: np.ndarray
+        """
+        similarities = np.zeros(len(points_a), dtype=np.float64)
+        for i, (point_a, point_b) in enumerate(zip(np.asarray(points_a).tolist(), np.asarray(points_b).tolist())):
+            tokens_a = self.token_sets[point_a]
+            tokens_b = self.token_sets[point_b]
+            num_shared = len(tokens_a & tokens_b)
+            if num_shared:
+                similarities[i] = num_shared / (len(tokens_a) + len(tokens_b) - num_shared)
+        return similarities
+
+
+class SpatialIndexCandidates:
+    """
+    Candidate pairs of a EuclideanSimilarity from a k-d tree: all pairs within
+    the distance that corresponds to the min similarity.
+    """
+
+    def __init__(self, provider):
+        """
+        :param provider:
+        :type provider: EuclideanSimilarity
+        """
+        self.provider = provider
+        self.tree = cKDTree(provider.points)
+
+    def candidate_pairs(self, min_similarity):
+        """
+        :param min_similarity:
+        :type min_similarity: float
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        pairs = self.tree.query_pairs(self.provider.max_distance_for(min_similarity), output_type="ndarray")
+        if len(pairs) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pairs = pairs.astype(np.int64)
+        return np.minimum(pairs[:, 0], pairs[:, 1]), np.maximum(pairs[:, 0], pairs[:, 1])
+
+
+class InvertedIndexCandidates:
+    """
+    Candidate pairs of a JaccardSimilarity from an inverted index with prefix
+    filtering: with tokens ordered rarest first, two sets with a Jaccard
+    similarity of at least t must share one of the first
+    len(set) - ceil(t * len(set)) + 1 tokens of each set.
+    """
+
+    def __init__(self, provider, max_posting_size=None):
+        """
+        :param provider:
+        :type provider: JaccardSimilarity
+        :param max_posting_size: tokens in more sets than this are ignored
+                                 (stop words), None to use all tokens
+        :type max_posting_size: int | None
+        """
+        self.max_posting_size = max_posting_size
+
+        # rarest tokens first, ties by first appearance so the order is deterministic
+        token_counts = dict()
+        for tokens in provider.token_sets:
+            for token in tokens:
+                token_counts[token] = token_counts.get(token, 0) + 1
+        token_ranks = {token: rank for rank, token in
+                       enumerate(sorted(token_counts, key=lambda token: token_counts[token]))}
+
+        self.ranked_sets = [np.sort(np.array([token_ranks[token] for token in tokens], dtype=np.int64))
+                            for tokens in provider.token_sets]
+        self.token_counts = np.zeros(len(token_ranks), dtype=np.int64)
+        for token, rank in token_ranks.items():
+            self.token_counts[rank] = token_counts[token]
+
+    def candidate_pairs(self, min_similarity):
+        """
+        :param min_similarity:
+        :type min_similarity: float
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        prefix_points = list()
+        prefix_tokens = list()
+        for point, ranked_tokens in enumerate(self.ranked_sets):
+            num_tokens = len(ranked_tokens)
+            prefix_length = num_tokens - int(math.ceil(min_similarity * num_tokens)) + 1
+            prefix = ranked_tokens[:max(0, min(prefix_length, num_tokens))]
+            prefix_points.append(np.full(len(prefix), point, dtype=np.int64))
+            prefix_tokens.append(prefix)
+
+        if not prefix_points:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        prefix_points = np.concatenate(prefix_points)
+        prefix_tokens = np.concatenate(prefix_tokens)
+
+        if self.max_posting_size is not None:
+            common = self.token_counts[prefix_tokens] > self.max_posting_size
+            prefix_points = prefix_points[~common]
+            prefix_tokens = prefix_tokens[~common]
+
+        # postings of every token, points in increasing order
+        order = np.lexsort((prefix_points, prefix_tokens))
+        prefix_points = prefix_points[order]
+        posting_starts = np.flatnonzero(np.r_[True, prefix_tokens[order][1:] != prefix_tokens[order][:-1]])
+        posting_ends = np.r_[posting_starts[1:], len(prefix_points)]
+
+        points_a = list()
+        points_b = list()
+        for start, end in zip(posting_starts.tolist(), posting_ends.tolist()):
+            if end - start < 2:
+                continue
+            pair_a, pair_b = np.triu_indices(end - start, k=1)
+            points_a.append(prefix_points[start + pair_a])
+            points_b.append(prefix_points[start + pair_b])
+
+        if not points_a:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # dedupe pairs sharing several prefix tokens
+        num_points = len(self.ranked_sets)
+        pair_keys = np.unique(np.concatenate(points_a) * num_points + np.concatenate(points_b))
+        return pair_keys // num_points, pair_keys % num_points
+
+
+class SimilarityCache:
+    """
+    LRU cache of pair similarities bounded by an estimate of its memory use.
+    """
+
+    # estimated memory of one cached pair in a python OrderedDict
+    BYTES_PER_ENTRY = 120
+
+    def __init__(self, provider, max_bytes=1 << 30):
+        """
+        :param provider: similarity provider
+        :param max_bytes: memory bound of the cache
+        :type max_bytes: int
+        """
+        self.provider = provider
+        self.max_entries = max(1, max_bytes // SimilarityCache.BYTES_PER_ENTRY)
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def similarity(self, points_a, points_b):
+        """
+        :param points_a:
+        :type points_a: np.ndarray
+        :param points_b:
+        :type points_b: np.ndarray
+        :return: similarity of each pair, from the cache when possible
+        :rtype: np.ndarray
+        """
+        num_points = self.provider.num_points
+        pair_keys = (np.asarray(points_a, dtype=np.int64) * num_points + np.asarray(points_b, dtype=np.int64)).tolist()
+
+        similarities = np.zeros(len(pair_keys), dtype=np.float64)
+        missing = list()
+        for i, pair_key in enumerate(pair_keys):
+            cached = self.cache.get(pair_key)
+            if cached is None:
+                missing.append(i)
+            else:
+                self.cache.move_to_end(pair_key)
+                similarities[i] = cached
+
+        self.hits += len(pair_keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            missing = np.array(missing, dtype=np.int64)
+            similarities[missing] = self.provider.similarity(np.asarray(points_a)[missing],
+                                                             np.asarray(points_b)[missing])
+            for i, similarity in zip(missing.tolist(), similarities[missing].tolist()):
+                self.cache[pair_keys[i]] = similarity
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+        return similarities
+
+
+class EdgeStream:
+    """
+    Lazily produces the edges of a similarity graph in decreasing similarity
+    order (ties by point IDs). Edges are computed one similarity band at a
+    time, [floor, previous floor), lowering the floor by band_step until
+    min_similarity is reached, so all edges of a band are at most as similar
+    as every edge produced before.
+    """
+
+    def __init__(self, provider, candidates, min_similarity=0.0, band_step=0.05, cache_bytes=1 << 30):
+        """
+        :param provider: similarity provider
+        :param candidates: candidate pair generator
+        :param min_similarity: no edges below this similarity are produced,
+                               analogous to the threshold of a pre-produced
+                               graph
+        :type min_similarity: float
+        :param band_step: similarity width of a band
+        :type band_step: float
+        :param cache_bytes: memory bound of the similarity cache
+        :type cache_bytes: int
+        """
+        if not 0 < band_step <= 1:
+            raise ValueError("band_step must be between 0 and 1")
+
+        self.provider = provider
+        self.candidates = candidates
+        self.min_similarity = min_similarity
+        self.band_step = band_step
+        self.cache = SimilarityCache(provider, max_bytes=cache_bytes)
+
+        # similarity floor of the bands computed so far, edges >= floor are all known
+        self.floor = None
+        self._num_bands = 0
+        self.exhausted = False
+        # computed edges not produced yet, in decreasing similarity order
+        self._buffer = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
+
+    @property
+    def num_points(self):
+        return self.provider.num_points
+
+    def _next_band(self):
+        """
+        Computes the edges of the next similarity band into the buffer.
+        """
+        ceiling = self.floor
+        # floors are computed from the band no. so rounding errors don't add up
+        self._num_bands += 1
+        floor = max(1.0 - self._num_bands * self.band_step, self.min_similarity)
+        self.floor = floor
+        if floor <= self.min_similarity:
+            self.exhausted = True
+
+        points_a, points_b = self.candidates.candidate_pairs(floor)
+        similarities = self.cache.similarity(points_a, points_b)
+
+        in_band = similarities >= floor
+        if ceiling is not None:
+            in_band &= similarities < ceiling
+        points_a = points_a[in_band]
+        points_b = points_b[in_band]
+        similarities = similarities[in_band]
+
+        order = np.lexsort((points_b, points_a, -similarities))
+        buffered_a, buffered_b, buffered_similarities = self._buffer
+        self._buffer = (np.concatenate((buffered_a, points_a[order])),
+                        np.concatenate((buffered_b, points_b[order])),
+                        np.concatenate((buffered_similarities, similarities[order])))
+
+        print("Computed {} edges with similarity in [{:.4f}, {}) from {} candidate pairs (cache hits: {}, "
+              "misses: {})".format(len(order), floor, "{:.4f}".format(ceiling) if ceiling is not None else "1",
+                                   len(in_band), self.cache.hits, self.cache.misses))
+
+    def next_edges(self, num_edges):
+        """
+        :param num_edges: max no. of edges to produce
+        :type num_edges: int
+        :return: the next edges (points_a < points_b), fewer than num_edges
+                 only if the stream is exhausted. All edges with the
+                 similarity of the last edge are included, so there can also
+                 be more.
+        :rtype: (np.ndarray, np.ndarray, np.ndarray)
+        """
+        while not self.exhausted and len(self._buffer[2]) <= num_edges:
+            self._next_band()
+
+        buffered_a, buffered_b, buffered_similarities = self._buffer
+        end = min(num_edges, len(buffered_similarities))
+        if end > 0:
+            # include ties of the last edge, those are all buffered as bands split at similarity values
+            end = int(np.searchsorted(-buffered_similarities, -buffered_similarities[end - 1], side="right"))
+
+        self._buffer = (buffered_a[end:], buffered_b[end:], buffered_similarities[end:])
+        return buffered_a[:end], buffered_b[:end], buffered_similarities[:end]
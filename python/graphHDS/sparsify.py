@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Degree bounding of a graph before shaving. The flow added by the edges of a
+shaving level grows with the sum of squared node degrees (every 2 hop path
+through a node is a flow term), so a few hub nodes can dominate the runtime
+and the size of the flow graph. Edges can be sparsified by keeping the top k
+edges of every node by weight (symmetrized by union or mutual kNN), or by
+sampling the edges of hub nodes and reweighting the sampled edges by their
+inverse sampling probability so expected weighted degrees are mostly kept.
+
+sparsification_report measures how much the sum of squared degrees dropped
+and estimates the impact on node flows from the 2 hop path weights of every
+node (the node flows of the full graph without node weights).
+"""
+import numpy as np
+from scipy.stats import spearmanr
+
+from graphHDS.ArrayGraph import ArrayGraph
+
+
+def top_k_edges(graph, k, mutual=False):
+    """
+    :param graph:
+    :type graph: ArrayGraph
+    :param k: no. of heaviest edges kept per node, ties by edge index
+    :type k: int
+    :param mutual: keep an edge only if it is in the top k of both its nodes
+                   (mutual kNN), else if it is in the top k of either one
+    :type mutual: bool
+    :return: True for every kept edge
+    :rtype: np.ndarray
+    """
+    if k < 1:
+        raise ValueError("k must be at least 1")
+
+    degrees = graph.degrees()
+    rows = np.repeat(np.arange(graph.num_nodes), degrees)
+    order = np.lexsort((graph.edge_idx, -graph.weights, rows))
+
+    # rank of every entry within its row, entries are still grouped by row
+    ranks = np.arange(len(order)) - graph.indptr[rows]
+    top_edges = graph.edge_idx[order][ranks < k]
+
+    # no. of nodes that have the edge in their top k
+    num_tops = np.bincount(top_edges, minlength=graph.num_edges)
+    return num_tops == 2 if mutual else num_tops > 0
+
+
+def sample_hub_edges(graph, max_degree, random):
+    """
+    Samples the edges of nodes with more than max_degree edges. An edge is
+    kept with probability min(1, max_degree / degree) of the higher degree of
+    its nodes, so every node keeps max_degree edges in expectation, and a kept
+    edge is reweighted by the inverse of that probability so the expected
+    weighted degree of every node is unchanged. Reweighted edges are capped
+    at 1 to stay similarities, so hubs of heavy edges lose some flow (see
+    sparsification_report).
+    :param graph:
+    :type graph: ArrayGraph
+    :param max_degree: expected max no. of edges of a node
+    :type max_degree: int
+    :param random:
+    :type random: random.Random
+    :return: True for every kept edge, new weight of every edge
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    if max_degree < 1:
+        raise ValueError("max_degree must be at least 1")
+
+    node_probs = np.minimum(1.0, max_degree / np.maximum(graph.degrees(), 1))
+    edge_probs = np.minimum(node_probs[graph.edge_src], node_probs[graph.edge_dst])
+
+    rng = np.random.default_rng(random.getrandbits(63))
+    keep = rng.random(graph.num_edges) < edge_probs
+
+    return keep, np.minimum(graph.edge_weights / edge_probs, 1.0)
+
+
+def sparsified_graph(graph, keep, weights=None):
+    """
+    :param graph:
+    :type graph: ArrayGraph
+    :param keep: True for every kept edge
+    :type keep: np.ndarray
+    :param weights: new weight of every edge, None to keep the weights
+    :type weights: np.ndarray | None
+    :return: graph of the kept edges with the same nodes, weight sorted if
+             the graph was
+    :rtype: ArrayGraph
+    """
+    if weights is None:
+        return ArrayGraph(graph.node_ids, graph.edge_src[keep], graph.edge_dst[keep], graph.edge_weights[keep],
+                          weight_sorted=graph.weight_sorted)
+
+    sparse_graph = ArrayGraph(graph.node_ids, graph.edge_src[keep], graph.edge_dst[keep], weights[keep])
+    if graph.weight_sorted:
+        sparse_graph.sort_by_weight()
+    return sparse_graph
+
+
+def two_hop_weights(graph):
+    """
+    :param graph:
+    :type graph: ArrayGraph
+    :return: sum of the weights (product of the edge weights) of all 2 hop
+             paths from every node to another node, i.e. the node flows of the
+             whole graph without node weights
+    :rtype: np.ndarray
+    """
+    rows = np.repeat(np.arange(graph.num_nodes), graph.degrees())
+    weighted_degrees = np.bincount(rows, weights=graph.weights, minlength=graph.num_nodes)
+    return np.bincount(rows, weights=graph.weights * (weighted_degrees[graph.indices] - graph.weights),
+                       minlength=graph.num_nodes)
+
+
+def sparsification_report(graph, sparse_graph):
+    """
+    :param graph: graph before sparsification
+    :type graph: ArrayGraph
+    :param sparse_graph: graph after sparsification, same nodes
+    :type sparse_graph: ArrayGraph
+    :return: edge counts, sum of squared degrees and max degree before and
+             after, and the estimated node flow impact: ratio of the total 2
+             hop path weights, mean and max relative change of the nodes that
+             had any, and the Spearman rank correlation of the nodes' 2 hop
+             path weights before and after
+    :rtype: dict
+    """
+    degrees = graph.degrees().astype(np.float64)
+    sparse_degrees = sparse_graph.degrees().astype(np.float64)
+    flows = two_hop_weights(graph)
+    sparse_flows = two_hop_weights(sparse_graph)
+
+    has_flow = flows > 0
+    relative_changes = np.abs(sparse_flows[has_flow] - flows[has_flow]) / flows[has_flow]
+    if np.count_nonzero(has_flow) > 1:
+        rank_correlation = float(spearmanr(flows, sparse_flows)[0])
+    else:
+        rank_correlation = None
+
+    sum_sq_degrees = float((degrees ** 2).sum())
+    sparse_sum_sq_degrees = float((sparse_degrees ** 2).sum())
+    return {
+        "edges": graph.num_edges,
+        "sparse_edges": sparse_graph.num_edges,
+        "sum_sq_degrees": sum_sq_degrees,
+        "sparse_sum_sq_degrees": sparse_sum_sq_degrees,
+        "sum_sq_degrees_ratio": sparse_sum_sq_degrees / sum_sq_degrees if sum_sq_degrees else None,
+        "max_degree": int(degrees.max()) if len(degrees) else 0,
+        "sparse_max_degree": int(sparse_degrees.max()) if len(sparse_degrees) else 0,
+        "flow_ratio": float(sparse_flows.sum() / flows.sum()) if flows.sum() else None,
+        "mean_flow_change": float(relative_changes.mean()) if len(relative_changes) else None,
+        "max_flow_change": float(relative_changes.max()) if len(relative_changes) else None,
+        "flow_rank_correlation": rank_correlation
+    }